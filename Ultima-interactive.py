@@ -8,11 +8,34 @@ import grp
 import time
 import datetime
 import shlex
+import re # <--- For scanning fstab entries
+import json # <--- For parsing lvs JSON reports
+import stat # <--- For rendering file modes without ls
+import fcntl # <--- For locking /etc/subuid and /etc/subgid while appending
+import mmap # <--- For searching files in place without reading them into memory
+import selectors # <--- For draining subprocess pipes incrementally
+import contextlib
+import traceback
+import functools
+import ssl
+import tempfile
+import urllib.request
 import logging
+import logging.handlers # <--- For buffered log output
+import atexit
+import queue # <--- For the background logging queue
 from pathlib import Path
 import shutil # <--- Import for shutil.which()
 import argparse # <--- Import argparse
 import platform # <--- For system information
+import threading # <--- For background console export
+from concurrent.futures import ThreadPoolExecutor # <--- For overlapping independent I/O
+from types import SimpleNamespace # <--- For sharing computed paths between steps and summary
+
+# os.waitstatus_to_exitcode and os.copy_file_range need 3.9/3.8; from 3.8 on shutil.copyfile
+# (and copy2) also copies in-kernel via sendfile on Linux, so backups never loop in Python
+if sys.version_info < (3, 9):
+    sys.exit("Error: this installer requires Python 3.9 or newer.")
 
 # --- Rich TUI Imports (Enhanced) ---
 from rich.console import Console
@@ -26,6 +49,8 @@ from rich.table import Table  # <--- For system info tables
 from rich.tree import Tree    # <--- For feature preview
 from rich.align import Align  # <--- For centered content
 from rich.columns import Columns  # <--- For side-by-side content
+from rich.markup import escape # <--- For showing command text inside markup
+from rich.filesize import decimal as format_size # <--- For human-readable sizes
 from rich.layout import Layout    # <--- For complex layouts
 
 # Try to import psutil for system info (optional)
@@ -35,6 +60,20 @@ try:
 except ImportError:
     PSUTIL_AVAILABLE = False
 
+# Try to import python3-apt for in-process package installs (optional)
+try:
+    import apt
+    APT_PKG_AVAILABLE = True
+except ImportError:
+    APT_PKG_AVAILABLE = False
+
+# Try to import pystemd for reading unit state over D-Bus without spawning systemctl (optional)
+try:
+    from pystemd.systemd1 import Unit as SystemdUnit
+    PYSTEMD_AVAILABLE = True
+except ImportError:
+    PYSTEMD_AVAILABLE = False
+
 # --- Configuration ---
 LOCAL_QCOW_PATH = Path("/android.qcow2")
 DEFAULT_QCOW_SIZE = "126G" # Default size if creating the QCOW2 file
@@ -43,9 +82,11 @@ VG_NAME = "data_vg"
 LV_NAME = "data_lv"
 LVM_MOUNT_POINT = Path("/mnt/data")
 LV_DEVICE_PATH = Path(f"/dev/{VG_NAME}/{LV_NAME}")
+LVM_SETUP_SENTINEL = Path("/var/lib/avf/lvm-setup.done") # Written once PV/VG/LV/filesystem exist
 DEBIAN_USER = "droid"
 DEBIAN_GROUP = "users"  # Group for mount point/Samba/VNC
 ZT_NETWORK_ID = "INSERT Zerotier Network ID" # Example ZeroTier Network ID
+ZT_NETWORKS_DIR = Path("/var/lib/zerotier-one/networks.d") # One <network id>.conf per joined network
 VNC_DISPLAY_NUM = "1"
 VNC_DISPLAY = f":{VNC_DISPLAY_NUM}"
 VNC_GEOMETRY = "2424x1080" # Example geometry, adjust as needed
@@ -79,6 +120,9 @@ REQUIRED_PACKAGES = [
     "zsh", "bash-completion", # Shell enhancements
     "lsb-release", # For Docker installation
 ]
+# Deduplicated and sorted so apt sees the same argument order on every run (this also keeps
+# related packages such as gnome-*, qemu-* and python3-* next to each other)
+REQUIRED_PACKAGES = tuple(sorted(set(REQUIRED_PACKAGES)))
 
 KEY_COMMANDS_TO_VALIDATE = [
     "qemu-img",
@@ -100,19 +144,73 @@ KEY_COMMANDS_TO_VALIDATE = [
     "update-binfmts",
 ]
 
+# Environment overlay for every apt-get/dpkg call (run_command merges it onto os.environ)
+APT_NONINTERACTIVE_ENV = {'DEBIAN_FRONTEND': 'noninteractive'}
+# python3-apt's commit() runs dpkg with the process environment, so it is set once here at
+# startup, before the logging thread or any step threads exist, rather than around each call
+os.environ.update(APT_NONINTERACTIVE_ENV)
+# dpkg is not concurrent; steps that may run in parallel take this around apt work
+APT_LOCK = threading.Lock()
+
 # --- Setup Logging ---
 current_timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
 LOG_FILENAME = f"/var/log/setup_avf_interactive_{current_timestamp}.log"
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
-    filename=LOG_FILENAME,
-    filemode='w'
+# Console HTML dumps written on failure (built once so the error paths only load a name)
+ERROR_HTML_LOG = f"installer_error_console_{current_timestamp}.html"
+CRITICAL_HTML_LOG = f"installer_CRITICAL_error_console_{current_timestamp}.html"
+# Pre-encoded critical-error banners, written straight to stderr on the failure path
+_BANNER_CRIT = b"\n\x1b[1;31mAn unexpected critical error occurred outside of step execution:\x1b[0m\n"
+_BANNER_LOG_HINT = b"\nPlease check the log file for details: " + LOG_FILENAME.encode() + b"\n"
+_log_file_handler = logging.FileHandler(LOG_FILENAME, mode='w')
+_log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+# Buffer records in RAM and write them out in batches; CRITICAL records and exit flush immediately
+log_buffer_handler = logging.handlers.MemoryHandler(
+    capacity=512,
+    flushLevel=logging.CRITICAL,
+    target=_log_file_handler,
+    flushOnClose=True
 )
+# Callers only enqueue records; a listener thread feeds them to the buffered file handler
+_log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(_log_queue, log_buffer_handler)
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# QueueHandler.prepare() formats each record with this formatter in the calling thread, before
+# queueing: it merges the message args and any traceback into the message. Only the
+# timestamp/level prefix is added later by the file handler on the listener thread.
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.DEBUG, handlers=[_log_queue_handler])
+log_listener.start()
+# atexit runs LIFO: drain the queue first, then flush/close the buffer
+atexit.register(log_buffer_handler.close)
+atexit.register(log_listener.stop)
 logger = logging.getLogger("AVFInstaller")
 
+def flush_logs():
+    """Drains queued log records and writes all buffered records to the log file."""
+    log_listener.stop() # Processes everything already queued
+    log_buffer_handler.flush()
+    log_listener.start()
+
 # --- Console for Rich Output ---
 console = Console(record=True, log_time_format="[%Y-%m-%d %H:%M:%S]")
+QUIET = False # Set by --quiet: skips progress chatter (errors, warnings and prompts still print)
+
+def notice(*objects, **kwargs):
+    """console.print for non-essential progress messages; a no-op under --quiet."""
+    if not QUIET:
+        console.print(*objects, **kwargs)
+
+# Pre-built Rich text for messages the Samba/Podman steps print repeatedly; assembled with
+# Text.assemble() at print time instead of re-parsing markup around the same constants
+_USER_TAG = Text(DEBIAN_USER, style="yellow")
+_SAMBA_SHARES_TEXT = Text.from_markup(
+    "[bold yellow]Available Shares:[/bold yellow]\n"
+    "  • [cyan]RootFS[/cyan] - Root filesystem (read-only, secure)\n"
+    "  • [cyan]RootFS-RW[/cyan] - Root filesystem (read-write, DANGEROUS!)\n"
+    "  • [cyan]Homes[/cyan] - User home directories\n"
+    f"  • [cyan]{SAMBA_SHARE_NAME}[/cyan] - Data volume\n"
+    "[bold red]WARNING:[/bold red] RootFS-RW share provides full system access - use with extreme caution!"
+)
 
 # =============================================================================
 # ENHANCED VISUAL FUNCTIONS
@@ -347,6 +445,19 @@ def show_completion_celebration(duration, features_installed=27):
     
     console.print(stats_table)
 
+# Invariant body of the pre-install warning panel, parsed once at import
+_CHANGES_NOTICE_TEXT = Text.from_markup(
+    "[bold red]⚠️  IMPORTANT SYSTEM CHANGES AHEAD ⚠️[/bold red]\n\n"
+    "This installer will make significant modifications:\n\n"
+    "• [yellow]Install 60+ packages[/yellow] and their dependencies\n"
+    "• [yellow]Modify system configs[/yellow] (/etc/ssh, /etc/samba, etc.)\n"
+    "• [yellow]Create storage volumes[/yellow] and mount points\n"
+    "• [yellow]Configure network services[/yellow] and security settings\n"
+    "• [yellow]Set up containerization[/yellow] (Docker + Podman)\n"
+    "• [yellow]Enable x86 emulation[/yellow] on ARM64 architecture\n\n"
+    "[dim]Estimated time: 15-30 minutes depending on network speed[/dim]"
+)
+
 def enhanced_confirmation(args):
     """Enhanced confirmation with better visual layout"""
     
@@ -382,15 +493,7 @@ def enhanced_confirmation(args):
     # Warning panel
     console.print("\n")
     console.print(Panel(
-        "[bold red]⚠️  IMPORTANT SYSTEM CHANGES AHEAD ⚠️[/bold red]\n\n"
-        "This installer will make significant modifications:\n\n"
-        "• [yellow]Install 60+ packages[/yellow] and their dependencies\n"
-        "• [yellow]Modify system configs[/yellow] (/etc/ssh, /etc/samba, etc.)\n"
-        "• [yellow]Create storage volumes[/yellow] and mount points\n"
-        "• [yellow]Configure network services[/yellow] and security settings\n"
-        "• [yellow]Set up containerization[/yellow] (Docker + Podman)\n"
-        "• [yellow]Enable x86 emulation[/yellow] on ARM64 architecture\n\n"
-        "[dim]Estimated time: 15-30 minutes depending on network speed[/dim]",
+        _CHANGES_NOTICE_TEXT,
         title="🚨 System Modification Notice",
         border_style="red",
         padding=(1, 2)
@@ -405,84 +508,225 @@ def enhanced_confirmation(args):
 
 # --- Helper Functions ---
 
+# Lines of stdout/stderr shown per stream when a command fails (the result and the debug log
+# keep every line)
+OUTPUT_RING_LINES = 1024
+
+# Read-only utilities that may be spawned without the close_fds sweep (Python's own fds are
+# non-inheritable anyway); this lets subprocess use posix_spawn for them.
+FAST_SPAWN_COMMANDS = frozenset({'date', 'ls', 'stat', 'id', 'groups', 'uname', 'lsblk', 'dpkg-query'})
+FAST_SPAWN_SYSTEMCTL_VERBS = frozenset({'is-active', 'is-enabled', 'show', 'status'})
+
+def _is_fast_spawn(command):
+    """Returns True if a list command is on the read-only allow-list for the fast spawn path."""
+    exe = os.path.basename(str(command[0]))
+    if exe == 'systemctl':
+        return len(command) > 1 and command[1] in FAST_SPAWN_SYSTEMCTL_VERBS
+    return exe in FAST_SPAWN_COMMANDS
+
+def _stream_process(cmd_to_run, shell=False, cwd=None, env=None, timeout=None, text=True, capture_output=True, show_output=False, close_fds=True):
+    """
+    Runs a command via Popen, draining stdout/stderr incrementally through a selector.
+    Each complete line is sent to the debug log (and echoed to the console when show_output
+    is set) and kept in full for the result.
+    With capture_output=False stdin/stdout go to /dev/null (no pipe, no decoding) and only
+    stderr is drained, so failures can still be reported; the result's stdout is None.
+    Returns a subprocess.CompletedProcess. Raises subprocess.TimeoutExpired carrying the
+    partial output if the timeout is hit (the process is killed first).
+    """
+    if capture_output:
+        proc = subprocess.Popen(cmd_to_run, shell=shell, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=close_fds)
+    else:
+        proc = subprocess.Popen(cmd_to_run, shell=shell, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, close_fds=close_fds)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    collected = {'stdout': [], 'stderr': []}
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
+    def _emit(stream_name, raw_line):
+        line = raw_line.decode('utf-8', errors='replace').rstrip('\r') if text else raw_line
+        collected[stream_name].append(line)
+        if debug_enabled:
+            logger.debug("%s: %s", stream_name, line)
+        if show_output:
+            console.print(line, style="dim" if stream_name == 'stdout' else "yellow", markup=False, highlight=False)
+
+    def _collected(stream_name):
+        if stream_name == 'stdout' and not capture_output:
+            return None
+        lines = collected[stream_name]
+        if text:
+            return '\n'.join(lines) + '\n' if lines else ''
+        return b'\n'.join(lines) + b'\n' if lines else b''
+
+    def _timed_out():
+        proc.kill()
+        proc.wait()
+        return subprocess.TimeoutExpired(cmd_to_run, timeout, output=_collected('stdout'), stderr=_collected('stderr'))
+
+    partial = {'stdout': b'', 'stderr': b''}
+    with selectors.DefaultSelector() as sel:
+        if proc.stdout is not None:
+            sel.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+        sel.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+        try:
+            while sel.get_map():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise _timed_out()
+                for key, _ in sel.select(remaining):
+                    stream_name = key.data
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk: # EOF on this stream
+                        sel.unregister(key.fileobj)
+                        if partial[stream_name]:
+                            _emit(stream_name, partial[stream_name])
+                            partial[stream_name] = b''
+                        continue
+                    *lines, partial[stream_name] = (partial[stream_name] + chunk).split(b'\n')
+                    for raw_line in lines:
+                        _emit(stream_name, raw_line)
+        finally:
+            if proc.stdout is not None:
+                proc.stdout.close()
+            proc.stderr.close()
+
+    try:
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        returncode = proc.wait(timeout=remaining)
+    except subprocess.TimeoutExpired:
+        raise _timed_out()
+    return subprocess.CompletedProcess(cmd_to_run, returncode, _collected('stdout'), _collected('stderr'))
+
+@functools.lru_cache(maxsize=16)
+def _user_env_template(uid):
+    """Our environment with HOME/USER/LOGNAME switched to the given user; copy before modifying."""
+    pw_info = pwd.getpwuid(uid)
+    user_env = os.environ.copy()
+    user_env['HOME'] = pw_info.pw_dir
+    user_env['USER'] = pw_info.pw_name
+    user_env['LOGNAME'] = pw_info.pw_name
+    return user_env
+
+def _print_command_failure(header, stderr=None, stdout=None):
+    """
+    Prints a failure header (markup) plus any captured stderr/stdout in a single console write.
+    Captured output is appended as plain text, so brackets in it are never parsed as markup;
+    each stream shows at most its last OUTPUT_RING_LINES lines (the debug log has them all).
+    """
+    message = Text.from_markup(header)
+    for label, style, output in (("Stderr", "yellow", stderr), ("Stdout", "dim", stdout)):
+        if not output:
+            continue
+        message.append(f"\n{label}: ", style=style)
+        lines = output.splitlines(keepends=True)
+        if len(lines) > OUTPUT_RING_LINES:
+            message.append(f"… {len(lines) - OUTPUT_RING_LINES} earlier lines omitted (see log) …\n", style="dim")
+            output = ''.join(lines[-OUTPUT_RING_LINES:])
+        message.append(output)
+    console.print(message)
+
+class _LazyCmdStr:
+    """Shell-quoted display form of a command, built only when first formatted (e.g. by an emitted log record)."""
+    __slots__ = ('_command', '_text')
+
+    def __init__(self, command):
+        self._command = command
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            if isinstance(self._command, list):
+                self._text = ' '.join(shlex.quote(str(arg)) for arg in self._command)
+            else:
+                self._text = self._command
+        return self._text
+
 def run_command(command, description="Running command", check=True, shell=False, capture_output=True, text=True, user=None, cwd=None, env=None, show_output=False, timeout=None):
     """
-    Runs a command using subprocess.run, logs execution details, and handles errors including timeout.
+    Runs a command (streaming its output, see _stream_process), logs execution details, and handles errors including timeout.
     Uses sudo -u USER -H -- command for running as another user.
+    Pass capture_output=False when only the exit status matters (stdout is discarded, stderr kept).
     Returns the subprocess.CompletedProcess object on success (return code 0), None on failure or timeout.
     """
-    if isinstance(command, list):
-        cmd_str_display = ' '.join(shlex.quote(str(arg)) for arg in command)
-        cmd_to_run = command
-    else:
-        cmd_str_display = command
-        cmd_to_run = command
-        if not shell:
-            logger.warning(f"Command is a string ('{cmd_str_display}') but shell=False. This might not work as expected.")
+    cmd_str_display = _LazyCmdStr(command)
+    cmd_to_run = command
+    if not isinstance(command, list) and not shell:
+        logger.warning("Command is a string ('%s') but shell=False. This might not work as expected.", command)
 
     log_prefix = f"[User: {user}] " if user else ""
-    logger.info(f"{log_prefix}Executing: {cmd_str_display}")
+    logger.info("%sExecuting: %s", log_prefix, cmd_str_display)
     sensitive_desc = "password" in description.lower()
-    console.log(f"{log_prefix}{description}: [dim]{'(command hidden)' if sensitive_desc else cmd_str_display}[/dim]")
+    if not QUIET:
+        console.log(f"{log_prefix}{description}: [dim]{'(command hidden)' if sensitive_desc else escape(str(cmd_str_display))}[/dim]")
 
-    full_env = os.environ.copy()
+    full_env = None # None = inherit our environment unchanged; only built when user/env need it
     if user:
         try:
-            pw_info = pwd.getpwnam(user)
-            full_env['HOME'] = pw_info.pw_dir
-            full_env['USER'] = user
-            full_env['LOGNAME'] = user
+            pw_info = _pw(user)
+            full_env = _user_env_template(pw_info.pw_uid).copy()
             # Ensure XDG_RUNTIME_DIR is set if the user has one (important for podman rootless)
             xdg_runtime_dir = f"/run/user/{pw_info.pw_uid}"
             if Path(xdg_runtime_dir).is_dir():
                  full_env['XDG_RUNTIME_DIR'] = xdg_runtime_dir
                  logger.debug(f"Setting XDG_RUNTIME_DIR={xdg_runtime_dir} for user {user}")
 
-            sudo_prefix = ['sudo', '-u', user, '-H', '--'] # Using -H to set HOME
+            if pw_info.pw_uid == os.geteuid():
+                # Already running as the target user; HOME/USER/LOGNAME above are all sudo -H would add
+                logger.debug(f"Already running as '{user}' (uid {pw_info.pw_uid}), skipping sudo.")
+            else:
+                sudo_prefix = ['sudo', '-u', user, '-H', '--'] # Using -H to set HOME
 
-            # Prepend sudo prefix and ensure PATH is reasonable
-            # We might need to explicitly pass PATH if sudo resets it too much
-            # sudo_prefix.extend(['env', f'PATH={full_env.get("PATH", os.defpath)}']) # More robust? Maybe too complex.
+                # Prepend sudo prefix and ensure PATH is reasonable
+                # We might need to explicitly pass PATH if sudo resets it too much
+                # sudo_prefix.extend(['env', f'PATH={full_env.get("PATH", os.defpath)}']) # More robust? Maybe too complex.
 
-            if isinstance(cmd_to_run, list):
-                 cmd_to_run = sudo_prefix + cmd_to_run
-            else:
-                 logger.warning("Running shell=True command as different user via sudo is complex. Prefer list-based commands.")
-                 cmd_to_run = ' '.join(sudo_prefix) + ' ' + cmd_to_run
-                 shell = True # Must use shell if original was string
-            cmd_str_display = ' '.join(shlex.quote(str(arg)) for arg in cmd_to_run) if isinstance(cmd_to_run, list) else cmd_to_run
-            logger.info(f"Updated command with sudo: {'(command hidden)' if sensitive_desc else cmd_str_display}")
+                if isinstance(cmd_to_run, list):
+                     cmd_to_run = sudo_prefix + cmd_to_run
+                else:
+                     logger.warning("Running shell=True command as different user via sudo is complex. Prefer list-based commands.")
+                     cmd_to_run = ' '.join(sudo_prefix) + ' ' + cmd_to_run
+                     shell = True # Must use shell if original was string
+                cmd_str_display = _LazyCmdStr(cmd_to_run)
+                logger.info("Updated command with sudo: %s", '(command hidden)' if sensitive_desc else cmd_str_display)
         except KeyError:
             logger.error(f"User '{user}' not found for run_command.")
             console.print(f"[bold red]Error:[/bold red] System user '{user}' not found.")
             return None
 
     if env:
+        if full_env is None:
+            full_env = os.environ.copy()
         full_env.update(env)
 
+    # Resolve bare executable names once via the cached PATH scan; an absolute path lets
+    # subprocess skip its own PATH walk (and use posix_spawn where allowed)
+    if isinstance(cmd_to_run, list) and not shell and not (env and 'PATH' in env):
+        exe = str(cmd_to_run[0])
+        if os.sep not in exe:
+            resolved_exe = find_executable(exe)
+            if resolved_exe:
+                cmd_to_run = [resolved_exe] + list(cmd_to_run[1:])
+
     try:
-        result = subprocess.run(
+        # Output is streamed line by line to the debug log (and console when show_output is set)
+        result = _stream_process(
             cmd_to_run,
-            check=check,
             shell=shell,
-            capture_output=capture_output,
-            text=text,
             cwd=cwd,
             env=full_env,
-            timeout=timeout
+            timeout=timeout,
+            text=text,
+            capture_output=capture_output,
+            show_output=show_output,
+            # Allow-listed read-only commands run as root skip the fd sweep
+            close_fds=not (user is None and not shell and cwd is None and isinstance(cmd_to_run, list) and _is_fast_spawn(cmd_to_run))
         )
-        logger.debug(f"Command completed: {'(command hidden)' if sensitive_desc else cmd_str_display}")
+        logger.debug("Command completed: %s", '(command hidden)' if sensitive_desc else cmd_str_display)
         logger.debug(f"Return Code: {result.returncode}")
-        if result.stdout: logger.debug(f"Stdout:\n{result.stdout.strip()}")
-        if result.stderr: logger.debug(f"Stderr:\n{result.stderr.strip()}")
-
-        if show_output and result.stdout:
-             console.print(f"[dim]{result.stdout.strip()}[/dim]")
-        if show_output and result.stderr:
-             console.print(f"[yellow]Stderr:[/yellow] [dim]{result.stderr.strip()}[/dim]")
 
         if result.returncode == 0:
-            console.log(f"[green]Success:[/green] {description}")
+            if not QUIET:
+                console.log(f"[green]Success:[/green] {description}")
             return result
         else:
              # Only raise CalledProcessError if check=True was intended (which it defaults to)
@@ -491,70 +735,596 @@ def run_command(command, description="Running command", check=True, shell=False,
                  result.check_returncode()
              else:
                  # If check=False, failure is not exceptional, just return None
-                 console.print(f"[yellow]Command Failed (Code: {result.returncode}, check=False):[/yellow] [dim]{'(command hidden)' if sensitive_desc else cmd_str_display}[/dim]")
-                 if result.stderr: console.print(f"[yellow]Stderr:[/yellow] {result.stderr.strip()}")
-                 if result.stdout: console.print(f"[dim]Stdout:[/dim] {result.stdout.strip()}")
-                 logger.warning(f"Command failed with return code {result.returncode} (check=False): {'(command hidden)' if sensitive_desc else cmd_str_display}")
+                 _print_command_failure(f"[yellow]Command Failed (Code: {result.returncode}, check=False):[/yellow] [dim]{'(command hidden)' if sensitive_desc else escape(str(cmd_str_display))}[/dim]",
+                                        result.stderr and result.stderr.strip(), result.stdout and result.stdout.strip())
+                 logger.warning("Command failed with return code %s (check=False): %s", result.returncode, '(command hidden)' if sensitive_desc else cmd_str_display)
                  return None # Return None for non-zero exit when check=False
 
     except subprocess.TimeoutExpired as e:
-        logger.error(f"Command timed out after {timeout} seconds: {'(command hidden)' if sensitive_desc else cmd_str_display}")
+        logger.error("Command timed out after %s seconds: %s", timeout, '(command hidden)' if sensitive_desc else cmd_str_display)
         stdout_cap = e.stdout.strip() if e.stdout and isinstance(e.stdout, str) else "(no stdout captured or not text)"
         stderr_cap = e.stderr.strip() if e.stderr and isinstance(e.stderr, str) else "(no stderr captured or not text)"
-        logger.error(f"Timeout Stdout: {stdout_cap}")
-        logger.error(f"Timeout Stderr: {stderr_cap}")
-        console.print(f"[bold red]Error:[/bold red] Command timed out after {timeout} seconds: [dim]{'(command hidden)' if sensitive_desc else cmd_str_display}[/dim]")
-        if e.stderr: console.print(f"[yellow]Timeout Stderr:[/yellow] {stderr_cap}")
-        if e.stdout: console.print(f"[dim]Timeout Stdout:[/dim] {stdout_cap}")
+        logger.error("Timeout Stdout: %s", stdout_cap)
+        logger.error("Timeout Stderr: %s", stderr_cap)
+        _print_command_failure(f"[bold red]Error:[/bold red] Command timed out after {timeout} seconds: [dim]{'(command hidden)' if sensitive_desc else escape(str(cmd_str_display))}[/dim]",
+                               e.stderr and stderr_cap, e.stdout and stdout_cap)
         return None
     except subprocess.CalledProcessError as e:
         # This block now handles failures when check=True
-        logger.error(f"Command failed: {'(command hidden)' if sensitive_desc else cmd_str_display}", exc_info=False)
+        logger.error("Command failed: %s", '(command hidden)' if sensitive_desc else cmd_str_display, exc_info=False)
         logger.error(f"Return code: {e.returncode}")
         stdout_cap = e.stdout.strip() if e.stdout and isinstance(e.stdout, str) else "(no stdout captured or not text)"
         stderr_cap = e.stderr.strip() if e.stderr and isinstance(e.stderr, str) else "(no stderr captured or not text)"
-        if e.stdout: logger.error(f"Stdout:\n{stdout_cap}")
-        if e.stderr: logger.error(f"Stderr:\n{stderr_cap}")
-        console.print(f"[bold red]Error:[/bold red] Command failed (Code: {e.returncode}): [dim]{'(command hidden)' if sensitive_desc else cmd_str_display}[/dim]")
-        if e.stderr: console.print(f"[yellow]Stderr:[/yellow] {stderr_cap}")
-        if e.stdout: console.print(f"[dim]Stdout:[/dim] {stdout_cap}")
+        if e.stdout: logger.error("Stdout:\n%s", stdout_cap)
+        if e.stderr: logger.error("Stderr:\n%s", stderr_cap)
+        _print_command_failure(f"[bold red]Error:[/bold red] Command failed (Code: {e.returncode}): [dim]{'(command hidden)' if sensitive_desc else escape(str(cmd_str_display))}[/dim]",
+                               e.stderr and stderr_cap, e.stdout and stdout_cap)
         return None
     except FileNotFoundError:
         cmd_exec = cmd_to_run[0] if isinstance(cmd_to_run, list) else cmd_to_run.split()[0]
-        logger.error(f"Command executable not found: '{cmd_exec}' for command: {'(command hidden)' if sensitive_desc else cmd_str_display}")
+        logger.error("Command executable not found: '%s' for command: %s", cmd_exec, '(command hidden)' if sensitive_desc else cmd_str_display)
         console.print(f"[bold red]Error:[/bold red] Command executable not found: '{cmd_exec}'. Check installation and PATH.")
         return None
     except Exception as e:
-        logger.exception(f"An unexpected error occurred running command: {'(command hidden)' if sensitive_desc else cmd_str_display}")
+        logger.exception("An unexpected error occurred running command: %s", '(command hidden)' if sensitive_desc else cmd_str_display)
         console.print(f"[bold red]Unexpected Error during command execution:[/bold red] {e}")
         console.print_exception(show_locals=False)
         return None
 
 
+# {basename: full path} for every file on PATH, built by one scan; None until first lookup
+_path_cache = None
+
+def find_executable(name):
+    """
+    Looks up an executable on PATH using a single cached scan of the PATH directories
+    (first directory wins, like shutil.which). Returns the full path, or None if not found.
+    Call invalidate_path_cache() after installing packages.
+    """
+    global _path_cache
+    if _path_cache is None:
+        cache = {}
+        for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+            if not directory:
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        # is_file() uses the dirent type, so only symlinks cost a stat here
+                        if entry.name not in cache and entry.is_file():
+                            cache[entry.name] = entry.path
+            except OSError:
+                continue
+        _path_cache = cache
+        logger.debug(f"Scanned PATH: {len(cache)} entries cached.")
+    cmd_path = _path_cache.get(name)
+    if cmd_path and os.access(cmd_path, os.X_OK):
+        return cmd_path
+    return None
+
+def invalidate_path_cache():
+    """Drops the cached PATH scan so the next find_executable() call rescans."""
+    global _path_cache
+    _path_cache = None
+
+# One TLS context shared by every HTTPS download (CA bundle loaded once)
+_SSL_CONTEXT = ssl.create_default_context()
+_SSL_CONTEXT.minimum_version = ssl.TLSVersion.TLSv1_2 # Same floor as curl --tlsv1.2
+
+def download_to_tempfile(url, suffix="", timeout=30):
+    """
+    Downloads a URL over HTTPS into a new temporary file (mode 0600).
+    Returns the Path of the temp file (caller removes it), or None on failure.
+    """
+    logger.info(f"Downloading {url}")
+    console.log(f"Downloading: [dim]{url}[/dim]")
+    try:
+        with urllib.request.urlopen(url, timeout=timeout, context=_SSL_CONTEXT) as response:
+            data = response.read()
+        fd, tmp_name = tempfile.mkstemp(prefix="avf-download-", suffix=suffix)
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        logger.info(f"Downloaded {len(data)} bytes from {url} to {tmp_name}")
+        return Path(tmp_name)
+    except (OSError, ValueError) as e: # URLError/HTTPError/timeouts are OSError subclasses
+        logger.error(f"Failed to download {url}: {e}")
+        console.print(f"[bold red]Error:[/bold red] Failed to download {url}: {e}")
+        return None
+
+def batch_apt(commands, description="Batched apt-get run", **kwargs):
+    """
+    Runs several apt-get invocations in a single 'sh -c' process.
+    `commands` is a list of (argv, required) pairs: a failing required command stops
+    the batch, a failing optional one only prints a warning to stderr and the batch continues.
+    Extra keyword arguments go to run_command (env defaults to APT_NONINTERACTIVE_ENV).
+    Returns the run_command result (None on failure).
+    """
+    script_parts = []
+    for argv, required in commands:
+        cmd_str = ' '.join(shlex.quote(str(arg)) for arg in argv)
+        if required:
+            script_parts.append(cmd_str)
+        else:
+            warn_msg = shlex.quote(f"Warning: '{' '.join(argv[:2])}' failed, continuing")
+            script_parts.append(f"{{ {cmd_str} || echo {warn_msg} >&2; }}")
+    kwargs.setdefault('env', APT_NONINTERACTIVE_ENV)
+    with APT_LOCK:
+        result = run_command(['sh', '-c', ' && '.join(script_parts)], description=description, **kwargs)
+    invalidate_path_cache() # Packages may have added executables
+    return result
+
+def apt_update_source_cmd(sources_file):
+    """
+    Returns an 'apt-get update' argv that refreshes only the lists for `sources_file`
+    (e.g. a repo just added under sources.list.d), leaving the other repos' lists untouched.
+    """
+    return ['apt-get', 'update', '-qq',
+            '-o', f'Dir::Etc::sourcelist={sources_file}',
+            '-o', 'Dir::Etc::sourceparts=-',
+            '-o', 'APT::Get::List-Cleanup=0']
+
+def _log_stream_lines(fd, tag):
+    """Logs each line read from `fd` (until EOF) under `tag`; run on a background thread."""
+    with os.fdopen(fd, 'rb') as stream:
+        for line in stream:
+            logger.info("[%s] %s", tag, line.decode(errors='replace').rstrip())
+
+if APT_PKG_AVAILABLE:
+    import apt.progress.base
+
+    class _LoggedInstallProgress(apt.progress.base.InstallProgress):
+        """
+        python3-apt install progress that sends dpkg/debconf output to the installer log
+        instead of the terminal, so it cannot scroll over the live Rich progress display.
+        """
+        def fork(self):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                # Child (runs dpkg): stdout/stderr go into the pipe
+                os.dup2(write_fd, 1)
+                os.dup2(write_fd, 2)
+                os.close(read_fd)
+                os.close(write_fd)
+                return pid
+            os.close(write_fd)
+            threading.Thread(target=_log_stream_lines, args=(read_fd, "dpkg"), name="dpkg-output", daemon=True).start()
+            return pid
+
+# apt_cache_install() result when requested packages are not in any APT source; the apt-get
+# fallback would fail the same way, so callers abort instead of retrying
+APT_UNKNOWN_PACKAGES = "unknown-packages"
+
+def apt_cache_install(packages, upgrade=True):
+    """
+    Refreshes the package lists, optionally upgrades, and installs `packages` through
+    python3-apt, so the resolver is loaded once instead of once per apt-get call.
+    Download and dpkg output go to the log file, not the terminal.
+    A failed list refresh only warns (like the optional steps of batch_apt).
+    Returns True on success, APT_UNKNOWN_PACKAGES if some packages do not exist in the
+    configured sources, and False on other failures (callers fall back to the apt-get path).
+    """
+    try:
+        with APT_LOCK:
+            cache = apt.Cache()
+            fetch_progress = apt.progress.base.AcquireProgress() # Silent
+            try:
+                cache.update(fetch_progress)
+            except OSError as e: # FetchFailedException is an IOError
+                console.print(f"[bold yellow]Warning:[/bold yellow] Package list update failed ({e}); continuing.")
+                logger.warning(f"apt cache update failed: {e}")
+            cache.open(None)
+            if upgrade:
+                cache.upgrade()
+            unknown = [name for name in packages if name not in cache]
+            if unknown:
+                logger.error(f"Packages not found in apt cache: {unknown}")
+                console.print(f"[bold red]Error:[/bold red] Packages not available from APT sources: {unknown}")
+                return APT_UNKNOWN_PACKAGES
+            for name in packages:
+                cache[name].mark_install()
+            if cache.get_changes():
+                logger.info(f"Committing {len(cache.get_changes())} package changes via python3-apt.")
+                cache.commit(fetch_progress, _LoggedInstallProgress())
+        return True
+    except (OSError, SystemError) as e: # LockFailedException is an IOError; apt_pkg errors are SystemError
+        logger.error(f"python3-apt install failed: {e}")
+        console.print(f"[yellow]In-process APT install failed ({e}); falling back to apt-get.[/yellow]")
+        return False
+    finally:
+        invalidate_path_cache() # Packages may have added executables
+
+def run_parallel(command_specs):
+    """
+    Runs independent commands concurrently. Each spec is a dict of run_command keyword
+    arguments (including 'command'); use show_output=False and print the results afterwards
+    so the outputs don't interleave. Returns the results in spec order (None for failures).
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(command_specs))) as executor:
+        return list(executor.map(lambda spec: run_command(**spec), command_specs))
+
+def show_network_status():
+    """Prints ZeroTier networks and interface addresses, querying both at once."""
+    results = run_parallel([
+        dict(command=['zerotier-cli', 'listnetworks'], description="Current ZeroTier Networks", show_output=False, check=False),
+        dict(command=['ip', '-brief', 'addr'], description="Current IP Addresses", show_output=False, check=False),
+    ])
+    for result in results:
+        if result and result.stdout:
+            console.print(Text(result.stdout.rstrip()))
+
+def collect_diagnostics(tag, units=()):
+    """
+    Failure-path helper: gathers block device and LVM state, plus the status and recent journal
+    of `units`, running the commands concurrently. Each output is printed and logged under `tag`.
+    """
+    specs = [
+        dict(command=['lsblk'], description="Current block devices"),
+        dict(command=['pvs'], description="LVM PV Status"),
+        dict(command=['vgs'], description="LVM VG Status"),
+        dict(command=['lvs'], description="LVM LV Status"),
+    ]
+    if units:
+        specs.append(dict(command=['systemctl', 'status', *units, '--no-pager'], description="Service status"))
+        specs.append(dict(command=['journalctl', '-n', '50', '--no-pager', *(arg for unit in units for arg in ('-u', unit))], description="Service logs"))
+    for spec in specs:
+        spec.update(show_output=False, check=False)
+    console.print(f"[cyan]Collecting diagnostics ({tag})...[/cyan]")
+    # Failed commands already print their output via run_command; show the successful ones here
+    for spec, result in zip(specs, run_parallel(specs)):
+        if result and result.stdout:
+            console.print(Text(f"--- {spec['description']} ---\n{result.stdout.rstrip()}"))
+            logger.info("Diagnostics [%s] %s:\n%s", tag, spec['description'], result.stdout.rstrip())
+
+def save_console_html_async(html_log):
+    """
+    Exports the recorded console output to an HTML file on a background thread,
+    so failure messages reach the user without waiting on the export.
+    The thread is non-daemon, so the interpreter finishes the export before exiting.
+    The tip pointing at the file is printed only once the save has succeeded.
+    Returns the started thread.
+    """
+    def _dump():
+        try:
+            console.save_html(html_log)
+            logger.info(f"Console output saved to {html_log}")
+            console.print(f"\n[yellow]Tip:[/yellow] Detailed console output saved to [dim]'{html_log}'[/dim] for review.")
+        except OSError as save_err:
+            # Advisory only; skip the logging chain since we're usually on the way out
+            sys.stderr.write(f"HTML log save failed: {save_err}\n")
+
+    dump_thread = threading.Thread(target=_dump, name="console-html-dump")
+    dump_thread.start()
+    return dump_thread
+
+def _dbus_unit_properties(units, properties):
+    """
+    Reads unit properties straight from PID 1 over D-Bus (pystemd), formatted the way
+    'systemctl show' prints them. Raises on any D-Bus/pystemd error so callers can fall back.
+    """
+    unit_props = {}
+    for unit in units:
+        # Like systemctl, a bare name means a .service unit
+        systemd_unit = SystemdUnit((unit if '.' in unit else f"{unit}.service").encode())
+        systemd_unit.load()
+        props = {}
+        for prop in properties:
+            value = getattr(systemd_unit.Unit, prop)
+            if isinstance(value, bool):
+                value = "yes" if value else "no"
+            props[prop] = value.decode() if isinstance(value, bytes) else str(value)
+        unit_props[unit] = props
+    return unit_props
+
+def get_unit_properties(units, properties=("ActiveState",)):
+    """
+    Queries systemd properties for several units: over D-Bus when pystemd is installed,
+    otherwise with a single 'systemctl show' call.
+    Returns a dict mapping each unit to a {property: value} dict, or {} on failure.
+    """
+    units = list(units)
+    if PYSTEMD_AVAILABLE:
+        try:
+            return _dbus_unit_properties(units, properties)
+        except Exception as e:
+            logger.debug(f"D-Bus unit query failed ({e}); falling back to 'systemctl show'.")
+    show_cmd = ['systemctl', 'show', '--no-pager'] + [f'--property={prop}' for prop in properties] + units
+    result = run_command(show_cmd, description=f"Querying {', '.join(properties)} for {len(units)} units", check=False)
+    if not result or result.stdout is None:
+        return {}
+    # systemctl separates the property blocks of each unit with a blank line, in argument order
+    blocks = result.stdout.strip('\n').split('\n\n')
+    if len(blocks) != len(units):
+        logger.warning(f"Unexpected 'systemctl show' output: {len(blocks)} blocks for {len(units)} units.")
+        return {}
+    unit_props = {}
+    for unit, block in zip(units, blocks):
+        unit_props[unit] = dict(line.split('=', 1) for line in block.splitlines() if '=' in line)
+    return unit_props
+
+def units_active(units):
+    """True if every unit in `units` is active; a D-Bus read with pystemd, else 'systemctl is-active'."""
+    units = list(units)
+    if PYSTEMD_AVAILABLE:
+        try:
+            return all(props['ActiveState'] == 'active' for props in _dbus_unit_properties(units, ("ActiveState",)).values())
+        except Exception as e:
+            logger.debug(f"D-Bus ActiveState query failed ({e}); falling back to 'systemctl is-active'.")
+    return probe_command(['systemctl', 'is-active', '--quiet', *units])
+
+def wait_units_active(units, timeout=5.0, interval=0.1):
+    """
+    Polls quietly until every unit in `units` is active or `timeout` seconds pass.
+    Returns {unit: is_active}; only a timeout costs an extra 'systemctl show', which reports
+    which units failed and their sub-states in one call.
+    """
+    units = list(units)
+    if wait_for(lambda: units_active(units), timeout=timeout, interval=interval):
+        return dict.fromkeys(units, True)
+    unit_props = get_unit_properties(units, ("ActiveState", "SubState"))
+    states = {unit: unit_props.get(unit, {}) for unit in units}
+    logger.warning("Units not all active after %ss: %s", timeout,
+                   ', '.join(f"{unit}={props.get('ActiveState', '?')}/{props.get('SubState', '?')}" for unit, props in states.items()))
+    return {unit: props.get('ActiveState') == 'active' for unit, props in states.items()}
+
+# Set when a step writes or changes unit files; flush_daemon_reload() turns any number of
+# requests into one 'systemctl daemon-reload' right before something needs the new units
+_pending_daemon_reload = False
+
+def request_daemon_reload():
+    """Marks systemd's view of the unit files as stale without reloading yet."""
+    global _pending_daemon_reload
+    _pending_daemon_reload = True
+
+def flush_daemon_reload():
+    """
+    Runs a single 'systemctl daemon-reload' if one was requested since the last flush.
+    Returns True if nothing was pending or the reload succeeded, False if it failed.
+    """
+    global _pending_daemon_reload
+    if not _pending_daemon_reload:
+        return True
+    if not run_command(['systemctl', 'daemon-reload'], description="Daemon reload", capture_output=False):
+        return False
+    _pending_daemon_reload = False
+    return True
+
+@functools.lru_cache(maxsize=64)
+def _pw(name):
+    """Cached pwd.getpwnam(); raises KeyError for unknown users (misses are not cached)."""
+    return pwd.getpwnam(name)
+
+@functools.lru_cache(maxsize=64)
+def _gr(name):
+    """Cached grp.getgrnam(); raises KeyError for unknown groups (misses are not cached)."""
+    return grp.getgrnam(name)
+
+@functools.lru_cache(maxsize=64)
+def _grgid(gid):
+    """Cached grp.getgrgid(); raises KeyError for unknown gids (misses are not cached)."""
+    return grp.getgrgid(gid)
+
+def clear_identity_cache():
+    """Drops the cached passwd/group entries; call after adding or changing users or groups."""
+    _pw.cache_clear()
+    _gr.cache_clear()
+    _grgid.cache_clear()
+    _user_env_template.cache_clear()
+
+def get_installed_packages():
+    """Returns the set of package names dpkg reports as installed (read from its status database)."""
+    installed = set()
+    package = None
+    try:
+        with open("/var/lib/dpkg/status", encoding="utf-8", errors="replace") as status_file:
+            for line in status_file:
+                if line.startswith("Package: "):
+                    package = line[9:].strip()
+                elif line.startswith("Status: ") and package and line.rstrip().endswith(" installed"):
+                    installed.add(package)
+    except OSError as e:
+        logger.warning(f"Could not read dpkg status database: {e}")
+    return installed
+
+def probe_command(argv, timeout=2.0):
+    """
+    Runs a short status command quietly (stdout discarded, stderr only reaches the debug log).
+    Returns True if it exits 0, False on non-zero exit, timeout or missing executable.
+    """
+    try:
+        return _stream_process(argv, timeout=timeout, capture_output=False).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+def wait_for(predicate, timeout=10.0, interval=0.1):
+    """
+    Polls `predicate()` until it returns truthy or `timeout` seconds pass.
+    Returns True as soon as the predicate succeeds, False on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if predicate():
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+
+def needs_change(kind, target, desired=None):
+    """
+    Cheap desired-state probe so re-runs can skip work that is already done.
+      'packages': target is an iterable of package names; returns the list not yet installed.
+      'service':  target is a unit; returns True unless it is both enabled and active.
+      'timezone': target is a zone name; returns True unless /etc/localtime already points at it.
+    """
+    if kind == 'packages':
+        installed = get_installed_packages()
+        return [pkg for pkg in target if pkg not in installed]
+    if kind == 'service':
+        props = get_unit_properties([target], ('UnitFileState', 'ActiveState')).get(target, {})
+        return not (props.get('UnitFileState') == 'enabled' and props.get('ActiveState') == 'active')
+    if kind == 'timezone':
+        try:
+            return not os.readlink("/etc/localtime").endswith(f"zoneinfo/{target}")
+        except OSError:
+            return True
+    raise ValueError(f"Unknown needs_change kind: {kind}")
+
+def _fd_has_line_prefix(fd, prefix):
+    """
+    Returns (found, ends_with_newline) for an open file: whether any line starts with the
+    bytes `prefix`, searched in a read-only mmap (no copy of the file), and whether the file
+    ends in a newline (True for an empty file).
+    """
+    size = os.fstat(fd).st_size
+    if not size:
+        return False, True # mmap cannot map an empty file
+    with mmap.mmap(fd, size, prot=mmap.PROT_READ) as mm:
+        found = mm[:len(prefix)] == prefix or mm.find(b"\n" + prefix) != -1
+        return found, mm[size - 1] == ord("\n")
+
+def _ensure_subid_entry(path, user, start, count):
+    """
+    Adds a 'user:start:count' line to a subuid/subgid file unless the user already has one.
+    Check and append share one O_APPEND descriptor held under flock, so concurrent runs
+    cannot both append. Returns True if the entry was added, False if it already existed.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        found, ends_with_newline = _fd_has_line_prefix(fd, f"{user}:".encode())
+        if found:
+            return False
+        entry = f"{user}:{start}:{count}\n".encode()
+        if not ends_with_newline:
+            entry = b"\n" + entry
+        os.write(fd, entry)
+        return True
+    finally:
+        os.close(fd) # Also releases the lock
+
+FICLONE = 0x40049409 # ioctl: share src's extents with dst (Btrfs/XFS reflink)
+
+def backup_file_copy(src, dst):
+    """
+    Copies src to dst for a backup, preserving metadata like shutil.copy2. Tries a reflink
+    clone first (a metadata-only copy on CoW filesystems), then an in-kernel
+    os.copy_file_range, and falls back to shutil.copy2 (itself sendfile-based on Linux).
+    Raises OSError on failure.
+    """
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        # Some filesystems/pseudo-files report 0; never keep a truncated backup
+                        raise OSError(f"copy_file_range stopped with {remaining} bytes left")
+                    remaining -= copied
+        shutil.copystat(src, dst)
+    except (OSError, AttributeError): # AttributeError: no os.copy_file_range on this platform
+        shutil.copy2(src, dst)
+
+def _make_user_dirs(paths, uid, gid):
+    """
+    Creates each path with its missing parents (mkdir -p) as root, chowning every directory it
+    creates to uid:gid; components that already exist are left as they are.
+    """
+    for path in map(Path, paths):
+        missing = []
+        while not path.exists():
+            missing.append(path)
+            path = path.parent
+        for directory in reversed(missing):
+            directory.mkdir(exist_ok=True)
+            os.chown(directory, uid, gid)
+
+def _ensure_private_dir(path, uid, gid, mode=0o700):
+    """
+    Ensures `path` is a directory owned by uid:gid with `mode` (e.g. ~/.ssh, ~/.vnc), using
+    direct syscalls as root and only changing what differs. Raises OSError on failure.
+    """
+    path = Path(path)
+    path.mkdir(mode=mode, exist_ok=True)
+    st = path.lstat()
+    if not stat.S_ISDIR(st.st_mode):
+        raise OSError(f"{path} exists but is not a directory")
+    if (st.st_uid, st.st_gid) != (uid, gid):
+        os.chown(path, uid, gid)
+    if stat.S_IMODE(st.st_mode) != mode:
+        os.chmod(path, mode)
+
+def _append_line(path, line, mode=0o644):
+    """
+    Appends `line` to `path` (creating it with `mode`) in a single O_APPEND write,
+    starting a new line first if the file lacks a trailing newline.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, mode)
+    try:
+        size = os.fstat(fd).st_size
+        data = (line + '\n').encode()
+        if size and os.pread(fd, 1, size - 1) != b'\n':
+            data = b'\n' + data
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    return True
+
 def check_group_exists(group_name):
     """Checks if a system group exists."""
     try:
-        grp.getgrnam(group_name)
+        _gr(group_name)
         logger.debug(f"Group '{group_name}' found.")
         return True
     except KeyError:
         logger.debug(f"Group '{group_name}' not found.")
         return False
 
+def user_groups(user_name):
+    """
+    Returns the set of group names the user belongs to (primary plus supplementary),
+    read straight from the group database like `groups` does. Raises KeyError for unknown users.
+    """
+    pw_info = _pw(user_name)
+    member_of = {g.gr_name for g in grp.getgrall() if user_name in g.gr_mem} # Not cached: membership changes
+    member_of.add(_grgid(pw_info.pw_gid).gr_name)
+    return member_of
+
 def check_user_exists(user_name):
     """Checks if a system user exists."""
     try:
-        pwd.getpwnam(user_name)
+        _pw(user_name)
         logger.debug(f"User '{user_name}' found.")
         return True
     except KeyError:
         logger.debug(f"User '{user_name}' not found.")
         return False
 
-def write_file(path, content, owner=None, group=None, permissions=None, show_content=True):
+# Content above this size is previewed as plain (truncated) text instead of highlighted
+SYNTAX_PREVIEW_MAX_CHARS = 2000
+
+# Preview language by file suffix, then by exact file name (dotfiles have no suffix)
+_LEXER_BY_SUFFIX = {
+    '.service': 'bash', '.mount': 'bash', '.timer': 'bash',
+    '.conf': 'ini', '.cfg': 'ini', '.ini': 'ini',
+    '.json': 'json', '.xml': 'xml', '.yaml': 'yaml', '.yml': 'yaml',
+}
+_LEXER_BY_NAME = {'xstartup': 'bash', '.profile': 'bash'}
+
+@functools.lru_cache(maxsize=16)
+def _get_lexer(lang):
+    """Returns a cached Pygments lexer instance for the given language name."""
+    from pygments.lexers import get_lexer_by_name # Pygments ships with rich
+    return get_lexer_by_name(lang)
+
+def write_file(path, content, owner=None, group=None, permissions=None, show_content=True, atomic=False):
     """
     Writes content to a file, creating parent directories if needed.
     Optionally sets owner, group, and permissions (as octal string like "0644").
+    With atomic=True the content goes to a hidden sibling temp file that is fdatasync'd and
+    renamed over the target, so readers (e.g. systemd) never see a half-written file.
     Returns True on success, False on failure.
     Assumes this function is run with sufficient privileges (e.g., root)
     to create files and change ownership/permissions.
@@ -564,97 +1334,135 @@ def write_file(path, content, owner=None, group=None, permissions=None, show_con
     console.log(f"Preparing file: [cyan]{path}[/cyan]")
 
     if show_content:
-        lang = "bash"
-        if any(s in str(path) for s in [".service", ".mount", ".timer", "xstartup", ".profile"]): lang = "bash"
-        elif str(path).endswith((".conf", ".cfg", ".ini")): lang = "ini"
-        elif str(path).endswith(".json"): lang = "json"
-        elif str(path).endswith(".xml"): lang = "xml"
-        elif str(path).endswith((".yaml", ".yml")): lang = "yaml"
-        else: lang = "text"
+        lang = _LEXER_BY_SUFFIX.get(path.suffix) or _LEXER_BY_NAME.get(path.name, "text")
+
+        if len(content) > SYNTAX_PREVIEW_MAX_CHARS:
+            # Skip tokenizing large files; a truncated plain preview is enough
+            preview = Text(content[:SYNTAX_PREVIEW_MAX_CHARS] + f"\n… ({len(content) - SYNTAX_PREVIEW_MAX_CHARS} more characters, see file)")
+            console.print(Panel(preview, title=f"Content for {path.name} (truncated)", border_style="dim"))
+        else:
+            syntax = Syntax(content, _get_lexer(lang), theme="default", line_numbers=True, word_wrap=False)
+            console.print(Panel(syntax, title=f"Content for {path.name}", border_style="dim"))
+
+    # Resolve mode and ownership up front so a bad value fails before anything is created
+    mode = None
+    if permissions:
+        try:
+            mode = int(permissions, 8)
+        except ValueError:
+            logger.error(f"Invalid permission format '{permissions}'. Should be octal string e.g., '0644'.")
+            console.print(f"[bold red]Error:[/bold red] Invalid permission format '{permissions}'.")
+            return False
 
-        syntax = Syntax(content, lang, theme="default", line_numbers=True, word_wrap=False)
-        console.print(Panel(syntax, title=f"Content for {path.name}", border_style="dim"))
+    uid = -1
+    gid = -1
+    owner_str = owner or '(current)'
+    group_str = group or '(current)'
+    try:
+        if owner:
+            uid = _pw(owner).pw_uid
+        if group:
+            gid = _gr(group).gr_gid
+    except KeyError as e:
+         logger.error(f"Owner '{owner}' or group '{group}' not found: {e}")
+         console.print(f"[bold red]Error:[/bold red] Owner '{owner}' or group '{group}' not found. Cannot set ownership.")
+         return False
 
+    write_path = path.with_name(f".{path.name}.tmp") if atomic else path
     try:
         path.parent.mkdir(parents=True, exist_ok=True)
         logger.debug(f"Ensured parent directory exists: {path.parent}")
-        path.write_text(content)
-        logger.info(f"Successfully wrote content to {path}")
-        console.log(f"[green]✓[/green] File written: [cyan]{path}[/cyan]")
-
-        # Set Permissions FIRST (before ownership potentially restricts root)
-        if permissions:
-            try:
-                octal_perm = int(permissions, 8)
-                os.chmod(path, octal_perm)
+        # Create with the final mode, then fchmod (defeats umask) and fchown on the same fd
+        fd = os.open(write_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, mode if mode is not None else 0o666)
+        try:
+            data = content.encode()
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            logger.info(f"Successfully wrote content to {path}")
+            console.log(f"[green]✓[/green] File written: [cyan]{path}[/cyan]")
+
+            # Set Permissions FIRST (before ownership potentially restricts root)
+            if mode is not None:
+                os.fchmod(fd, mode)
                 logger.info(f"Set permissions {permissions} for {path}")
                 console.log(f"  - Permissions set to [yellow]{permissions}[/yellow]")
-            except ValueError:
-                logger.error(f"Invalid permission format '{permissions}'. Should be octal string e.g., '0644'.")
-                console.print(f"[bold red]Error:[/bold red] Invalid permission format '{permissions}'.")
-                # Attempt to remove potentially wrongly permissioned file? Or just fail? Fail for safety.
-                try: path.unlink()
-                except OSError: pass
-                return False
-            except OSError as chmod_err:
-                 logger.error(f"Failed to set permissions {permissions} for {path}: {chmod_err}")
-                 console.print(f"[bold red]Error:[/bold red] Failed to set permissions {permissions} for {path}: {chmod_err}")
-                 try: path.unlink()
-                 except OSError: pass
-                 return False
-
 
-        # Set Ownership LAST
-        if owner or group:
-            uid = -1
-            gid = -1
-            owner_str = owner or '(current)'
-            group_str = group or '(current)'
+            # Set Ownership LAST
+            if uid != -1 or gid != -1:
+                os.fchown(fd, uid, gid)
+                logger.info(f"Set owner={owner_str}({uid}), group={group_str}({gid}) for {path}")
+                console.log(f"  - Ownership set to [yellow]{owner_str}:{group_str}[/yellow]")
 
-            try:
-                if owner:
-                    uid = pwd.getpwnam(owner).pw_uid
-                if group:
-                    gid = grp.getgrnam(group).gr_gid
-
-                if uid != -1 or gid != -1:
-                    os.chown(path, uid, gid)
-                    logger.info(f"Set owner={owner_str}({uid}), group={group_str}({gid}) for {path}")
-                    console.log(f"  - Ownership set to [yellow]{owner_str}:{group_str}[/yellow]")
-
-            except KeyError as e:
-                 logger.error(f"Owner '{owner}' or group '{group}' not found: {e}")
-                 console.print(f"[bold red]Error:[/bold red] Owner '{owner}' or group '{group}' not found. Cannot set ownership.")
-                 try: path.unlink()
-                 except OSError: pass
-                 return False
-            except Exception as chown_err:
-                logger.error(f"Failed to set ownership {owner}:{group} for {path}: {chown_err}")
-                console.print(f"[bold red]Error:[/bold red] Failed to set ownership for {path}: {chown_err}")
-                try: path.unlink()
-                except OSError: pass
-                return False
+            if atomic:
+                os.fdatasync(fd) # Data must be on disk before the rename makes it visible
+        finally:
+            os.close(fd)
+        if atomic:
+            os.replace(write_path, path)
 
         return True
 
     except Exception as e:
         logger.exception(f"Failed to write or configure file {path}")
         console.print(f"[bold red]Error:[/bold red] Failed writing/configuring file {path}: {e}")
-        # Attempt cleanup
-        try: path.unlink()
-        except OSError: pass
+        # Attempt cleanup (atomic writes leave the original untouched)
+        with contextlib.suppress(OSError):
+            write_path.unlink()
         return False
 
+def write_files(file_specs):
+    """
+    Writes a batch of small config files in a single pass.
+    Each spec is a dict of write_file() keyword arguments (path and content required).
+    Content panels are suppressed; one summary line is logged for the batch.
+    Parent directories of atomic writes are fsync'd once each after the batch.
+    Returns a dict mapping each path to its write_file() result.
+    """
+    results = {}
+    renamed_dirs = set()
+    for spec in file_specs:
+        spec = dict(spec)
+        spec.setdefault("show_content", False)
+        path = Path(spec["path"])
+        results[path] = write_file(**spec)
+        if results[path] and spec.get("atomic"):
+            renamed_dirs.add(path.parent)
+    # One fsync per directory makes all the renames in it durable, instead of one per file
+    for directory in renamed_dirs:
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError as e:
+            logger.warning(f"Could not fsync directory {directory}: {e}")
+    written = sum(1 for ok in results.values() if ok)
+    logger.info(f"Batch write finished: {written}/{len(results)} files written.")
+    console.log(f"Batch write: [green]{written}[/green]/{len(results)} files written")
+    return results
+
 # --- Installer Steps Definition ---
 installer_steps = []
 
-def installer_step(title):
-    """Decorator to register a function as an installer step."""
+def installer_step(title, depends_on=None):
+    """
+    Decorator to register a function as an installer step.
+    depends_on: optional list of step titles this step needs. Steps that declare it may run
+    concurrently with neighbouring steps whose dependencies are also met; steps without it
+    depend on every step before them (plain sequential order).
+    """
     def decorator(func):
         logger.debug(f"Registering installer step: {title}")
-        installer_steps.append({"title": title, "func": func})
+        installer_steps.append({"title": title, "func": func, "depends_on": depends_on})
         return func
     return decorator
+
+def step_is_ready(step_info, completed_titles):
+    """Returns True if a step declares dependencies and all of them have completed."""
+    depends_on = step_info.get("depends_on")
+    return depends_on is not None and set(depends_on) <= completed_titles
 # --- END Installer Steps Definition ---
 
 
@@ -694,6 +1502,7 @@ def step_prereqs(progress, task_id, args):
              groupadd_cmd.append(group_name)
 
              if run_command(groupadd_cmd, description=f"Creating group '{group_name}'"):
+                 clear_identity_cache() # Group database changed
                  console.print(f"[green]✓[/green] Group '{group_name}' created.")
                  logger.info(f"Successfully created group '{group_name}'.")
              else:
@@ -712,32 +1521,35 @@ def step_prereqs(progress, task_id, args):
 @installer_step("Install Dependencies")
 def step_install_deps(progress, task_id, args):
     """Updates apt, upgrades packages, installs required packages, and verifies key commands."""
-    console.print("[cyan]Updating package lists (apt-get update)...[/cyan]")
-    update_result = run_command(['apt-get', 'update', '-qq'], description="apt-get update", show_output=False)
-    if not update_result:
-        console.print("[bold yellow]Warning:[/bold yellow] 'apt-get update' failed. Check network and APT sources. Attempting to continue...")
-        logger.warning("'apt-get update' failed. Proceeding cautiously.")
-
-    console.print("[cyan]Upgrading existing packages (apt-get upgrade -y)...[/cyan]")
-    upgrade_env = os.environ.copy()
-    upgrade_env['DEBIAN_FRONTEND'] = 'noninteractive'
-    upgrade_result = run_command(['apt-get', 'upgrade', '-y'], description="apt-get upgrade", env=upgrade_env, show_output=False)
-    if not upgrade_result:
-        console.print("[bold yellow]Warning:[/bold yellow] 'apt-get upgrade' failed. System might not be fully up-to-date.")
-        logger.warning("'apt-get upgrade' failed. Proceeding.")
+    missing_packages = needs_change('packages', REQUIRED_PACKAGES)
+    apt_commands = [
+        (['apt-get', 'update', '-qq'], False),
+        (['apt-get', 'upgrade', '-y'], False),
+    ]
+    if missing_packages:
+        console.print(f"[cyan]Updating package lists, upgrading and installing {len(missing_packages)} missing packages...[/cyan]")
+        apt_commands.append((['apt-get', 'install', '-y'] + missing_packages, True))
     else:
-        console.print("[green]✓[/green] Package upgrade completed.")
-
-    console.print("[cyan]Installing required packages...[/cyan]")
-    install_env = os.environ.copy()
-    install_env['DEBIAN_FRONTEND'] = 'noninteractive'
-    install_result = run_command(['apt-get', 'install', '-y'] + REQUIRED_PACKAGES, description="apt-get install", env=install_env, show_output=False)
+        console.print("[cyan]All required packages already installed; updating and upgrading only...[/cyan]")
+        logger.info("All required packages already installed; skipping apt-get install.")
+    apt_result = apt_cache_install(missing_packages) if APT_PKG_AVAILABLE else False
+    if apt_result == APT_UNKNOWN_PACKAGES:
+        logger.error("Required packages missing from the APT sources; not retrying with apt-get.")
+        return False
+    if apt_result is True:
+        install_result = True # Resolved and installed in-process; no apt-get needed
+    else:
+        # update/upgrade failures are tolerated (warned on stderr); only the install is required
+        install_result = batch_apt(apt_commands, description="apt-get update + upgrade + install", show_output=False)
+        if install_result and install_result.stderr and "failed, continuing" in install_result.stderr:
+            console.print("[bold yellow]Warning:[/bold yellow] 'apt-get update' or 'apt-get upgrade' failed. System might not be fully up-to-date.")
+            logger.warning("'apt-get update'/'apt-get upgrade' reported a failure in the batched run. Proceeding.")
 
     if not install_result:
         console.print("[bold red]Error:[/bold red] Failed to install one or more required packages during initial attempt.")
         logger.error("Initial 'apt-get install' failed.")
         console.print("Attempting 'apt --fix-broken install' to resolve potential issues...")
-        fix_result = run_command(['apt-get', '--fix-broken', 'install', '-y'], description="apt --fix-broken install", env=install_env, show_output=False)
+        fix_result = run_command(['apt-get', '--fix-broken', 'install', '-y'], description="apt --fix-broken install", env=APT_NONINTERACTIVE_ENV, show_output=False)
 
         if not fix_result:
              console.print("[bold red]Error:[/bold red] 'apt --fix-broken install' also failed. Unable to resolve dependencies.")
@@ -745,7 +1557,8 @@ def step_install_deps(progress, task_id, args):
              return False
 
         console.print("Retrying package installation after fix attempt...")
-        install_result = run_command(['apt-get', 'install', '-y'] + REQUIRED_PACKAGES, description="apt-get install (retry)", env=install_env, show_output=False)
+        install_result = run_command(['apt-get', 'install', '-y', *REQUIRED_PACKAGES], description="apt-get install (retry)", env=APT_NONINTERACTIVE_ENV, show_output=False)
+        invalidate_path_cache()
 
         if not install_result:
              console.print("[bold red]Fatal Error:[/bold red] Failed to install required packages even after attempting fix. Check APT logs and configuration.")
@@ -761,7 +1574,7 @@ def step_install_deps(progress, task_id, args):
     missing_cmds = []
     for cmd in KEY_COMMANDS_TO_VALIDATE:
         logger.debug(f"Verifying command: {cmd}")
-        cmd_path = shutil.which(cmd)
+        cmd_path = find_executable(cmd)
         if cmd_path is None:
             console.print(f"[bold red]✗ Error:[/bold red] Command '{cmd}' not found in PATH after installation.")
             logger.error(f"Verification failed: Command '{cmd}' not found in PATH.")
@@ -782,7 +1595,7 @@ def step_install_deps(progress, task_id, args):
     return True
 
 
-@installer_step("Check/Create QCOW2 File")
+@installer_step("Check/Create QCOW2 File", depends_on=["Install Dependencies"])
 def step_create_qcow(progress, task_id, args): # Added args parameter
     """Checks for the QCOW2 file and creates it if missing and confirmed by user."""
     console.print(f"Verifying QCOW2 file existence: [cyan]{LOCAL_QCOW_PATH}[/cyan]")
@@ -812,7 +1625,8 @@ def step_create_qcow(progress, task_id, args): # Added args parameter
         return False
 
     console.print(f"Creating {DEFAULT_QCOW_SIZE} QCOW2 file (this might take a moment)...")
-    create_cmd = ['qemu-img', 'create', '-f', 'qcow2', str(LOCAL_QCOW_PATH), DEFAULT_QCOW_SIZE]
+    # No preallocation and 1M clusters: the image starts as a few metadata clusters instead of zero-filled space
+    create_cmd = ['qemu-img', 'create', '-f', 'qcow2', '-o', 'preallocation=off,cluster_size=1M', str(LOCAL_QCOW_PATH), DEFAULT_QCOW_SIZE]
     create_result = run_command(create_cmd, description=f"Creating {DEFAULT_QCOW_SIZE} QCOW2 file", show_output=True)
 
     if not create_result:
@@ -830,30 +1644,37 @@ def step_create_qcow(progress, task_id, args): # Added args parameter
              logger.critical("'disk' group missing during QCOW2 permission setting.")
              return False
 
-        disk_gid = grp.getgrnam("disk").gr_gid
+        disk_gid = _gr("disk").gr_gid
         os.chmod(LOCAL_QCOW_PATH, 0o660)
         os.chown(LOCAL_QCOW_PATH, 0, disk_gid)
         console.print("[green]✓[/green] Initial permissions set (root:disk, 660).")
         logger.info(f"Set initial permissions (660, root:disk) for {LOCAL_QCOW_PATH}")
-        run_command(['ls', '-lh', str(LOCAL_QCOW_PATH)], description="Verifying file and permissions", show_output=True)
+        st = os.stat(LOCAL_QCOW_PATH)
+        console.print(f"  [dim]{stat.filemode(st.st_mode)} {st.st_uid}:{st.st_gid} {format_size(st.st_size)} "
+                      f"({format_size(st.st_blocks * 512)} allocated) {LOCAL_QCOW_PATH}[/dim]")
 
     except Exception as e:
         logger.exception(f"Failed to set initial permissions/ownership for newly created {LOCAL_QCOW_PATH}")
         console.print(f"[bold red]Fatal Error:[/bold red] Failed to set initial permissions for {LOCAL_QCOW_PATH}: {e}")
         # Attempt cleanup of potentially unusable file
-        try: LOCAL_QCOW_PATH.unlink()
-        except OSError: pass
+        with contextlib.suppress(OSError):
+            LOCAL_QCOW_PATH.unlink()
         return False
 
     progress.update(task_id, advance=1)
     return True
 
 
-@installer_step("Set Timezone")
+@installer_step("Set Timezone", depends_on=["Prerequisite Checks"])
 def step_set_timezone(progress, task_id, args): # Added args
     """Sets the system timezone."""
     timezone = "America/Los_Angeles" # TODO: Consider making this configurable or auto-detect
     logger.info(f"Setting system timezone to {timezone}")
+    if not needs_change('timezone', timezone):
+        console.print(f"[green]✓[/green] Timezone already set to {timezone}.")
+        logger.info(f"Timezone already {timezone}; skipping timedatectl.")
+        progress.update(task_id, advance=1)
+        return True
     if run_command(['timedatectl', 'set-timezone', timezone], description=f"Setting timezone to {timezone}"):
         run_command(['date'], description="Current date/time after timezone change", show_output=True)
         progress.update(task_id, advance=1)
@@ -865,7 +1686,7 @@ def step_set_timezone(progress, task_id, args): # Added args
          return True # Continue installation
 
 
-@installer_step("Install/Configure ZeroTier")
+@installer_step("Install/Configure ZeroTier", depends_on=["Install Dependencies"])
 def step_zerotier(progress, task_id, args): # Added args
     """Installs ZeroTier if needed, enables the service, and joins the specified network."""
     logger.info("Starting ZeroTier setup.")
@@ -873,8 +1694,15 @@ def step_zerotier(progress, task_id, args): # Added args
     if not zt_check_result:
         console.print("ZeroTier not found. [cyan]Installing ZeroTier via official script...[/cyan]")
         logger.info("zerotier-cli not found. Installing...")
-        zt_install_cmd = "curl -s https://install.zerotier.com | bash"
-        install_result = run_command(zt_install_cmd, description="Downloading and running ZeroTier installer", shell=True, show_output=True)
+        zt_installer = download_to_tempfile("https://install.zerotier.com", suffix=".sh")
+        install_result = None
+        if zt_installer:
+            try:
+                with APT_LOCK: # The installer script drives apt-get itself
+                    install_result = run_command(['bash', str(zt_installer)], description="Running ZeroTier installer", show_output=True)
+            finally:
+                zt_installer.unlink(missing_ok=True)
+            invalidate_path_cache()
         if not install_result:
             console.print("[bold red]Error:[/bold red] ZeroTier installation script failed.")
             logger.error("ZeroTier installation script failed.")
@@ -886,10 +1714,10 @@ def step_zerotier(progress, task_id, args): # Added args
         logger.info(f"ZeroTier already installed at {zt_check_result}.")
 
     console.print("[cyan]Enabling and starting ZeroTier service (zerotier-one)...[/cyan]")
-    enable_start_result = run_command(['systemctl', 'enable', '--now', 'zerotier-one'], description="Enabling and starting ZeroTier service")
-    if not enable_start_result:
-        status_result = run_command(['systemctl', 'is-active', '--quiet', 'zerotier-one'], check=False, description="Checking ZT service status")
-        if not status_result or status_result.returncode != 0:
+    if not needs_change('service', 'zerotier-one'):
+        console.print("[green]✓[/green] ZeroTier service already enabled and active.")
+    elif not run_command(['systemctl', 'enable', '--now', 'zerotier-one'], description="Enabling and starting ZeroTier service"):
+        if not units_active(['zerotier-one']):
              console.print("[bold red]Error:[/bold red] Failed to enable or start ZeroTier service, and it's not active.")
              logger.error("Failed to enable/start zerotier-one and it's not active.")
              run_command(['journalctl', '-u', 'zerotier-one', '-n', '20', '--no-pager'], description="ZT service logs", show_output=True, check=False)
@@ -900,15 +1728,22 @@ def step_zerotier(progress, task_id, args): # Added args
     else:
         console.print("[green]✓[/green] ZeroTier service enabled and started.")
 
-    time.sleep(2) # Give service time to fully initialize
+    # Poll until the daemon answers instead of sleeping a fixed amount
+    if wait_for(lambda: probe_command(['zerotier-cli', 'info']), timeout=10.0):
+        logger.info("ZeroTier daemon is responding.")
+    else:
+        console.print("[yellow]Warning:[/yellow] ZeroTier daemon did not respond to 'zerotier-cli info' within 10s. Continuing.")
+        logger.warning("zerotier-cli info did not succeed within 10s.")
 
     console.print(f"[cyan]Checking ZeroTier network status for [yellow]{ZT_NETWORK_ID}[/yellow]...[/cyan]")
-    list_networks_result = run_command(['zerotier-cli', 'listnetworks'], description="Checking current networks", show_output=True)
-    network_joined = False
-    if list_networks_result and ZT_NETWORK_ID in list_networks_result.stdout:
+    # The daemon keeps a <network id>.conf per joined network; a stat avoids asking the CLI
+    network_joined = (ZT_NETWORKS_DIR / f"{ZT_NETWORK_ID}.conf").exists()
+    if not network_joined:
+        list_networks_result = run_command(['zerotier-cli', 'listnetworks'], description="Checking current networks", show_output=True)
+        network_joined = bool(list_networks_result and ZT_NETWORK_ID in list_networks_result.stdout)
+    if network_joined:
          console.print(f"Already joined network [cyan]{ZT_NETWORK_ID}[/cyan].")
          logger.info(f"Already joined ZeroTier network {ZT_NETWORK_ID}.")
-         network_joined = True
 
     if not network_joined:
          console.print(f"Joining ZeroTier Network [cyan]{ZT_NETWORK_ID}[/cyan]...")
@@ -923,10 +1758,10 @@ def step_zerotier(progress, task_id, args): # Added args
               logger.info(f"Join request sent for network {ZT_NETWORK_ID}.")
 
          console.print(f"[bold yellow]Action Required:[/bold yellow] Authorize this device in ZeroTier Central for network [yellow]{ZT_NETWORK_ID}[/yellow].")
-         time.sleep(3) # Pause to let user read
+         if not args.non_interactive:
+              time.sleep(3) # Pause to let user read (non-interactive runs may be in a concurrent wave)
 
-    run_command(['zerotier-cli', 'listnetworks'], description="Current ZeroTier Networks", show_output=True, check=False)
-    run_command(['ip', '-brief', 'addr'], description="Current IP Addresses", show_output=True, check=False)
+    show_network_status()
 
     logger.info("ZeroTier setup step finished.")
     progress.update(task_id, advance=1)
@@ -940,68 +1775,36 @@ def step_ssh_prep(progress, task_id, args): # Added args
     ssh_dir = Path(f"/home/{DEBIAN_USER}/.ssh")
     auth_keys_file = ssh_dir / "authorized_keys"
 
-    console.print(f"Ensuring SSH directory [cyan]{ssh_dir}[/cyan] exists for user [yellow]{DEBIAN_USER}[/yellow] with 700 permissions...")
-    # Create directory AS THE USER to ensure correct ownership from the start
-    mkdir_result = run_command(['mkdir', '-p', str(ssh_dir)], user=DEBIAN_USER, description="Creating .ssh directory")
-    if not mkdir_result:
-        logger.error(f"Failed to create directory {ssh_dir} as user {DEBIAN_USER}.")
-        # Check if dir exists but failed for other reason (e.g., perms)
-        if not ssh_dir.is_dir():
-             console.print(f"[bold red]Error:[/bold red] Could not create SSH directory {ssh_dir}")
-             return False
-        else:
-             console.print(f"[yellow]Warning:[/yellow] mkdir failed, but {ssh_dir} exists. Proceeding to check permissions.")
-
-
-    # Set permissions AS THE USER
-    chmod_dir_result = run_command(['chmod', '700', str(ssh_dir)], user=DEBIAN_USER, description="Setting .ssh directory permissions")
-    if not chmod_dir_result:
-        # Verify permissions manually if command failed
-        try:
-             current_mode = ssh_dir.stat().st_mode & 0o777
-             if current_mode == 0o700:
-                 console.print(f"[yellow]Warning:[/yellow] chmod command failed, but permissions on {ssh_dir} seem correct (700). Continuing.")
-                 logger.warning(f"chmod 700 on {ssh_dir} failed, but mode is already 700.")
-             else:
-                 console.print(f"[bold red]Error:[/bold red] Failed to set 700 permissions on {ssh_dir} (current: {oct(current_mode)}).")
-                 logger.error(f"Failed to set permissions on {ssh_dir} as user {DEBIAN_USER}. Current mode: {oct(current_mode)}.")
-                 return False
-        except Exception as stat_err:
-             console.print(f"[bold red]Error:[/bold red] Failed to set 700 permissions on {ssh_dir} and could not verify existing permissions: {stat_err}")
-             logger.error(f"Failed to set permissions on {ssh_dir} as user {DEBIAN_USER} and stat failed: {stat_err}.")
-             return False
-
-    console.print(f"Ensuring authorized_keys file [cyan]{auth_keys_file}[/cyan] exists with 600 permissions...")
-    # Touch file AS THE USER
-    touch_result = run_command(['touch', str(auth_keys_file)], user=DEBIAN_USER, description="Touching authorized_keys file")
-    if not touch_result:
-        # Check if file exists but failed for other reason
-        if not auth_keys_file.is_file():
-             console.print(f"[bold red]Error:[/bold red] Could not create authorized_keys file {auth_keys_file}")
-             logger.error(f"Failed to touch {auth_keys_file} as user {DEBIAN_USER}.")
-             return False
-        else:
-            console.print(f"[yellow]Warning:[/yellow] touch failed, but {auth_keys_file} exists. Proceeding to check permissions.")
-
-
-    # Set permissions AS THE USER
-    chmod_file_result = run_command(['chmod', '600', str(auth_keys_file)], user=DEBIAN_USER, description="Setting authorized_keys file permissions")
-    if not chmod_file_result:
-         # Verify permissions manually if command failed
-        try:
-             current_mode = auth_keys_file.stat().st_mode & 0o777
-             if current_mode == 0o600:
-                 console.print(f"[yellow]Warning:[/yellow] chmod command failed, but permissions on {auth_keys_file} seem correct (600). Continuing.")
-                 logger.warning(f"chmod 600 on {auth_keys_file} failed, but mode is already 600.")
-             else:
-                 console.print(f"[bold red]Error:[/bold red] Failed to set 600 permissions on {auth_keys_file} (current: {oct(current_mode)}).")
-                 logger.error(f"Failed to set permissions on {auth_keys_file} as user {DEBIAN_USER}. Current mode: {oct(current_mode)}.")
-                 return False
-        except Exception as stat_err:
-             console.print(f"[bold red]Error:[/bold red] Failed to set 600 permissions on {auth_keys_file} and could not verify existing permissions: {stat_err}")
-             logger.error(f"Failed to set permissions on {auth_keys_file} as user {DEBIAN_USER} and stat failed: {stat_err}.")
-             return False
+    console.print(f"Ensuring SSH directory [cyan]{ssh_dir}[/cyan] (700) and [cyan]{auth_keys_file}[/cyan] (600) exist for user [yellow]{DEBIAN_USER}[/yellow]...")
+    try:
+        pw_info = _pw(DEBIAN_USER)
+    except KeyError:
+        console.print(f"[bold red]Error:[/bold red] System user '{DEBIAN_USER}' not found.")
+        logger.error(f"User {DEBIAN_USER} not found during SSH directory preparation.")
+        return False
 
+    # Direct syscalls as root, then hand ownership to the user. Everything is applied through
+    # O_NOFOLLOW descriptors so a pre-existing symlink in the user's home is never followed.
+    try:
+        with contextlib.suppress(FileExistsError):
+            os.mkdir(ssh_dir, 0o700)
+        for path, flags, mode in ((ssh_dir, os.O_RDONLY | os.O_DIRECTORY, 0o700),
+                                  (auth_keys_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)):
+            fd = os.open(path, flags | os.O_NOFOLLOW | os.O_CLOEXEC, mode)
+            try:
+                # Only touch what differs (re-runs usually find both already correct)
+                st = os.fstat(fd)
+                if stat.S_IMODE(st.st_mode) != mode:
+                    os.fchmod(fd, mode)
+                if (st.st_uid, st.st_gid) != (pw_info.pw_uid, pw_info.pw_gid):
+                    os.fchown(fd, pw_info.pw_uid, pw_info.pw_gid)
+            finally:
+                os.close(fd)
+            logger.debug(f"Prepared {path} ({oct(mode)}, {DEBIAN_USER})")
+    except OSError as e:
+        console.print(f"[bold red]Error:[/bold red] Could not prepare {e.filename or ssh_dir}: {e.strerror or e}")
+        logger.error(f"Failed to prepare SSH directory for {DEBIAN_USER}: {e}")
+        return False
 
     console.print(f"[green]✓[/green] SSH directory and authorized_keys file prepared.")
     console.print(f"[bold yellow]Action Required:[/bold yellow] Add your public SSH key(s) to [cyan]{auth_keys_file}[/cyan]")
@@ -1018,24 +1821,35 @@ def step_groups_xorg(progress, task_id, args): # Added args
     console.print(f"Adding user [yellow]{DEBIAN_USER}[/yellow] to required groups: [cyan]{', '.join(groups_to_add)}[/cyan]...")
 
     # Ensure all groups actually exist before adding the user
-    missing_system_groups = []
-    for group_name in groups_to_add:
-        if not check_group_exists(group_name):
-            console.print(f"[bold red]Error:[/bold red] Required group '{group_name}' does not exist. Cannot add user.")
-            logger.error(f"Prerequisite group '{group_name}' missing.")
-            missing_system_groups.append(group_name)
+    missing_system_groups = [g for g in groups_to_add if not check_group_exists(g)]
     if missing_system_groups:
+        console.print(f"[bold red]Error:[/bold red] Required group(s) {', '.join(missing_system_groups)} do not exist. Cannot add user.")
+        logger.error(f"Prerequisite groups missing: {missing_system_groups}")
         # This should ideally not happen if prereq step ran correctly, but check defensively.
         return False
 
 
-    usermod_result = run_command(['usermod', '-aG', ','.join(groups_to_add), DEBIAN_USER], description="Adding user to groups", check=False) # Don't fail immediately if usermod returns non-zero
-
-    # Verify group membership after running usermod
-    groups_check_result = run_command(['groups', DEBIAN_USER], description="Checking final groups")
+    # Only run usermod for the groups the user isn't in yet (re-runs usually have none)
+    # One group-database scan up front; it is only repeated if usermod actually ran
+    try:
+        current_groups = user_groups(DEBIAN_USER)
+    except KeyError as e:
+        logger.warning(f"Group lookup failed for {DEBIAN_USER}: {e}")
+        current_groups = None
+    groups_needed = groups_to_add if current_groups is None else [g for g in groups_to_add if g not in current_groups]
+    if groups_needed:
+        run_command(['usermod', '-aG', ','.join(groups_needed), DEBIAN_USER], description="Adding user to groups", capture_output=False, check=False) # Don't fail immediately if usermod returns non-zero
+        clear_identity_cache()
+        # Verify group membership after running usermod (one re-read)
+        try:
+            current_groups = user_groups(DEBIAN_USER)
+        except KeyError as e:
+            logger.warning(f"Group lookup failed while verifying {DEBIAN_USER}'s groups: {e}")
+            current_groups = None
+    else:
+        logger.info(f"{DEBIAN_USER} already in all required groups; skipping usermod.")
     groups_successfully_added = True
-    if groups_check_result:
-        current_groups = set(groups_check_result.stdout.strip().split(':')[-1].strip().split())
+    if current_groups is not None:
         logger.debug(f"Current groups for {DEBIAN_USER} after usermod: {current_groups}")
         missing_groups = [g for g in groups_to_add if g not in current_groups]
         if not missing_groups:
@@ -1050,7 +1864,7 @@ def step_groups_xorg(progress, task_id, args): # Added args
             # Otherwise, just warn and continue
     else:
         console.print("[bold yellow]Warning:[/bold yellow] Could not verify user groups after 'usermod'. Check manually.")
-        logger.warning(f"Could not verify groups for {DEBIAN_USER} after usermod failed or command error.")
+        logger.warning(f"Could not verify groups for {DEBIAN_USER} after usermod.")
         # Let's not fail the whole install for verification failure, but log it.
 
     if not groups_successfully_added:
@@ -1063,25 +1877,24 @@ def step_groups_xorg(progress, task_id, args): # Added args
     console.print(f"Configuring Xorg session permissions in [cyan]{xwrapper_conf}[/cyan]...")
     logger.info(f"Configuring {xwrapper_conf} to ensure '{allowed_line}' is set.")
 
-    current_content_lines = []
-    if xwrapper_conf.is_file():
+    xwrapper_exists = xwrapper_conf.is_file()
+    if xwrapper_exists:
         try:
-            current_content_lines = xwrapper_conf.read_text().splitlines()
-            found = False
-            for line in current_content_lines:
-                if line.strip() == allowed_line:
-                    found = True
-                    needs_anybody_line = False
-                    logger.info(f"'{allowed_line}' already present in {xwrapper_conf}.")
-                    break
-                elif line.strip().startswith("allowed_users="):
-                     # If a different allowed_users line exists, we should warn or decide policy
-                     console.print(f"[yellow]Warning:[/yellow] Found existing but different '{line.strip()}' in {xwrapper_conf}. Keeping existing setting.")
-                     logger.warning(f"Found existing '{line.strip()}' in {xwrapper_conf}. Not adding '{allowed_line}'.")
-                     needs_anybody_line = False # Don't overwrite existing setting
-                     break
-            if found:
-                console.print(f"[green]✓[/green] Xwrapper config '{allowed_line}' already correctly set.")
+            # Stream the file and stop at the first allowed_users line
+            with open(xwrapper_conf) as f:
+                for line in f:
+                    stripped = line.strip()
+                    if stripped == allowed_line:
+                        needs_anybody_line = False
+                        logger.info(f"'{allowed_line}' already present in {xwrapper_conf}.")
+                        console.print(f"[green]✓[/green] Xwrapper config '{allowed_line}' already correctly set.")
+                        break
+                    elif stripped.startswith("allowed_users="):
+                         # If a different allowed_users line exists, we should warn or decide policy
+                         console.print(f"[yellow]Warning:[/yellow] Found existing but different '{stripped}' in {xwrapper_conf}. Keeping existing setting.")
+                         logger.warning(f"Found existing '{stripped}' in {xwrapper_conf}. Not adding '{allowed_line}'.")
+                         needs_anybody_line = False # Don't overwrite existing setting
+                         break
 
         except Exception as e:
             console.print(f"[bold red]Error:[/bold red] Failed reading existing {xwrapper_conf}: {e}")
@@ -1093,21 +1906,25 @@ def step_groups_xorg(progress, task_id, args): # Added args
 
     if needs_anybody_line:
         console.print(f"Adding/Ensuring line '[yellow]{allowed_line}[/yellow]' in {xwrapper_conf}...")
-        # Create new content or append to existing
-        new_content = "\n".join(current_content_lines)
-        if new_content and not new_content.endswith('\n'):
-            new_content += "\n"
-        new_content += f"{allowed_line}\n"
-
-        if not write_file(xwrapper_conf, new_content, permissions="0644", show_content=False): # Don't show full file content
+        if xwrapper_exists:
+            # Append the one line in place; no need to rebuild the rest of the file
+            try:
+                updated = _append_line(xwrapper_conf, allowed_line)
+            except OSError as e:
+                logger.error(f"Failed appending to {xwrapper_conf}: {e}")
+                updated = False
+        else:
+            updated = write_file(xwrapper_conf, f"{allowed_line}\n", permissions="0644", show_content=False, atomic=True)
+        if not updated:
             console.print(f"[bold red]Error:[/bold red] Failed to write updated {xwrapper_conf}.")
             logger.error(f"Failed writing updated {xwrapper_conf}")
             return False
         console.print(f"[green]✓[/green] {xwrapper_conf} updated.")
         logger.info(f"Successfully updated {xwrapper_conf} with '{allowed_line}'.")
-    elif xwrapper_conf.is_file(): # If line wasn't needed but file exists, ensure perms
+    elif xwrapper_exists: # If line wasn't needed but file exists, ensure perms
          try:
-              os.chmod(xwrapper_conf, 0o644)
+              if stat.S_IMODE(xwrapper_conf.stat().st_mode) != 0o644:
+                   os.chmod(xwrapper_conf, 0o644)
          except OSError as e:
               logger.warning(f"Could not ensure permissions on existing {xwrapper_conf}: {e}")
 
@@ -1123,7 +1940,7 @@ def step_rust_just(progress, task_id, args): # Added args
     logger.info(f"Starting Rust and 'just' installation for user {DEBIAN_USER}.")
     # Get user's home dynamically
     try:
-        user_info = pwd.getpwnam(DEBIAN_USER)
+        user_info = _pw(DEBIAN_USER)
         user_home = Path(user_info.pw_dir)
         cargo_path = user_home / ".cargo/bin"
         profile_path = user_home / ".profile"
@@ -1143,10 +1960,18 @@ def step_rust_just(progress, task_id, args): # Added args
     if not cargo_exists:
         console.print("Rust (cargo) not found. [cyan]Installing Rust via rustup for user...[/cyan]")
         logger.info(f"Rust not found for user {DEBIAN_USER}. Installing via rustup.")
-        # rustup-init.sh needs to be run as the target user
-        rustup_cmd = "curl --proto '=https' --tlsv1.2 -sSf https://sh.rustup.rs | sh -s -- -y --no-modify-path"
-        # Use bash -c within run_command to handle the pipe
-        rustup_install_result = run_command(['bash', '-c', rustup_cmd], user=DEBIAN_USER, description="Running rustup installer", show_output=True, timeout=600) # Increase timeout for potential downloads/builds
+        # Fetch rustup-init.sh ourselves (no curl | sh pipeline), then run it as the target user
+        rustup_script = download_to_tempfile("https://sh.rustup.rs", suffix=".sh")
+        if rustup_script is None:
+            console.print("[bold red]Error:[/bold red] Could not download the rustup installer.")
+            logger.error("Download of https://sh.rustup.rs failed.")
+            return False
+        try:
+            os.chown(rustup_script, user_info.pw_uid, user_info.pw_gid) # Readable by the user only
+            # Run through sh so a noexec /tmp doesn't matter
+            rustup_install_result = run_command(['sh', str(rustup_script), '-y', '--no-modify-path'], user=DEBIAN_USER, description="Running rustup installer", show_output=True, timeout=600) # Increase timeout for potential downloads/builds
+        finally:
+            rustup_script.unlink(missing_ok=True)
 
         if not rustup_install_result:
             console.print("[bold red]Error:[/bold red] Rust installation via rustup failed.")
@@ -1156,25 +1981,24 @@ def step_rust_just(progress, task_id, args): # Added args
         console.print(f"Adding Cargo bin directory to PATH in user's [cyan]{profile_path}[/cyan]...")
         logger.info(f"Attempting to add '{path_export_line}' to {profile_path} for user {DEBIAN_USER}.")
         try:
-            # Ensure .profile exists (as user)
-            if not run_command(['touch', str(profile_path)], user=DEBIAN_USER, description=f"Ensuring {profile_path} exists"):
-                logger.warning(f"Could not touch {profile_path} as user {DEBIAN_USER}.") # Continue anyway
-
-            # Check if line already exists (as user)
-            # Use grep -qFx for exact match, quoting carefully
-            grep_cmd = f"grep -qFx {shlex.quote(path_export_line)} {shlex.quote(str(profile_path))}"
-            path_exists_result = run_command(['bash', '-c', grep_cmd], user=DEBIAN_USER, check=False, description="Checking if PATH export exists in .profile")
-
-            if not path_exists_result or path_exists_result.returncode != 0: # 0 means found, 1 means not found, >1 is error
-                # Append the line (as user) using tee -a
-                # Quoting is tricky here, especially with the inner quotes for PATH
-                append_cmd = f"echo {shlex.quote(path_export_line)} >> {shlex.quote(str(profile_path))}"
-                append_result = run_command(['bash', '-c', append_cmd], user=DEBIAN_USER, description="Appending PATH to .profile")
-
-                if not append_result:
-                     console.print(f"[bold red]Error:[/bold red] Failed to append PATH export to {profile_path}.")
-                     logger.error(f"Failed to append PATH to {profile_path} for user {DEBIAN_USER}.")
-                     return False # Fail if we can't update PATH
+            # Check in-process; root can read the user's .profile directly
+            try:
+                profile_lines = profile_path.read_text().splitlines()
+            except FileNotFoundError:
+                profile_lines = []
+
+            if path_export_line not in profile_lines:
+                # Append as root (the user owns the home, so refuse to follow a planted symlink),
+                # then hand a newly created file to the user
+                if profile_path.is_symlink():
+                     console.print(f"[bold red]Error:[/bold red] {profile_path} is a symlink; not appending to it as root.")
+                     logger.error(f"Refusing to append to symlinked {profile_path} for user {DEBIAN_USER}.")
+                     return False
+                profile_existed = profile_path.exists()
+                _append_line(profile_path, path_export_line)
+                if not profile_existed:
+                    pw_info = _pw(DEBIAN_USER)
+                    os.chown(profile_path, pw_info.pw_uid, pw_info.pw_gid)
                 console.print("[green]✓[/green] Added PATH export to .profile.")
                 logger.info(f"Successfully added PATH export to {profile_path}.")
             else:
@@ -1229,8 +2053,7 @@ def step_zt_join_verify(progress, task_id, args): # Added args
      """Verifies ZeroTier network status and reminds user to authorize."""
      logger.info("Verifying ZeroTier network join status.")
      console.print("[cyan]Verifying ZeroTier network status again...[/cyan]")
-     run_command(['zerotier-cli', 'listnetworks'], description="Current ZeroTier Networks", show_output=True, check=False)
-     run_command(['ip', '-brief', 'addr'], description="Current IP Addresses", show_output=True, check=False)
+     show_network_status()
      console.print(f"[bold yellow]Reminder:[/bold yellow] Ensure this device is authorized on network [yellow]{ZT_NETWORK_ID}[/yellow] in your ZeroTier Central account (my.zerotier.com).")
      logger.info("ZeroTier verification step finished.")
      progress.update(task_id, advance=1)
@@ -1254,7 +2077,7 @@ def step_qcow_perms(progress, task_id, args): # Added args
              logger.critical("'disk' group missing during QCOW2 permission setting.")
              return False
 
-        disk_gid = grp.getgrnam("disk").gr_gid
+        disk_gid = _gr("disk").gr_gid
         target_mode = 0o660
         target_uid = 0 # root
         target_gid = disk_gid
@@ -1283,7 +2106,9 @@ def step_qcow_perms(progress, task_id, args): # Added args
 
         console.print("[green]✓[/green] QCOW2 Permissions verified/set.")
         if needs_chmod or needs_chown:
-             run_command(['ls', '-lh', str(LOCAL_QCOW_PATH)], description="Verifying final permissions", show_output=True)
+             # Final state is the stat we already have plus the changes just applied
+             final_mode = stat.S_IFMT(current_stat.st_mode) | target_mode
+             console.print(f"  [dim]{stat.filemode(final_mode)} {target_uid}:{target_gid} {format_size(current_stat.st_size)} {LOCAL_QCOW_PATH}[/dim]")
 
         logger.info(f"QCOW2 permission check/set finished for {LOCAL_QCOW_PATH}.")
         progress.update(task_id, advance=1)
@@ -1295,17 +2120,46 @@ def step_qcow_perms(progress, task_id, args): # Added args
         return False
 
 
-@installer_step("Define NBD Systemd Service")
-def step_nbd_service(progress, task_id, args): # Added args
-    """Creates the systemd service file for managing the QEMU NBD connection."""
-    logger.info("Defining systemd service for QEMU NBD.")
-    nbd_service_file = Path("/etc/systemd/system/qemu-nbd-connect.service")
-    console.print(f"Defining NBD systemd service: [cyan]{nbd_service_file}[/cyan]")
+# Readiness probe used by the NBD unit (second ExecStart): one process doing open/ioctl/pread
+# directly, instead of a bash loop forking lsblk and dd on every retry
+NBD_WAIT_SCRIPT_PATH = Path("/usr/local/sbin/nbd-wait")
+NBD_WAIT_SCRIPT = """#!/usr/bin/python3
+# Installed by Ultima-interactive.py: waits until an NBD device has a size and is readable.
+import fcntl, os, struct, sys, time
+
+BLKGETSIZE64 = 0x80081272
+
+def main(dev, tries=60, delay=0.5):
+    for _ in range(tries):
+        try:
+            fd = os.open(dev, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        except OSError:
+            print(f"Waiting for {dev}...", flush=True)
+        else:
+            try:
+                size = struct.unpack("Q", fcntl.ioctl(fd, BLKGETSIZE64, bytes(8)))[0]
+                if size > 0:
+                    os.pread(fd, 1024, 0)
+                    print(f"NBD Size OK ({size}), read OK.", flush=True)
+                    return 0
+                print("NBD Size is 0, waiting...", flush=True)
+            except OSError as e:
+                print(f"NBD not ready ({e}), retrying...", flush=True)
+            finally:
+                os.close(fd)
+        time.sleep(delay)
+    print(f"NBD device {dev} did not become ready (exist/size/read test failed)", flush=True)
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1]))
+"""
 
-    # Use Type=oneshot with RemainAfterExit=yes, include ExecStartPost check
-    # Ensure modprobe happens before trying to disconnect/connect
-    # Add retry/check loop in ExecStartPost for robustness
-    content = f"""[Unit]
+# Unit templates are filled with str.format_map; literal braces must be doubled.
+# Use Type=oneshot with RemainAfterExit=yes; the readiness check is a second ExecStart, so
+# 'systemctl start' returns exactly when the device is usable (or the check failed)
+# Ensure modprobe happens before trying to disconnect/connect
+NBD_UNIT_TMPL = """[Unit]
 Description=Set up QEMU NBD device {NBD_DEVICE} for {LOCAL_QCOW_PATH}
 Documentation=man:qemu-nbd(8)
 After=local-fs.target network-online.target systemd-modules-load.service
@@ -1315,22 +2169,41 @@ Before=lvm2-activation-early.service lvm2-activation.service lvm-activate-data-v
 [Service]
 Type=oneshot
 RemainAfterExit=yes
-# Load nbd module if not already loaded
-ExecStartPre=/sbin/modprobe nbd nbds_max=16
+# Load nbd module if not already loaded (skip modprobe's module/dependency resolution when it is)
+ExecStartPre=/bin/sh -c '[ -d /sys/module/nbd ] || exec /sbin/modprobe nbd nbds_max=16'
 # Attempt disconnect first in case it was left connected
 ExecStartPre=-/usr/bin/qemu-nbd --disconnect {NBD_DEVICE}
-# Connect the NBD device
+# Connect the NBD device (qemu-nbd returns once the kernel connection is set up)
 ExecStart=/usr/bin/qemu-nbd --connect={NBD_DEVICE} {LOCAL_QCOW_PATH}
-# Wait for the device to appear and be readable (basic check)
-ExecStartPost=/bin/bash -c 'tries=60; delay=0.5; while [ $tries -gt 0 ]; do if [ -b {NBD_DEVICE} ]; then size=$(/usr/bin/lsblk -bno SIZE {NBD_DEVICE} 2>/dev/null || echo 0); if [ "$size" -gt 0 ]; then echo "NBD Size OK ($size), testing read..."; if dd if={NBD_DEVICE} of=/dev/null bs=1k count=1 status=none; then echo "NBD Read OK."; exit 0; else echo "NBD Read FAILED ($?), retrying..."; sleep $delay; fi; else echo "NBD Size is 0, waiting..."; sleep $delay; fi; else echo "Waiting for {NBD_DEVICE}..."; sleep $delay; fi; tries=$((tries-1)); done; echo "NBD device {NBD_DEVICE} did not become ready (exist/size/read test failed)"; exit 1'
+# Then wait for the device to be readable (size via ioctl, then a 1k read); oneshot runs these in order
+ExecStart={NBD_WAIT_SCRIPT_PATH} {NBD_DEVICE}
 # Disconnect on service stop
 ExecStop=/usr/bin/qemu-nbd --disconnect {NBD_DEVICE}
 
 [Install]
 WantedBy=multi-user.target
 """
-    if write_file(nbd_service_file, content, permissions="0644"):
-        logger.info(f"Successfully wrote NBD systemd service file {nbd_service_file}.")
+
+
+@installer_step("Define NBD Systemd Service")
+def step_nbd_service(progress, task_id, args): # Added args
+    """Creates the systemd service file for managing the QEMU NBD connection."""
+    logger.info("Defining systemd service for QEMU NBD.")
+    nbd_service_file = Path("/etc/systemd/system/qemu-nbd-connect.service")
+    notice(f"Defining NBD systemd service: [cyan]{nbd_service_file}[/cyan]")
+
+    content = NBD_UNIT_TMPL.format_map({
+        'NBD_DEVICE': NBD_DEVICE,
+        'LOCAL_QCOW_PATH': LOCAL_QCOW_PATH,
+        'NBD_WAIT_SCRIPT_PATH': NBD_WAIT_SCRIPT_PATH,
+    })
+    results = write_files([
+        dict(path=NBD_WAIT_SCRIPT_PATH, content=NBD_WAIT_SCRIPT, permissions="0755", atomic=True),
+        dict(path=nbd_service_file, content=content, permissions="0644", atomic=True, show_content=True),
+    ])
+    if all(results.values()):
+        logger.info("Successfully wrote NBD systemd service file %s and %s.", nbd_service_file, NBD_WAIT_SCRIPT_PATH)
+        request_daemon_reload()
         progress.update(task_id, advance=1)
         return True
     else:
@@ -1338,15 +2211,8 @@ WantedBy=multi-user.target
          return False
 
 
-@installer_step("Define LVM Activation Systemd Service")
-def step_lvm_service(progress, task_id, args): # Added args
-    """Creates the systemd service file for activating the LVM Volume Group."""
-    logger.info(f"Defining systemd service for LVM activation ({VG_NAME}).")
-    lvm_service_file = Path("/etc/systemd/system/lvm-activate-data-vg.service")
-    console.print(f"Defining LVM activation systemd service: [cyan]{lvm_service_file}[/cyan]")
-
-    # Add checks and waits for NBD device and LV node
-    content = f"""[Unit]
+# Includes waits for the NBD device (via udev settle) and for the LV node (LV_WAIT_EXEC)
+LVM_UNIT_TMPL = """[Unit]
 Description=Activate LVM Volume Group '{VG_NAME}' on NBD device {NBD_DEVICE}
 Documentation=man:vgchange(8) man:lvchange(8)
 Requires=qemu-nbd-connect.service
@@ -1357,24 +2223,44 @@ Before=local-fs.target remote-fs.target mnt-data.mount # Ensure it runs before t
 Type=oneshot
 RemainAfterExit=yes
 Environment="PATH=/usr/sbin:/usr/bin:/sbin:/bin"
-# Wait briefly after NBD connect service reports success
-ExecStartPre=/bin/sleep 1
-# Settle udev rules
+# Settle udev rules (qemu-nbd-connect.service only succeeds once the device is readable)
 ExecStartPre=/usr/bin/udevadm settle --timeout=30
-# Verify NBD device readiness again before activating VG
-ExecStartPre=/bin/bash -c 'tries=30; delay=1; while [ $tries -gt 0 ]; do if [ -b {NBD_DEVICE} ]; then echo "NBD device {NBD_DEVICE} found. Testing read..."; if dd if={NBD_DEVICE} of=/dev/null bs=1k count=1 status=none; then echo "NBD Read OK."; exit 0; else echo "NBD Read FAILED ($?), retrying..."; sleep $delay; fi; fi; echo "Waiting for {NBD_DEVICE}..."; sleep $delay; tries=$((tries-1)); done; echo "NBD device {NBD_DEVICE} did not become ready/readable"; exit 1'
 # Activate the Volume Group
 ExecStart=/usr/sbin/lvm vgchange -ay {VG_NAME}
 # Wait for the Logical Volume device node to appear
-ExecStartPost=/bin/bash -c 'tries=30; delay=1; while ! [ -b {LV_DEVICE_PATH} ]; do echo "Waiting for LV {LV_DEVICE_PATH}..."; sleep $delay; tries=$((tries-1)); if [ "$tries" -le 0 ]; then echo "LV node {LV_DEVICE_PATH} did not appear"; exit 1; fi; done; echo "LV node {LV_DEVICE_PATH} appeared."'
+ExecStartPost={LV_WAIT_EXEC}
 # Deactivate on service stop
 ExecStop=/usr/sbin/lvm vgchange -an {VG_NAME}
 
 [Install]
 WantedBy=multi-user.target
 """
-    if write_file(lvm_service_file, content, permissions="0644"):
-        logger.info(f"Successfully wrote LVM activation systemd service file {lvm_service_file}.")
+
+
+@installer_step("Define LVM Activation Systemd Service")
+def step_lvm_service(progress, task_id, args): # Added args
+    """Creates the systemd service file for activating the LVM Volume Group."""
+    logger.info("Defining systemd service for LVM activation (%s).", VG_NAME)
+    lvm_service_file = Path("/etc/systemd/system/lvm-activate-data-vg.service")
+    notice(f"Defining LVM activation systemd service: [cyan]{lvm_service_file}[/cyan]")
+
+    # Wait for the LV node with 'udevadm wait' (systemd 248+, event driven) when available,
+    # falling back to the shell polling loop on older udev
+    if probe_command(['udevadm', 'wait', '--help']):
+        lv_wait_exec = f"/usr/bin/udevadm wait --timeout=30 {LV_DEVICE_PATH}"
+    else:
+        logger.info("'udevadm wait' not available; using a polling loop for the LV node in the unit.")
+        lv_wait_exec = f"""/bin/bash -c 'tries=30; delay=1; while ! [ -b {LV_DEVICE_PATH} ]; do echo "Waiting for LV {LV_DEVICE_PATH}..."; sleep $delay; tries=$((tries-1)); if [ "$tries" -le 0 ]; then echo "LV node {LV_DEVICE_PATH} did not appear"; exit 1; fi; done; echo "LV node {LV_DEVICE_PATH} appeared."'"""
+
+    content = LVM_UNIT_TMPL.format_map({
+        'VG_NAME': VG_NAME,
+        'NBD_DEVICE': NBD_DEVICE,
+        'LV_DEVICE_PATH': LV_DEVICE_PATH,
+        'LV_WAIT_EXEC': lv_wait_exec,
+    })
+    if write_file(lvm_service_file, content, permissions="0644", atomic=True):
+        logger.info("Successfully wrote LVM activation systemd service file %s.", lvm_service_file)
+        request_daemon_reload()
         progress.update(task_id, advance=1)
         return True
     else:
@@ -1382,129 +2268,153 @@ WantedBy=multi-user.target
          return False
 
 
+def _mark_lvm_setup_done():
+    """Records that the LV exists so later runs can skip the LVM checks. Failure is only logged."""
+    try:
+        LVM_SETUP_SENTINEL.parent.mkdir(parents=True, exist_ok=True)
+        LVM_SETUP_SENTINEL.write_text(f"{VG_NAME}/{LV_NAME} {current_timestamp}\n")
+        logger.info(f"Wrote LVM setup sentinel {LVM_SETUP_SENTINEL}.")
+    except OSError as e:
+        logger.warning(f"Could not write LVM setup sentinel {LVM_SETUP_SENTINEL}: {e}")
+
+
 @installer_step("Configure LVM (Create if Needed)")
 def step_lvm_setup(progress, task_id, args): # Added args
     """Checks if the LVM LV exists, performs first-time setup (PV, VG, LV, format) if not, using transient NBD."""
-    logger.info(f"Starting LVM configuration check/setup for {LV_DEVICE_PATH}.")
-    console.print(f"Checking if LVM logical volume [cyan]{LV_DEVICE_PATH}[/cyan] exists...")
+    logger.info("Starting LVM configuration check/setup for %s.", LV_DEVICE_PATH)
+    # Fast path on reruns: setup finished before and the LV is already active, so no lvs/vgchange is needed
+    if LVM_SETUP_SENTINEL.is_file() and LV_DEVICE_PATH.is_block_device():
+        notice(f"[green]✓[/green] LVM setup already completed ([dim]{LVM_SETUP_SENTINEL}[/dim]). Skipping.")
+        logger.info("Sentinel %s present and %s active; skipping LVM checks.", LVM_SETUP_SENTINEL, LV_DEVICE_PATH)
+        progress.update(task_id, advance=1)
+        return True
+    notice(f"Checking if LVM logical volume [cyan]{LV_DEVICE_PATH}[/cyan] exists...")
 
-    # Check using lvs command first, as device node might not exist even if LV is defined but inactive
-    lvs_check_cmd = ['lvs', '--noheadings', '-o', 'lv_path', f'{VG_NAME}/{LV_NAME}']
+    # Check using lvs command first, as device node might not exist even if LV is defined but inactive.
+    # One JSON report gives both existence and activation state.
+    lvs_check_cmd = ['lvs', '--reportformat=json', '-o', 'lv_path,lv_active', f'{VG_NAME}/{LV_NAME}']
     lvs_result = run_command(lvs_check_cmd, description="Checking if LV exists via lvs", check=False, capture_output=True)
-
-    # If lvs succeeds and output matches the expected path (or just succeeds meaning LV exists)
-    if lvs_result and lvs_result.returncode == 0 and str(LV_DEVICE_PATH) in lvs_result.stdout:
-        console.print("[green]✓[/green] LVM LV already exists (according to lvs). Skipping creation.")
-        logger.info(f"LVM LV {LV_DEVICE_PATH} already exists based on lvs output.")
-        # Ensure VG is active for subsequent steps (like fstab mount testing)
-        run_command(['lvm', 'vgchange', '-ay', VG_NAME], description="Ensuring VG is active", check=False)
+    lv_report = None
+    if lvs_result:
+        try:
+            lv_report = next((lv for lv in json.loads(lvs_result.stdout)['report'][0]['lv']
+                              if lv.get('lv_path') == str(LV_DEVICE_PATH)), None)
+        except (ValueError, KeyError, IndexError) as e:
+            logger.warning(f"Could not parse lvs JSON report: {e}")
+
+    if lv_report is not None:
+        notice("[green]✓[/green] LVM LV already exists (according to lvs). Skipping creation.")
+        logger.info(f"LVM LV {LV_DEVICE_PATH} already exists based on lvs output (lv_active={lv_report.get('lv_active')!r}).")
+        # Ensure VG is active for subsequent steps (like fstab mount testing); lv_active is empty when inactive
+        if not lv_report.get('lv_active'):
+            run_command(['lvm', 'vgchange', '-ay', VG_NAME], description="Ensuring VG is active", capture_output=False, check=False)
+        _mark_lvm_setup_done()
         progress.update(task_id, advance=1)
         return True
     elif LV_DEVICE_PATH.is_block_device():
          # Fallback check if lvs failed but device exists somehow
         console.print("[yellow]Warning:[/yellow] lvs check failed, but block device exists. Assuming LVM is set up.")
         logger.warning(f"LVM LV check via lvs failed, but {LV_DEVICE_PATH} exists. Assuming setup is complete.")
-        run_command(['lvm', 'vgchange', '-ay', VG_NAME], description="Ensuring VG is active", check=False)
+        run_command(['lvm', 'vgchange', '-ay', VG_NAME], description="Ensuring VG is active", capture_output=False, check=False)
         progress.update(task_id, advance=1)
         return True
 
 
-    console.print("LVM LV not found. [cyan]Performing one-time LVM setup...[/cyan]")
-    logger.info(f"LVM LV {LV_DEVICE_PATH} not found. Starting LVM creation process.")
+    notice("LVM LV not found. [cyan]Performing one-time LVM setup...[/cyan]")
+    logger.info("LVM LV %s not found. Starting LVM creation process.", LV_DEVICE_PATH)
 
-    console.print("Reloading systemd daemon (to ensure NBD service unit is known)...")
-    if not run_command(['systemctl', 'daemon-reload'], description="Daemon reload"):
+    # Pick up the unit files written by the previous steps (no-op if nothing changed)
+    if not flush_daemon_reload():
         logger.error("daemon-reload failed before transient NBD start.")
         # Non-fatal, service file might still be loadable
         console.print("[yellow]Warning:[/yellow] daemon-reload failed. Attempting to start NBD anyway.")
 
-    console.print(f"Starting NBD connection temporarily ([green]qemu-nbd-connect.service[/green])...")
-    # Start the service. Its ExecStartPost should handle waiting/checking.
-    # Add a timeout to the start command itself in case the ExecStartPost script hangs badly
+    notice(f"Starting NBD connection temporarily ([green]qemu-nbd-connect.service[/green])...")
+    # Start the service. Its second ExecStart (nbd-wait) handles waiting/checking.
+    # Add a timeout to the start command itself in case the readiness script hangs badly
     start_nbd_result = run_command(['systemctl', 'start', 'qemu-nbd-connect.service'],
                                    description="Starting NBD service transiently (blocks until ready/failed)",
+                                   capture_output=False,
                                    timeout=90) # 90 seconds timeout for start + readiness check
 
     if not start_nbd_result:
          console.print(f"[bold red]Error:[/bold red] Failed to start NBD service transiently or its readiness check failed.")
-         logger.error("systemctl start qemu-nbd-connect.service failed (likely ExecStartPost check or timeout).")
-         run_command(['journalctl', '-u', 'qemu-nbd-connect.service', '-n', '50', '--no-pager'], description="NBD service logs", show_output=True, check=False)
+         logger.error("systemctl start qemu-nbd-connect.service failed (likely readiness check or timeout).")
+         collect_diagnostics('lvm-setup', units=['qemu-nbd-connect.service'])
          # Try to stop it just in case it's stuck partially
-         run_command(['systemctl', 'stop', 'qemu-nbd-connect.service'], description="Attempting NBD service stop", check=False)
+         run_command(['systemctl', 'stop', 'qemu-nbd-connect.service'], description="Attempting NBD service stop", capture_output=False, check=False)
          return False
     logger.info("Transient NBD service started successfully (includes readiness check).")
-    # Add a small extra delay just in case device nodes need more time in userspace
-    time.sleep(1)
+    # Let udev finish with the device node (returns at once if it is already there)
+    run_command(['udevadm', 'settle', f'--exit-if-exists={NBD_DEVICE}', '--timeout=10'],
+                description="Waiting for NBD device node", capture_output=False, check=False)
 
     # Double-check the device node exists *after* the start command succeeded
     if not Path(NBD_DEVICE).is_block_device():
         console.print(f"[bold red]Error:[/bold red] NBD device [cyan]{NBD_DEVICE}[/cyan] not found after service start reported success.")
         logger.error(f"NBD device {NBD_DEVICE} missing after successful service start report.")
-        run_command(['lsblk'], description="Current block devices", show_output=True, check=False)
-        run_command(['systemctl', 'stop', 'qemu-nbd-connect.service'], description="Attempting NBD service stop", check=False)
+        collect_diagnostics('lvm-setup', units=['qemu-nbd-connect.service'])
+        run_command(['systemctl', 'stop', 'qemu-nbd-connect.service'], description="Attempting NBD service stop", capture_output=False, check=False)
         return False
-    console.print(f"[green]✓[/green] NBD device {NBD_DEVICE} seems ready.")
-    logger.info(f"NBD device {NBD_DEVICE} check passed after transient start.")
+    notice(f"[green]✓[/green] NBD device {NBD_DEVICE} seems ready.")
+    logger.info("NBD device %s check passed after transient start.", NBD_DEVICE)
 
     # --- LVM Creation Steps ---
     lvm_success = True
     try:
-        logger.info(f"Running pvcreate -vvv -ff -y {NBD_DEVICE}")
-        if not run_command(['pvcreate', '-vvv', '-ff', '-y', NBD_DEVICE], description="Creating LVM PV (verbose, double-forced, non-interactive)", show_output=True, timeout=60):
-            raise RuntimeError("pvcreate failed")
-
-        logger.info(f"Running vgcreate -y {VG_NAME} {NBD_DEVICE}")
-        if not run_command(['vgcreate', '-y', VG_NAME, NBD_DEVICE], description="Creating LVM VG (non-interactive)", timeout=30):
-             raise RuntimeError("vgcreate failed")
-
-        logger.info(f"Running lvcreate -y -l 100%FREE -n {LV_NAME} {VG_NAME}")
-        if not run_command(['lvcreate', '-y', '-l', '100%FREE', '-n', LV_NAME, VG_NAME], description="Creating LVM LV (non-interactive)", timeout=30):
-             raise RuntimeError("lvcreate failed")
-
-        # Wait for the LV device node to appear
-        logger.info(f"Waiting for LV device node {LV_DEVICE_PATH} to appear...")
-        node_appeared = False
-        for attempt in range(15): # Increase attempts slightly
-             if LV_DEVICE_PATH.is_block_device():
-                 node_appeared = True
-                 logger.info(f"LV device node {LV_DEVICE_PATH} appeared after {attempt+1}s.")
-                 break
-             console.log(f"Waiting for {LV_DEVICE_PATH}... ({attempt+1}/15)")
-             time.sleep(1)
-        if not node_appeared:
-            run_command(['lsblk'], description="Current block devices", show_output=True, check=False)
+        # PV, VG and LV creation in one shell; '&&' stops at the first failure, and the
+        # except branch below collects lsblk/pvs/vgs/lvs to show how far it got
+        lvm_create_script = ' && '.join([
+            f"pvcreate -ff -y {shlex.quote(NBD_DEVICE)}",
+            f"vgcreate -y {shlex.quote(VG_NAME)} {shlex.quote(NBD_DEVICE)}",
+            f"lvcreate -y -l 100%FREE -n {shlex.quote(LV_NAME)} {shlex.quote(VG_NAME)}",
+        ])
+        logger.info("Running: %s", lvm_create_script)
+        if not run_command(['sh', '-c', lvm_create_script], description="Creating LVM PV, VG and LV (non-interactive)", show_output=True, timeout=120):
+            raise RuntimeError("pvcreate/vgcreate/lvcreate failed")
+
+        # Wait for the LV device node to appear: udev returns as soon as it exists. The wait is
+        # shown once on the step's progress line rather than printed to the console.
+        logger.info("Waiting for LV device node %s to appear...", LV_DEVICE_PATH)
+        step_description = progress.tasks[task_id].description
+        progress.update(task_id, description=f"{step_description} [dim](waiting for {LV_DEVICE_PATH})[/dim]")
+        run_command(['udevadm', 'settle', f'--exit-if-exists={LV_DEVICE_PATH}', '--timeout=15'],
+                    description="Waiting for LV device node", capture_output=False, check=False)
+        progress.update(task_id, description=step_description)
+        if not LV_DEVICE_PATH.is_block_device():
             raise RuntimeError(f"LV device node {LV_DEVICE_PATH} did not appear after creation.")
-        else:
-            # Settle udev again after LV creation
-             run_command(['udevadm', 'settle'], description="Settling udev after LV creation", check=False)
-             time.sleep(1) # Small extra delay
+        logger.info("LV device node %s appeared.", LV_DEVICE_PATH)
 
-        # Format the LV
-        logger.info(f"Formatting {LV_DEVICE_PATH} with ext4...")
-        if not run_command(['mkfs.ext4', '-F', str(LV_DEVICE_PATH)], description="Formatting LV with ext4", timeout=300): # Allow time for large FS format
+        # Format the LV. Inode tables and the journal are zeroed lazily by the kernel (ext4lazyinit)
+        # after the first mount instead of up front, and no blocks are reserved for root on a data volume.
+        logger.info("Formatting %s with ext4 (lazy inode table/journal init; background zeroing continues after first mount)...", LV_DEVICE_PATH)
+        mkfs_cmd = ['mkfs.ext4', '-F', '-E', 'lazy_itable_init=1,lazy_journal_init=1', '-m', '0', str(LV_DEVICE_PATH)]
+        if not run_command(mkfs_cmd, description="Formatting LV with ext4", capture_output=False, timeout=120): # Lazy init only writes metadata
              raise RuntimeError("mkfs.ext4 failed")
 
     except Exception as lvm_err:
          console.print(f"[bold red]Error during LVM setup:[/bold red] {lvm_err}")
          logger.exception("Error during LVM PV/VG/LV/mkfs steps.")
          lvm_success = False
-         # Show LVM status on failure
-         run_command(['pvs'], description="LVM PV Status", show_output=True, check=False)
-         run_command(['vgs'], description="LVM VG Status", show_output=True, check=False)
-         run_command(['lvs'], description="LVM LV Status", show_output=True, check=False)
+         # Show block device and LVM status on failure
+         collect_diagnostics('lvm-setup')
 
 
     # --- Cleanup Transient NBD ---
-    console.print("Stopping temporary NBD service used for LVM setup...")
+    notice("Stopping temporary NBD service used for LVM setup...")
     logger.info("Stopping transient NBD service used for LVM creation.")
     # Don't check result, just try to stop it
-    run_command(['systemctl', 'stop', 'qemu-nbd-connect.service'], description="Stopping transient NBD service", check=False)
-    time.sleep(2) # Give time for disconnect
+    run_command(['systemctl', 'stop', 'qemu-nbd-connect.service'], description="Stopping transient NBD service", capture_output=False, check=False)
+    # The node itself persists after disconnect; the sysfs pid attribute only exists while connected
+    nbd_pid_attr = Path("/sys/block") / Path(NBD_DEVICE).name / "pid"
+    if not wait_for(lambda: not nbd_pid_attr.exists(), timeout=2.0, interval=0.05):
+        logger.warning(f"{NBD_DEVICE} still connected 2s after stopping the transient NBD service.")
 
     # --- Final Result ---
     if lvm_success:
-        console.print("[green]✓[/green] LVM setup (PV, VG, LV, Format) successful.")
+        notice("[green]✓[/green] LVM setup (PV, VG, LV, Format) successful.")
         logger.info("LVM one-time setup completed successfully.")
+        _mark_lvm_setup_done()
         progress.update(task_id, advance=1)
         return True
     else:
@@ -1514,26 +2424,29 @@ def step_lvm_setup(progress, task_id, args): # Added args
         return False
 
 
+# First two fields (device, mountpoint) of every non-comment fstab line
+FSTAB_RE = re.compile(rb'^[ \t]*([^#\s]\S*)[ \t]+(\S+)', re.M)
+
 @installer_step("Configure Mount Point & fstab")
 def step_fstab(progress, task_id, args): # Added args
     """Creates the mount point, sets ownership, adds fstab entry."""
-    logger.info(f"Starting mount point and fstab configuration for {LVM_MOUNT_POINT}.")
+    logger.info("Starting mount point and fstab configuration for %s.", LVM_MOUNT_POINT)
     console.print(f"Ensuring mount point [cyan]{LVM_MOUNT_POINT}[/cyan] exists with correct ownership ([yellow]{DEBIAN_USER}:{DEBIAN_GROUP}[/yellow])...")
 
     try:
         # Create directory if it doesn't exist
         LVM_MOUNT_POINT.mkdir(parents=True, exist_ok=True)
-        logger.debug(f"Ensured directory {LVM_MOUNT_POINT} exists.")
+        logger.debug("Ensured directory %s exists.", LVM_MOUNT_POINT)
 
         # Get UID/GID for ownership
-        user_info = pwd.getpwnam(DEBIAN_USER)
-        group_info = grp.getgrnam(DEBIAN_GROUP)
+        user_info = _pw(DEBIAN_USER)
+        group_info = _gr(DEBIAN_GROUP)
         target_uid = user_info.pw_uid
         target_gid = group_info.gr_gid
 
         # Set ownership
         os.chown(LVM_MOUNT_POINT, target_uid, target_gid)
-        logger.info(f"Set ownership of {LVM_MOUNT_POINT} to {target_uid}:{target_gid} ({DEBIAN_USER}:{DEBIAN_GROUP}).")
+        logger.info("Set ownership of %s to %s:%s (%s:%s).", LVM_MOUNT_POINT, target_uid, target_gid, DEBIAN_USER, DEBIAN_GROUP)
         console.print(f"  - Ownership set to [yellow]{DEBIAN_USER}:{DEBIAN_GROUP}[/yellow].")
         # Optionally set permissions (e.g., 775) if needed, but default might be fine
         # os.chmod(LVM_MOUNT_POINT, 0o775)
@@ -1553,8 +2466,8 @@ def step_fstab(progress, task_id, args): # Added args
     # Added nofail so system boots even if the mount fails
     fstab_entry_line = f"{LV_DEVICE_PATH}    {LVM_MOUNT_POINT}    ext4    defaults,nofail,_netdev    0    2"
     fstab_comment_line = f"# Entry added by AVF installer for LVM data volume ({VG_NAME}/{LV_NAME})"
-    console.print(f"Checking fstab entry for [cyan]{LVM_MOUNT_POINT}[/cyan] in [cyan]{fstab_file}[/cyan]...")
-    logger.info(f"Checking {fstab_file} for entry mounting {LV_DEVICE_PATH} at {LVM_MOUNT_POINT}")
+    notice(f"Checking fstab entry for [cyan]{LVM_MOUNT_POINT}[/cyan] in [cyan]{fstab_file}[/cyan]...")
+    logger.info("Checking %s for entry mounting %s at %s", fstab_file, LV_DEVICE_PATH, LVM_MOUNT_POINT)
 
     try:
         if not fstab_file.is_file():
@@ -1562,72 +2475,70 @@ def step_fstab(progress, task_id, args): # Added args
              logger.error(f"fstab file {fstab_file} not found.")
              return False
 
-        content = fstab_file.read_text()
-        entry_exists = False
+        content = fstab_file.read_bytes()
+        # Map both directions once; the checks below are then plain lookups
+        lv_bytes = os.fsencode(LV_DEVICE_PATH)
+        mp_bytes = os.fsencode(LVM_MOUNT_POINT)
+        source_by_target = {}
+        target_by_source = {}
+        for match in FSTAB_RE.finditer(content):
+            fstab_device, fstab_mountpoint = match.groups()
+            source_by_target.setdefault(fstab_mountpoint, fstab_device)
+            target_by_source.setdefault(fstab_device, fstab_mountpoint)
+
+        entry_exists = source_by_target.get(mp_bytes) == lv_bytes
         conflict_exists = False
-        for line in content.splitlines():
-            clean_line = line.strip()
-            if not clean_line or clean_line.startswith('#'): continue
-            parts = clean_line.split()
-            if len(parts) >= 2:
-                fstab_device = parts[0]
-                fstab_mountpoint = parts[1]
-                # Check if our exact device and mountpoint match
-                if fstab_device == str(LV_DEVICE_PATH) and fstab_mountpoint == str(LVM_MOUNT_POINT):
-                    entry_exists = True
-                    logger.info(f"Found existing fstab entry matching device and mountpoint: {clean_line}")
-                    break
-                # Check if our mountpoint is used by a *different* device
-                elif fstab_mountpoint == str(LVM_MOUNT_POINT) and fstab_device != str(LV_DEVICE_PATH):
-                    console.print(f"[bold yellow]Warning:[/bold yellow] Mount point {LVM_MOUNT_POINT} found in fstab but configured for a different device ({fstab_device})! Check {fstab_file}.")
-                    logger.warning(f"fstab conflict: {LVM_MOUNT_POINT} used by different device {fstab_device}.")
-                    conflict_exists = True
-                    break
-                # Check if our device is mounted *elsewhere*
-                elif fstab_device == str(LV_DEVICE_PATH) and fstab_mountpoint != str(LVM_MOUNT_POINT):
-                    console.print(f"[bold yellow]Warning:[/bold yellow] Device {LV_DEVICE_PATH} found in fstab but mounted elsewhere ({fstab_mountpoint})! Check {fstab_file}.")
-                    logger.warning(f"fstab conflict: {LV_DEVICE_PATH} mounted elsewhere at {fstab_mountpoint}.")
-                    conflict_exists = True
-                    break
+        if entry_exists:
+            logger.info("Found existing fstab entry matching device and mountpoint: %s %s", LV_DEVICE_PATH, LVM_MOUNT_POINT)
+        elif mp_bytes in source_by_target:
+            # Our mountpoint is used by a *different* device
+            fstab_device = os.fsdecode(source_by_target[mp_bytes])
+            console.print(f"[bold yellow]Warning:[/bold yellow] Mount point {LVM_MOUNT_POINT} found in fstab but configured for a different device ({fstab_device})! Check {fstab_file}.")
+            logger.warning(f"fstab conflict: {LVM_MOUNT_POINT} used by different device {fstab_device}.")
+            conflict_exists = True
+        elif lv_bytes in target_by_source:
+            # Our device is mounted *elsewhere*
+            fstab_mountpoint = os.fsdecode(target_by_source[lv_bytes])
+            console.print(f"[bold yellow]Warning:[/bold yellow] Device {LV_DEVICE_PATH} found in fstab but mounted elsewhere ({fstab_mountpoint})! Check {fstab_file}.")
+            logger.warning(f"fstab conflict: {LV_DEVICE_PATH} mounted elsewhere at {fstab_mountpoint}.")
+            conflict_exists = True
 
         if conflict_exists:
             console.print("[bold red]Error:[/bold red] fstab conflict detected. Please resolve manually before proceeding.")
             return False # Fail if there's a conflict
 
         if not entry_exists:
-            console.print("Adding fstab entry...")
-            logger.info(f"Adding fstab entry: {fstab_entry_line}")
-            # Ensure newline before adding comment/entry
-            if content and not content.endswith('\n'):
-                content += "\n"
-            new_content = content + f"\n{fstab_comment_line}\n{fstab_entry_line}\n"
-            # Write back - consider making a backup first
+            notice("Adding fstab entry...")
+            logger.info("Adding fstab entry: %s", fstab_entry_line)
+            # The entry is appended in place with one O_APPEND write, so the backup must be a real
+            # copy (a hardlink would share the inode and receive the appended lines as well)
             try:
                  backup_fstab = fstab_file.with_suffix(fstab_file.suffix + f".bak-{current_timestamp}")
-                 shutil.copy2(fstab_file, backup_fstab)
-                 logger.info(f"Backed up fstab to {backup_fstab}")
-                 fstab_file.write_text(new_content)
+                 backup_file_copy(fstab_file, backup_fstab)
+                 logger.info("Backed up fstab to %s", backup_fstab)
+                 # Blank separator line, then comment and entry; a missing trailing newline is added first
+                 _append_line(fstab_file, f"\n{fstab_comment_line}\n{fstab_entry_line}")
             except Exception as write_err:
                  console.print(f"[bold red]Error:[/bold red] Failed to write fstab file {fstab_file}: {write_err}")
                  logger.exception(f"Failed writing fstab file {fstab_file}")
                  return False
 
-            console.print("[green]✓[/green] fstab entry added.")
+            notice("[green]✓[/green] fstab entry added.")
             logger.info("Successfully added fstab entry.")
         else:
-            console.print("[green]✓[/green] fstab entry already seems to exist.")
+            notice("[green]✓[/green] fstab entry already seems to exist.")
 
         # Test the mount immediately if the device is active
         # Activate VG first just in case it wasn't active from LVM step
         vg_active_check = run_command(['lvm', 'vgchange', '-ay', VG_NAME], description="Ensuring VG is active before mount test", check=False)
         if vg_active_check and LV_DEVICE_PATH.is_block_device():
-             console.print(f"Attempting to mount [cyan]{LVM_MOUNT_POINT}[/cyan] using new fstab entry...")
+             notice(f"Attempting to mount [cyan]{LVM_MOUNT_POINT}[/cyan] using new fstab entry...")
              # Use mount -a which reads fstab, but target the specific mountpoint
              # Use mount --target to be safer than mount -a
              mount_result = run_command(['mount', str(LVM_MOUNT_POINT)], description=f"Testing mount {LVM_MOUNT_POINT}", check=False)
              if mount_result and mount_result.returncode == 0:
-                 console.print(f"[green]✓[/green] Successfully mounted {LVM_MOUNT_POINT}.")
-                 logger.info(f"Successfully mounted {LVM_MOUNT_POINT} via 'mount' command.")
+                 notice(f"[green]✓[/green] Successfully mounted {LVM_MOUNT_POINT}.")
+                 logger.info("Successfully mounted %s via 'mount' command.", LVM_MOUNT_POINT)
                  # Check ownership again after mount? Filesystem options might override.
                  try:
                      mount_stat = LVM_MOUNT_POINT.stat()
@@ -1641,8 +2552,8 @@ def step_fstab(progress, task_id, args): # Added args
                  # Check if already mounted (mount returns 32 if already mounted)
                  mountpoint_check = run_command(['mountpoint', '-q', str(LVM_MOUNT_POINT)], check=False, description="Checking if already mounted")
                  if mountpoint_check and mountpoint_check.returncode == 0:
-                      console.print(f"[green]✓[/green] {LVM_MOUNT_POINT} appears to be already mounted.")
-                      logger.info(f"{LVM_MOUNT_POINT} already mounted.")
+                      notice(f"[green]✓[/green] {LVM_MOUNT_POINT} appears to be already mounted.")
+                      logger.info("%s already mounted.", LVM_MOUNT_POINT)
                  else:
                       console.print(f"[bold yellow]Warning:[/bold yellow] Failed to mount {LVM_MOUNT_POINT} using 'mount' command (Code: {mount_result.returncode if mount_result else 'N/A'}). It should mount on next boot via fstab.")
                       logger.warning(f"Failed to mount {LVM_MOUNT_POINT} using mount command.")
@@ -1650,7 +2561,7 @@ def step_fstab(progress, task_id, args): # Added args
                            logger.warning(f"Mount stderr: {mount_result.stderr.strip()}")
         else:
             console.print(f"[yellow]Skipping immediate mount test:[/yellow] VG '{VG_NAME}' not active or LV device node missing.")
-            logger.info(f"Skipping mount test as VG {VG_NAME} not active or LV device missing.")
+            logger.info("Skipping mount test as VG %s not active or LV device missing.", VG_NAME)
 
 
         logger.info("Mount point and fstab configuration finished.")
@@ -1667,33 +2578,51 @@ def step_fstab(progress, task_id, args): # Added args
 def step_enable_storage_services(progress, task_id, args): # Added args
     """Reloads systemd daemon and enables NBD and LVM activation services for boot."""
     logger.info("Enabling storage persistence services (NBD, LVM activation).")
-    console.print("[cyan]Reloading systemd daemon (to recognize new/modified service units)...[/cyan]")
-    if not run_command(['systemctl', 'daemon-reload'], description="Daemon reload"):
-        logger.error("daemon-reload failed before enabling services.")
-        # This is usually serious, might prevent enabling
-        console.print("[bold red]Error:[/bold red] systemctl daemon-reload failed. Service enablement might fail. Check 'systemctl status' manually.")
-        return False # Fail the step if daemon-reload fails
-
-    console.print("[cyan]Enabling NBD ([green]qemu-nbd-connect.service[/green]) and LVM activation ([green]lvm-activate-data-vg.service[/green]) services for boot...[/cyan]")
-    nbd_enabled_ok = run_command(['systemctl', 'enable', 'qemu-nbd-connect.service'], description="Enabling NBD service")
-    lvm_enabled_ok = run_command(['systemctl', 'enable', 'lvm-activate-data-vg.service'], description="Enabling LVM activation service")
-
-    if nbd_enabled_ok and lvm_enabled_ok:
-        console.print("[green]✓[/green] Storage persistence services enabled for boot.")
-        logger.info("NBD and LVM activation services enabled successfully.")
-        # Also try starting them now if not already running (idempotent)
-        console.print("[cyan]Attempting to start storage services now...[/cyan]")
-        run_command(['systemctl', 'start', 'qemu-nbd-connect.service'], description="Starting NBD service", check=False) # Allow failure if already running
-        run_command(['systemctl', 'start', 'lvm-activate-data-vg.service'], description="Starting LVM activation service", check=False) # Allow failure if already running
+    storage_units = ['qemu-nbd-connect.service', 'lvm-activate-data-vg.service']
+    states = get_unit_properties(storage_units, ('ActiveState', 'UnitFileState', 'NeedDaemonReload'))
+    pending = [unit for unit in storage_units
+               if states.get(unit, {}).get('UnitFileState') != 'enabled' or states.get(unit, {}).get('ActiveState') != 'active']
+    # systemd flags units whose files changed since they were loaded; only reload when one of ours is stale
+    needs_reload = not states or any(states.get(unit, {}).get('NeedDaemonReload') != 'no' for unit in storage_units)
+
+    if needs_reload:
+        request_daemon_reload()
+    if needs_reload or _pending_daemon_reload:
+        notice("[cyan]Reloading systemd daemon (to recognize new/modified service units)...[/cyan]")
+        if not flush_daemon_reload():
+            logger.error("daemon-reload failed before enabling services.")
+            # This is usually serious, might prevent enabling
+            console.print("[bold red]Error:[/bold red] systemctl daemon-reload failed. Service enablement might fail. Check 'systemctl status' manually.")
+            return False # Fail the step if daemon-reload fails
+    else:
+        logger.info("Storage unit files unchanged since systemd loaded them; skipping daemon-reload.")
 
+    if not pending:
+        notice("[green]✓[/green] Storage persistence services already enabled and active.")
+        logger.info("Storage services already enabled and active; skipping systemctl enable/start.")
         progress.update(task_id, advance=1)
         return True
-    else:
-        if not nbd_enabled_ok: logger.error("Failed to enable qemu-nbd-connect.service.")
-        if not lvm_enabled_ok: logger.error("Failed to enable lvm-activate-data-vg.service.")
-        console.print("[bold red]Error:[/bold red] Failed to enable one or both storage services. Check systemctl status and journalctl for details.")
-        run_command(['systemctl', 'status', 'qemu-nbd-connect.service', 'lvm-activate-data-vg.service', '--no-pager'], description="Storage service status", check=False, show_output=True)
-        return False
+
+    notice(f"[cyan]Enabling and starting storage services: [green]{', '.join(pending)}[/green]...[/cyan]")
+    # One transaction enables the pending units for boot and starts them now
+    if run_command(['systemctl', 'enable', '--now', *pending], description="Enabling and starting storage services", check=False):
+        notice("[green]✓[/green] Storage persistence services enabled for boot and started.")
+        logger.info(f"Storage services enabled and started: {', '.join(pending)}.")
+        progress.update(task_id, advance=1)
+        return True
+
+    # enable --now also fails when only the start failed; enablement for boot is what this step requires
+    if probe_command(['systemctl', 'is-enabled', '--quiet', *storage_units]):
+        console.print("[yellow]Warning:[/yellow] Storage services are enabled for boot but could not be started now.")
+        logger.warning("Storage services enabled, but starting them failed.")
+        collect_diagnostics('storage-services', units=storage_units)
+        progress.update(task_id, advance=1)
+        return True
+
+    logger.error(f"Failed to enable storage services: {', '.join(storage_units)}.")
+    console.print("[bold red]Error:[/bold red] Failed to enable one or both storage services. Check systemctl status and journalctl for details.")
+    collect_diagnostics('storage-services', units=storage_units)
+    return False
 
 
 @installer_step("Install Docker CE with Multi-Architecture Support")
@@ -1717,14 +2646,12 @@ def step_install_docker(progress, task_id, args):
     # Remove old Docker packages if they exist
     old_packages = ["docker", "docker-engine", "docker.io", "containerd", "runc"]
     for package in old_packages:
-        run_command(['apt-get', 'remove', '-y', package], description=f"Removing old {package}", check=False)
+        run_command(['apt-get', 'remove', '-y', package], description=f"Removing old {package}", env=APT_NONINTERACTIVE_ENV, check=False)
     
     # Install prerequisites (most should already be installed)
     prereq_packages = ["ca-certificates", "curl", "gnupg", "lsb-release"]
-    install_env = os.environ.copy()
-    install_env['DEBIAN_FRONTEND'] = 'noninteractive'
     
-    if not run_command(['apt-get', 'install', '-y'] + prereq_packages, description="Installing Docker prerequisites", env=install_env):
+    if not run_command(['apt-get', 'install', '-y'] + prereq_packages, description="Installing Docker prerequisites", env=APT_NONINTERACTIVE_ENV):
         console.print("[bold red]Error:[/bold red] Failed to install Docker prerequisites.")
         logger.error("Failed to install Docker prerequisites.")
         return False
@@ -1801,7 +2728,7 @@ def step_install_docker(progress, task_id, args):
     ]
     
     if not run_command(['apt-get', 'install', '-y'] + docker_packages, 
-                       description="Installing Docker CE packages", env=install_env):
+                       description="Installing Docker CE packages", env=APT_NONINTERACTIVE_ENV):
         logger.error("Failed to install Docker CE packages.")
         return False
     
@@ -1809,6 +2736,7 @@ def step_install_docker(progress, task_id, args):
     if not run_command(['usermod', '-aG', 'docker', DEBIAN_USER], description=f"Adding {DEBIAN_USER} to docker group"):
         logger.error(f"Failed to add {DEBIAN_USER} to docker group.")
         return False
+    clear_identity_cache()
     
     # Configure Docker daemon for multi-arch support
     docker_config_dir = Path("/etc/docker")
@@ -1959,12 +2887,10 @@ def step_install_package_tools(progress, task_id, args):
     
     if missing_tools:
         console.print(f"[yellow]Installing missing tools:[/yellow] {', '.join(missing_tools)}")
-        install_env = os.environ.copy()
-        install_env['DEBIAN_FRONTEND'] = 'noninteractive'
         
         if not run_command(['apt-get', 'install', '-y'] + missing_tools, 
                            description="Installing missing package management tools", 
-                           env=install_env):
+                           env=APT_NONINTERACTIVE_ENV):
             console.print("[bold red]Error:[/bold red] Failed to install some package management tools.")
             logger.error("Failed to install missing package management tools.")
             return False
@@ -2005,10 +2931,10 @@ def step_enhance_configs(progress, task_id, args):
     logger.info(f"Starting configuration file enhancement for user {DEBIAN_USER}.")
     
     try:
-        user_info = pwd.getpwnam(DEBIAN_USER)
+        user_info = _pw(DEBIAN_USER)
         user_home = Path(user_info.pw_dir)
         user_gid = user_info.pw_gid
-        user_group_info = grp.getgrgid(user_gid)
+        user_group_info = _grgid(user_gid)
         user_primary_group = user_group_info.gr_name
     except KeyError:
         console.print(f"[bold red]Error:[/bold red] Cannot find user {DEBIAN_USER} for configuration enhancement.")
@@ -2038,7 +2964,7 @@ def step_enhance_configs(progress, task_id, args):
         if filepath.exists():
             backup_path = backup_dir / filename
             try:
-                shutil.copy2(str(filepath), str(backup_path))
+                backup_file_copy(filepath, backup_path)
                 console.print(f"[green]✓[/green] Backed up {filename}")
                 logger.info(f"Backed up {filepath} to {backup_path}")
             except Exception as e:
@@ -2197,9 +3123,9 @@ syntax on
     
     # Set ownership of backup directory
     try:
-        shutil.chown(str(backup_dir), user=DEBIAN_USER, group=user_primary_group)
+        shutil.chown(backup_dir, user=DEBIAN_USER, group=user_primary_group)
         for item in backup_dir.iterdir():
-            shutil.chown(str(item), user=DEBIAN_USER, group=user_primary_group)
+            shutil.chown(item, user=DEBIAN_USER, group=user_primary_group)
     except Exception as e:
         console.print(f"[yellow]Warning:[/yellow] Failed to set ownership of backup directory: {e}")
         logger.warning(f"Failed to set ownership of backup directory: {e}")
@@ -2246,7 +3172,7 @@ def step_install_starship(progress, task_id, args):
     
     # Get user's home directory
     try:
-        user_info = pwd.getpwnam(DEBIAN_USER)
+        user_info = _pw(DEBIAN_USER)
         user_home = Path(user_info.pw_dir)
     except KeyError:
         console.print(f"[bold red]Error:[/bold red] Cannot find user {DEBIAN_USER} for Starship configuration.")
@@ -2389,58 +3315,63 @@ error_symbol = "[❯](bold red)"
     return True
 
 
+BRAVE_BIN = Path("/usr/bin/brave-browser") # Symlink shipped by the brave-browser package
+
 @installer_step("Install Brave Browser")
 def step_install_brave(progress, task_id, args): # Added args
     """Installs Brave Browser from its official APT repository."""
     logger.info("Starting Brave Browser installation step.")
-    brave_path = shutil.which('brave-browser')
+    # The Debian package installs to a fixed path; only fall back to a PATH lookup without it
+    brave_path = str(BRAVE_BIN) if BRAVE_BIN.is_file() else find_executable('brave-browser')
     if brave_path:
-         console.print(f"Brave Browser already installed ([dim]{brave_path}[/dim]). Skipping installation.")
-         logger.info(f"Brave Browser already installed at {brave_path}.")
+         notice(f"Brave Browser already installed ([dim]{brave_path}[/dim]). Skipping installation.")
+         logger.info("Brave Browser already installed at %s.", brave_path)
          progress.update(task_id, advance=1)
          return True
 
-    console.print("[cyan]Installing Brave Browser (adding repository and package)...[/cyan]")
+    notice("[cyan]Installing Brave Browser (adding repository and package)...[/cyan]")
     logger.info("Brave Browser not found. Proceeding with installation.")
     keyring_dir = Path("/etc/apt/keyrings")
     keyring_file = keyring_dir / "brave-browser-archive-keyring.gpg"
     sources_file = Path("/etc/apt/sources.list.d/brave-browser-release.list")
     key_url = "https://brave-browser-apt-release.s3.brave.com/brave-browser-archive-keyring.gpg"
 
-    arch_result = run_command(['dpkg', '--print-architecture'], description="Getting system architecture")
+    try:
+         keyring_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+         logger.debug("Ensured keyring directory exists: %s", keyring_dir)
+    except Exception as e:
+         console.print(f"[bold red]Error:[/bold red] Failed creating keyring directory {keyring_dir}: {e}")
+         logger.exception(f"Failed creating keyring directory {keyring_dir}")
+         return False
+
+    # The architecture query is local and the key download is network-bound; overlap them
+    arch_result, key_result = run_parallel([
+        dict(command=['dpkg', '--print-architecture'], description="Getting system architecture"),
+        dict(command=['curl', '-fsSLo', str(keyring_file), key_url], description="Downloading Brave GPG key"),
+    ])
     if not arch_result:
          console.print("[bold red]Error:[/bold red] Could not determine system architecture using dpkg.")
          logger.error("Failed to determine system architecture.")
+         keyring_file.unlink(missing_ok=True)
          return False
     arch = arch_result.stdout.strip()
-    logger.info(f"System architecture detected as: {arch}")
+    logger.info("System architecture detected as: %s", arch)
 
     repo_line = f"deb [arch={arch} signed-by={keyring_file}] https://brave-browser-apt-release.s3.brave.com/ stable main"
-    logger.debug(f"Brave repository line: {repo_line}")
+    logger.debug("Brave repository line: %s", repo_line)
 
     success = True
-    try:
-         keyring_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
-         logger.debug(f"Ensured keyring directory exists: {keyring_dir}")
-    except Exception as e:
-         console.print(f"[bold red]Error:[/bold red] Failed creating keyring directory {keyring_dir}: {e}")
-         logger.exception(f"Failed creating keyring directory {keyring_dir}")
-         success = False
-
-    if success:
-        # Use curl command directly
-        curl_cmd = ['curl', '-fsSLo', str(keyring_file), key_url]
-        if not run_command(curl_cmd, description="Downloading Brave GPG key"):
-            logger.error(f"Failed to download Brave GPG key from {key_url}")
-            success = False
-            # Clean up potentially incomplete/invalid key file
-            keyring_file.unlink(missing_ok=True)
+    if not key_result:
+        logger.error(f"Failed to download Brave GPG key from {key_url}")
+        success = False
+        # Clean up potentially incomplete/invalid key file
+        keyring_file.unlink(missing_ok=True)
 
     if success:
         # Ensure key has correct permissions (readable by apt)
         try:
              os.chmod(keyring_file, 0o644)
-             logger.info(f"Set permissions 644 on {keyring_file}")
+             logger.info("Set permissions 644 on %s", keyring_file)
         except OSError as e:
              console.print(f"[bold red]Error:[/bold red] Failed setting permissions on GPG key {keyring_file}: {e}")
              logger.error(f"Failed setting permissions on {keyring_file}: {e}")
@@ -2459,7 +3390,7 @@ def step_install_brave(progress, task_id, args): # Added args
 
     if success:
         # Update apt cache after adding repo
-        if not run_command(['apt-get', 'update', '-qq'], description="apt update after adding Brave repo", show_output=False):
+        if not run_command(apt_update_source_cmd(sources_file), description="apt update of the Brave repo", show_output=False):
             logger.error("apt-get update failed after adding Brave repository.")
             # Don't necessarily fail the whole step yet, maybe install works anyway or user can fix apt
             console.print("[yellow]Warning:[/yellow] apt-get update failed after adding Brave repo. Install might fail.")
@@ -2467,18 +3398,17 @@ def step_install_brave(progress, task_id, args): # Added args
 
     if success:
         # Install the package
-        install_env = os.environ.copy()
-        install_env['DEBIAN_FRONTEND'] = 'noninteractive'
-        if not run_command(['apt-get', 'install', '-y', 'brave-browser'], description="Installing brave-browser package", env=install_env, show_output=False):
+        if not run_command(['apt-get', 'install', '-y', 'brave-browser'], description="Installing brave-browser package", env=APT_NONINTERACTIVE_ENV, show_output=False):
             logger.error("Failed to install brave-browser package.")
             success = False
+        invalidate_path_cache() # The package adds new executables
 
     # Final check
     if success:
-        brave_path_final = shutil.which('brave-browser')
+        brave_path_final = str(BRAVE_BIN) if BRAVE_BIN.is_file() else find_executable('brave-browser')
         if brave_path_final:
-            console.print(f"[green]✓[/green] Brave Browser installed successfully ([dim]{brave_path_final}[/dim]).")
-            logger.info(f"Brave Browser installed successfully at {brave_path_final}.")
+            notice(f"[green]✓[/green] Brave Browser installed successfully ([dim]{brave_path_final}[/dim]).")
+            logger.info("Brave Browser installed successfully at %s.", brave_path_final)
             progress.update(task_id, advance=1)
             return True
         else:
@@ -2499,44 +3429,9 @@ def step_install_brave(progress, task_id, args): # Added args
         return False # Fail the step
 
 
-@installer_step("Setup VNC (xstartup & systemd)")
-def step_setup_vnc(progress, task_id, args): # Added args
-    """Configures the VNC server xstartup script and systemd service."""
-    logger.info(f"Starting VNC setup for user {DEBIAN_USER} on display {VNC_DISPLAY}.")
-    # Determine user's home dynamically
-    try:
-        user_info = pwd.getpwnam(DEBIAN_USER)
-        user_home = Path(user_info.pw_dir)
-        vnc_dir = user_home / ".vnc"
-        vnc_xstartup_path_dynamic = vnc_dir / "xstartup" # Use dynamic path
-        vnc_pid_file_dynamic = vnc_dir / f"%H{VNC_DISPLAY}.pid" # Use dynamic path for PID
-    except KeyError:
-         console.print(f"[bold red]Error:[/bold red] Cannot find user {DEBIAN_USER} to determine home directory for VNC setup.")
-         logger.error(f"User {DEBIAN_USER} not found when getting home directory for VNC.")
-         return False
-
-    console.print(f"Configuring VNC xstartup script: [cyan]{vnc_xstartup_path_dynamic}[/cyan]...")
-
-    # Ensure .vnc directory exists, created as the user
-    try:
-        if not run_command(['mkdir', '-p', str(vnc_dir)], user=DEBIAN_USER, description=f"Ensuring VNC directory {vnc_dir} exists"):
-            # Check if it exists anyway if command failed
-            if not vnc_dir.is_dir():
-                 raise OSError(f"Failed to create VNC directory {vnc_dir} as user {DEBIAN_USER}")
-            else:
-                 logger.warning(f"mkdir failed for {vnc_dir}, but it exists.")
-        # Set permissions on .vnc dir? Usually 700.
-        run_command(['chmod', '700', str(vnc_dir)], user=DEBIAN_USER, description="Setting VNC directory permissions", check=False)
-
-    except Exception as e:
-         console.print(f"[bold red]Error:[/bold red] Failed creating/preparing VNC directory {vnc_dir}: {e}")
-         logger.exception(f"Failed creating/preparing VNC directory {vnc_dir}")
-         return False
-
-
-    # Define xstartup content
-    # Use gnome-session which should handle Wayland/X11 session types appropriately if available
-    xstartup_content = f"""#!/bin/sh
+# xstartup has no per-install values; the unit template is filled with str.format_map
+# Use gnome-session which should handle Wayland/X11 session types appropriately if available
+VNC_XSTARTUP = """#!/bin/sh
 
 # Start a GNOME Session (works for both X11 and Wayland via Xwayland in recent GNOME)
 export XDG_SESSION_DESKTOP=gnome
@@ -2559,49 +3454,20 @@ gnome-session &
 # gnome-terminal &
 
 """
-    # Write the xstartup file AS ROOT, then chown to user
-    if not write_file(vnc_xstartup_path_dynamic, xstartup_content, owner=DEBIAN_USER, permissions="0755"): # Make executable
-        console.print("[bold red]Error:[/bold red] Failed to write VNC xstartup script.")
-        logger.error(f"Failed writing VNC xstartup script {vnc_xstartup_path_dynamic}")
-        return False
-    console.print("[green]✓[/green] VNC xstartup script configured.")
-    logger.info(f"VNC xstartup script {vnc_xstartup_path_dynamic} configured successfully.")
-
-
-    # --- VNC Systemd Service ---
-    vnc_service_file = Path(f"/etc/systemd/system/vncserver@.service")
-    console.print(f"Defining VNC systemd service file: [cyan]{vnc_service_file}[/cyan]")
-    try:
-        vnc_user_info = pwd.getpwnam(DEBIAN_USER)
-        # Use primary group of the user unless DEBIAN_GROUP is different and exists
-        primary_gid = vnc_user_info.pw_gid
-        vnc_group_name = DEBIAN_USER # Default to user's primary group name
-        try:
-             vnc_group_name = grp.getgrgid(primary_gid).gr_name
-        except KeyError:
-             logger.warning(f"Could not find group name for primary GID {primary_gid} of user {DEBIAN_USER}. Using GID directly.")
-
-        vnc_service_group = DEBIAN_GROUP if check_group_exists(DEBIAN_GROUP) else vnc_group_name
 
-        logger.debug(f"Using User={DEBIAN_USER}, Group={vnc_service_group} for VNC service.")
-    except KeyError as e:
-        console.print(f"[bold red]Error:[/bold red] Cannot find VNC user '{DEBIAN_USER}' needed for service file: {e}")
-        logger.critical(f"VNC user '{DEBIAN_USER}' not found.")
-        return False
-
-    # Define systemd service content
-    # Using Type=forking as vncserver daemonizes
-    vnc_service_content = f"""[Unit]
+# Using Type=forking as vncserver daemonizes
+VNC_UNIT_TMPL = """[Unit]
 Description=TigerVNC per-display remote desktop service for user {DEBIAN_USER}
 Documentation=man:vncserver(1) man:Xvnc(1)
-# Start after graphical target and potentially storage/network services are up
-After=syslog.target network-online.target graphical.target lvm-activate-data-vg.service mnt-data.mount
-Wants=network-online.target
+# Order only against what the session actually uses (network and the data mount), not
+# graphical.target: Xvnc runs its own X server and would otherwise wait for the whole desktop stack
+After=network-online.target lvm-activate-data-vg.service mnt-data.mount
+Wants=network-online.target lvm-activate-data-vg.service mnt-data.mount
 
 [Service]
 Type=forking
 User={DEBIAN_USER}
-WorkingDirectory={user_home}
+WorkingDirectory={USER_HOME}
 
 # Clean any existing lock files before starting (avoids issues after crash)
 ExecStartPre=-/usr/bin/vncserver -kill :%i
@@ -2618,12 +3484,12 @@ ExecStart=/usr/bin/vncserver :%i \\
     -localhost no \\
     -alwaysshared \\
     -SecurityTypes VncAuth \\
-    -auth {user_home}/.Xauthority \\
-    -pidfile {vnc_pid_file_dynamic} \\
-    -xstartup {vnc_xstartup_path_dynamic}
+    -auth {USER_HOME}/.Xauthority \\
+    -pidfile {PID_FILE} \\
+    -xstartup {XSTARTUP_PATH}
 
 # Specify the PID file location explicitly
-PIDFile={vnc_pid_file_dynamic}
+PIDFile={PID_FILE}
 
 # Kill the VNC server process on stop
 ExecStop=/usr/bin/vncserver -kill :%i
@@ -2631,30 +3497,97 @@ ExecStop=/usr/bin/vncserver -kill :%i
 [Install]
 WantedBy=multi-user.target
 """
-    if not write_file(vnc_service_file, vnc_service_content, permissions="0644"):
+
+@installer_step("Setup VNC (xstartup & systemd)")
+def step_setup_vnc(progress, task_id, args): # Added args
+    """Configures the VNC server xstartup script and systemd service."""
+    logger.info("Starting VNC setup for user %s on display %s.", DEBIAN_USER, VNC_DISPLAY)
+    # Determine user's home dynamically
+    try:
+        user_info = _pw(DEBIAN_USER)
+        user_home = Path(user_info.pw_dir)
+        vnc_dir = user_home / ".vnc"
+        vnc_xstartup_path_dynamic = vnc_dir / "xstartup" # Use dynamic path
+        vnc_pid_file_dynamic = vnc_dir / f"%H{VNC_DISPLAY}.pid" # Use dynamic path for PID
+    except KeyError:
+         console.print(f"[bold red]Error:[/bold red] Cannot find user {DEBIAN_USER} to determine home directory for VNC setup.")
+         logger.error(f"User {DEBIAN_USER} not found when getting home directory for VNC.")
+         return False
+
+    notice(f"Configuring VNC xstartup script: [cyan]{vnc_xstartup_path_dynamic}[/cyan]...")
+
+    # Ensure .vnc directory exists, owned by the user with mode 700 (direct syscalls, no sudo/mkdir/chmod)
+    try:
+        _ensure_private_dir(vnc_dir, user_info.pw_uid, user_info.pw_gid)
+        logger.debug("Ensured VNC directory %s (700, %s).", vnc_dir, DEBIAN_USER)
+
+    except Exception as e:
+         console.print(f"[bold red]Error:[/bold red] Failed creating/preparing VNC directory {vnc_dir}: {e}")
+         logger.exception(f"Failed creating/preparing VNC directory {vnc_dir}")
+         return False
+
+    # --- VNC Systemd Service ---
+    vnc_service_file = Path(f"/etc/systemd/system/vncserver@.service")
+    notice(f"Defining VNC systemd service file: [cyan]{vnc_service_file}[/cyan]")
+    try:
+        vnc_user_info = _pw(DEBIAN_USER)
+        # Use primary group of the user unless DEBIAN_GROUP is different and exists
+        primary_gid = vnc_user_info.pw_gid
+        vnc_group_name = DEBIAN_USER # Default to user's primary group name
+        try:
+             vnc_group_name = _grgid(primary_gid).gr_name
+        except KeyError:
+             logger.warning(f"Could not find group name for primary GID {primary_gid} of user {DEBIAN_USER}. Using GID directly.")
+
+        vnc_service_group = DEBIAN_GROUP if check_group_exists(DEBIAN_GROUP) else vnc_group_name
+
+        logger.debug("Using User=%s, Group=%s for VNC service.", DEBIAN_USER, vnc_service_group)
+    except KeyError as e:
+        console.print(f"[bold red]Error:[/bold red] Cannot find VNC user '{DEBIAN_USER}' needed for service file: {e}")
+        logger.critical(f"VNC user '{DEBIAN_USER}' not found.")
+        return False
+
+    vnc_service_content = VNC_UNIT_TMPL.format_map({
+        'DEBIAN_USER': DEBIAN_USER,
+        'USER_HOME': user_home,
+        'VNC_GEOMETRY': VNC_GEOMETRY,
+        'VNC_DEPTH': VNC_DEPTH,
+        'PID_FILE': vnc_pid_file_dynamic,
+        'XSTARTUP_PATH': vnc_xstartup_path_dynamic,
+    })
+
+    # Both files are written as root in one atomic batch; xstartup is then owned by the user and executable
+    results = write_files([
+        dict(path=vnc_xstartup_path_dynamic, content=VNC_XSTARTUP, owner=DEBIAN_USER, permissions="0755", atomic=True),
+        dict(path=vnc_service_file, content=vnc_service_content, permissions="0644", atomic=True),
+    ])
+    if not results[vnc_xstartup_path_dynamic]:
+        console.print("[bold red]Error:[/bold red] Failed to write VNC xstartup script.")
+        logger.error(f"Failed writing VNC xstartup script {vnc_xstartup_path_dynamic}")
+        return False
+    notice("[green]✓[/green] VNC xstartup script configured.")
+    logger.info("VNC xstartup script %s configured successfully.", vnc_xstartup_path_dynamic)
+    if not results[vnc_service_file]:
         console.print("[bold red]Error:[/bold red] Failed to write VNC systemd service file.")
         logger.error(f"Failed writing VNC systemd service file {vnc_service_file}")
         return False
-    console.print("[green]✓[/green] VNC systemd service file defined.")
-    logger.info(f"VNC systemd service file {vnc_service_file} defined successfully.")
+    notice("[green]✓[/green] VNC systemd service file defined.")
+    logger.info("VNC systemd service file %s defined successfully.", vnc_service_file)
 
-    # --- Reload Daemon & Enable Service ---
-    console.print("[cyan]Reloading systemd daemon...[/cyan]")
-    if not run_command(['systemctl', 'daemon-reload'], description="Daemon reload"):
-        console.print("[yellow]Warning:[/yellow] systemctl daemon-reload failed. Service enablement might require manual reload.")
-        logger.warning("daemon-reload failed after writing VNC service file.")
-        # Don't fail here, enabling might still work if daemon notices changes
+    # --- Enable Service ---
+    # 'systemctl enable' works from the unit file on disk; the reload is deferred until a unit is started
+    request_daemon_reload()
 
     vnc_instance_service = f"vncserver@{VNC_DISPLAY_NUM}.service"
-    console.print(f"Enabling VNC service instance [cyan]{vnc_instance_service}[/cyan] for boot...")
-    logger.info(f"Enabling VNC service instance {vnc_instance_service}.")
+    notice(f"Enabling VNC service instance [cyan]{vnc_instance_service}[/cyan] for boot...")
+    logger.info("Enabling VNC service instance %s.", vnc_instance_service)
     if not run_command(['systemctl', 'enable', vnc_instance_service], description=f"Enabling {vnc_instance_service}"):
         console.print(f"[bold red]Error:[/bold red] Failed to enable VNC service instance {vnc_instance_service}.")
         logger.error(f"Failed to enable VNC service instance {vnc_instance_service}.")
         run_command(['systemctl', 'status', vnc_instance_service, '--no-pager'], description="VNC service status", check=False, show_output=True)
         return False
 
-    console.print(f"[green]✓[/green] VNC service ({vnc_instance_service}) configured and enabled.")
+    notice(f"[green]✓[/green] VNC service ({vnc_instance_service}) configured and enabled.")
     console.print(f"[bold yellow]Action Required:[/bold yellow] Set VNC password for user '{DEBIAN_USER}' before starting the service:")
     console.print(f"  Run: [white on black] sudo -u {DEBIAN_USER} vncpasswd [/white on black]")
     logger.info("VNC setup step finished successfully.")
@@ -2662,47 +3595,7 @@ WantedBy=multi-user.target
     return True
 
 
-@installer_step("Configure Enhanced Samba Server")
-def step_configure_samba(progress, task_id, args): # Added args
-    """Configures enhanced Samba server for sharing the LVM data volume and root filesystem."""
-    logger.info(f"Starting enhanced Samba configuration for share '{SAMBA_SHARE_NAME}' -> {SAMBA_SHARE_PATH}")
-    smb_conf_file = Path("/etc/samba/smb.conf")
-    console.print(f"Configuring enhanced Samba server with multiple shares in [cyan]{smb_conf_file}[/cyan]...")
-
-    # Backup existing config
-    if smb_conf_file.exists():
-         backup_file = smb_conf_file.with_suffix(f".bak-{current_timestamp}")
-         try:
-             # Use copy2 to preserve metadata, then overwrite original
-             shutil.copy2(str(smb_conf_file), str(backup_file))
-             console.print(f"Backed up existing smb.conf to [cyan]{backup_file}[/cyan]")
-             logger.info(f"Backed up {smb_conf_file} to {backup_file}")
-         except Exception as e:
-             console.print(f"[bold yellow]Warning:[/bold yellow] Could not back up {smb_conf_file}: {e}")
-             logger.warning(f"Could not back up {smb_conf_file}: {e}")
-             # Ask user if they want to continue and overwrite? For now, continue cautiously.
-             if not args.non_interactive and not Confirm.ask(f"Could not back up {smb_conf_file}. Overwrite existing file anyway?", default=False):
-                  console.print("[red]Aborted by user due to backup failure.[/red]")
-                  logger.error("Samba configuration aborted by user due to backup failure.")
-                  return False
-
-    # Verify the share path exists and is a directory (should be mounted by now)
-    share_path_obj = Path(SAMBA_SHARE_PATH)
-    if not share_path_obj.is_dir():
-        console.print(f"[bold red]Error:[/bold red] Samba share path '{SAMBA_SHARE_PATH}' does not exist or is not a directory.")
-        console.print("  Ensure LVM volume is mounted correctly (check `df -h` and previous steps).")
-        logger.error(f"Samba share path {SAMBA_SHARE_PATH} is not a valid directory. Check mount status.")
-        # Try to mount it explicitly?
-        mount_result = run_command(['mount', str(share_path_obj)], description=f"Attempting to mount {share_path_obj}", check=False)
-        if not mount_result or not share_path_obj.is_dir():
-             console.print(f"[bold red]Error:[/bold red] Still cannot access share path {share_path_obj} after mount attempt.")
-             return False
-        else:
-            console.print(f"[yellow]Info:[/yellow] Successfully mounted {share_path_obj}. Continuing Samba setup.")
-            logger.info(f"Mounted {share_path_obj} before Samba setup.")
-
-    # Define enhanced smb.conf content with root filesystem sharing
-    smb_conf_content = f"""# Enhanced Samba configuration generated by AVF installer ({current_timestamp})
+SMB_CONF_TMPL = """# Enhanced Samba configuration generated by AVF installer
 [global]
     workgroup = WORKGROUP
     server string = %h Debian ARM64 Server (Enhanced)
@@ -2730,6 +3623,15 @@ def step_configure_samba(progress, task_id, args): # Added args
     max xmit = 65535
     dead time = 15
     getwd cache = yes
+    # Zero-copy reads (sendfile) and writes (splice for requests >= 16 KiB), async I/O for every request
+    use sendfile = yes
+    min receivefile size = 16384
+    aio read size = 1
+    aio write size = 1
+    # Allocate blocks up front (fewer fragmented extents for large copies); skip per-I/O lock checks
+    strict allocate = yes
+    allocation roundup size = 4096
+    strict locking = no
     
     # Logging
     log file = /var/log/samba/log.%m
@@ -2820,64 +3722,144 @@ def step_configure_samba(progress, task_id, args): # Added args
     # Or allow anyone in the group: valid users = @{DEBIAN_GROUP}
     # Write access for the group
     write list = @{DEBIAN_GROUP} {DEBIAN_USER}
+    # Bulk data share: no byte-range lock check on every read/write
+    strict locking = no
 """
-    if not write_file(smb_conf_file, smb_conf_content, permissions="0644"):
+
+def install_smb_conf(smb_conf_file, smb_conf_content):
+    """
+    Stages the new smb.conf next to the live one and validates it with testparm; the live file
+    is only replaced (one rename, no second write) once testparm accepts it.
+    Returns True if installed, False if rejected or on failure (the old file is left in place).
+    """
+    staged_conf = smb_conf_file.with_name(f".{smb_conf_file.name}.new")
+    if not write_file(staged_conf, smb_conf_content, permissions="0644"):
         console.print("[bold red]Error:[/bold red] Failed to write enhanced Samba configuration file.")
-        logger.error(f"Failed writing enhanced Samba configuration {smb_conf_file}")
+        logger.error(f"Failed writing enhanced Samba configuration {staged_conf}")
+        return False
+
+    console.print("[cyan]Verifying enhanced Samba configuration using 'testparm'...[/cyan]")
+    testparm_result = run_command(['testparm', '-s', str(staged_conf)], description="Running testparm", show_output=True, check=False) # -s suppresses questions
+    # testparm returns 0 even with warnings, so also check stderr for critical errors
+    if not testparm_result or "ERROR:" in testparm_result.stderr:
+        console.print("[bold red]Error:[/bold red] 'testparm' reported critical errors in the Samba configuration. Check output above.")
+        console.print(f"  Existing {smb_conf_file} left unchanged.")
+        logger.error(f"'testparm' rejected {staged_conf}: {testparm_result.stderr.strip() if testparm_result else 'non-zero exit'}")
+        with contextlib.suppress(OSError):
+            staged_conf.unlink()
+        return False
+
+    try:
+        # Flush the validated file before the rename makes it the live smb.conf
+        fd = os.open(staged_conf, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            os.fdatasync(fd)
+        finally:
+            os.close(fd)
+        os.replace(staged_conf, smb_conf_file)
+    except OSError as e:
+        console.print(f"[bold red]Error:[/bold red] Failed to install {smb_conf_file}: {e}")
+        logger.error(f"Failed renaming {staged_conf} to {smb_conf_file}: {e}")
         return False
     console.print("[green]✓[/green] Enhanced Samba configuration file written.")
     logger.info(f"Enhanced Samba configuration {smb_conf_file} written successfully.")
+    return True
 
-    console.print("[bold yellow]Action Required:[/bold yellow] Set Samba password for user '{DEBIAN_USER}':")
-    console.print(f"  Run: [white on black] sudo smbpasswd -a {DEBIAN_USER} [/white on black]")
-    logger.info(f"User needs to set samba password for {DEBIAN_USER} using smbpasswd -a.")
+@installer_step("Configure Enhanced Samba Server")
+def step_configure_samba(progress, task_id, args): # Added args
+    """Configures enhanced Samba server for sharing the LVM data volume and root filesystem."""
+    logger.info(f"Starting enhanced Samba configuration for share '{SAMBA_SHARE_NAME}' -> {SAMBA_SHARE_PATH}")
+    smb_conf_file = Path("/etc/samba/smb.conf")
+    console.print(f"Configuring enhanced Samba server with multiple shares in [cyan]{smb_conf_file}[/cyan]...")
 
-    console.print("[cyan]Verifying enhanced Samba configuration using 'testparm'...[/cyan]")
-    testparm_result = run_command(['testparm', '-s'], description="Running testparm", show_output=True, check=False) # -s suppresses questions
-    if not testparm_result or testparm_result.returncode != 0:
-        # testparm returns 0 even with warnings, check stderr for critical errors usually
-        if testparm_result and "ERROR:" in testparm_result.stderr:
-            console.print("[bold red]Error:[/bold red] 'testparm' reported critical errors in the Samba configuration. Check output above.")
-            logger.error(f"'testparm' reported critical errors: {testparm_result.stderr.strip()}")
-            return False
+    # Verify the share path exists and is a directory (should be mounted by now)
+    share_path_obj = Path(SAMBA_SHARE_PATH)
+    if not share_path_obj.is_dir():
+        console.print(f"[bold red]Error:[/bold red] Samba share path '{SAMBA_SHARE_PATH}' does not exist or is not a directory.")
+        console.print("  Ensure LVM volume is mounted correctly (check `df -h` and previous steps).")
+        logger.error(f"Samba share path {SAMBA_SHARE_PATH} is not a valid directory. Check mount status.")
+        # Try to mount it explicitly?
+        mount_result = run_command(['mount', str(share_path_obj)], description=f"Attempting to mount {share_path_obj}", check=False)
+        if not mount_result or not share_path_obj.is_dir():
+             console.print(f"[bold red]Error:[/bold red] Still cannot access share path {share_path_obj} after mount attempt.")
+             return False
         else:
-             console.print("[yellow]Warning:[/yellow] 'testparm' returned non-zero or command failed, but no critical 'ERROR:' found in stderr. Check output carefully.")
-             logger.warning(f"testparm returned non-zero ({testparm_result.returncode if testparm_result else 'N/A'}) or failed, but no obvious critical errors.")
+            console.print(f"[yellow]Info:[/yellow] Successfully mounted {share_path_obj}. Continuing Samba setup.")
+            logger.info(f"Mounted {share_path_obj} before Samba setup.")
+
+    # Render the enhanced smb.conf (root filesystem sharing); no timestamp in it, so an
+    # unchanged rerun renders byte-identical content
+    smb_conf_content = SMB_CONF_TMPL.format_map({
+        'DEBIAN_USER': DEBIAN_USER,
+        'DEBIAN_GROUP': DEBIAN_GROUP,
+        'SAMBA_SHARE_NAME': SAMBA_SHARE_NAME,
+        'SAMBA_SHARE_PATH': SAMBA_SHARE_PATH,
+    })
+    # A rerun that would write the same bytes skips the backup, write, testparm and restart
+    try:
+        conf_unchanged = smb_conf_file.read_bytes() == smb_conf_content.encode()
+    except OSError:
+        conf_unchanged = False
+
+    # Backup existing config
+    if smb_conf_file.exists() and not conf_unchanged:
+         backup_file = smb_conf_file.with_suffix(f".bak-{current_timestamp}")
+         try:
+             # Preserve metadata like copy2 (reflink clone where supported), then overwrite original
+             backup_file_copy(smb_conf_file, backup_file)
+             console.print(f"Backed up existing smb.conf to [cyan]{backup_file}[/cyan]")
+             logger.info(f"Backed up {smb_conf_file} to {backup_file}")
+         except Exception as e:
+             console.print(f"[bold yellow]Warning:[/bold yellow] Could not back up {smb_conf_file}: {e}")
+             logger.warning(f"Could not back up {smb_conf_file}: {e}")
+             # Ask user if they want to continue and overwrite? For now, continue cautiously.
+             if not args.non_interactive and not Confirm.ask(f"Could not back up {smb_conf_file}. Overwrite existing file anyway?", default=False):
+                  console.print("[red]Aborted by user due to backup failure.[/red]")
+                  logger.error("Samba configuration aborted by user due to backup failure.")
+                  return False
+
+    if conf_unchanged:
+        console.print(f"[green]✓[/green] {smb_conf_file} already up to date; skipping backup, write and validation.")
+        logger.info(f"{smb_conf_file} unchanged; skipping backup, write, testparm and restart.")
+    elif not install_smb_conf(smb_conf_file, smb_conf_content):
+        return False
+
+    console.print(Text.assemble(("Action Required:", "bold yellow"), " Set Samba password for user '", _USER_TAG, "':"))
+    console.print(f"  Run: [white on black] sudo smbpasswd -a {DEBIAN_USER} [/white on black]")
+    logger.info(f"User needs to set samba password for {DEBIAN_USER} using smbpasswd -a.")
 
     console.print("[cyan]Enabling and restarting Samba services (smbd, nmbd)...[/cyan]")
     logger.info("Enabling and restarting Samba services.")
-    # Enable first, then restart (more reliable than enable --now sometimes)
-    enable_smbd_ok = run_command(['systemctl', 'enable', 'smbd'], description="Enabling smbd service")
-    enable_nmbd_ok = run_command(['systemctl', 'enable', 'nmbd'], description="Enabling nmbd service")
+    samba_units = ['smbd', 'nmbd']
+    if conf_unchanged:
+        # Daemons already run this configuration: just make sure they are enabled and started
+        enable_ok = run_command(['systemctl', 'enable', '--now', *samba_units], description="Enabling and starting smbd/nmbd services")
+    else:
+        # One enable for both units, then one restart so running daemons pick up the new smb.conf
+        # (enable --now would leave an already-running smbd on the old configuration)
+        enable_ok = run_command(['systemctl', 'enable', *samba_units], description="Enabling smbd/nmbd services")
 
-    restart_ok = run_command(['systemctl', 'restart', 'smbd', 'nmbd'], description="Restarting smbd/nmbd", check=False) # Restart might fail if already stopped etc.
+        restart_ok = run_command(['systemctl', 'restart', *samba_units], description="Restarting smbd/nmbd", check=False) # Restart might fail if already stopped etc.
 
-    if not (enable_smbd_ok and enable_nmbd_ok):
+    if not enable_ok:
         console.print("[bold yellow]Warning:[/bold yellow] Failed to enable one or both Samba services (smbd/nmbd). They might not start on boot.")
         logger.warning("Failed to enable smbd or nmbd.")
         # Don't fail step yet, try checking status
 
-    # Check status after restart attempt
-    time.sleep(2) # Give services time to start/fail
-    smbd_active = run_command(['systemctl', 'is-active', '--quiet', 'smbd'], check=False).returncode == 0
-    nmbd_active = run_command(['systemctl', 'is-active', '--quiet', 'nmbd'], check=False).returncode == 0
-    logger.info(f"Samba service status check: smbd active = {smbd_active}, nmbd active = {nmbd_active}")
+    # Check status after restart attempt: returns as soon as both are active, gives up after 5s
+    unit_active = wait_units_active(samba_units)
+    smbd_active = unit_active['smbd']
+    nmbd_active = unit_active['nmbd']
+    logger.info("Samba service status check: smbd active = %s, nmbd active = %s", smbd_active, nmbd_active)
 
     if smbd_active and nmbd_active:
         console.print("[green]✓[/green] Enhanced Samba services (smbd, nmbd) configured, enabled and are active.")
-        console.print("[bold yellow]Available Shares:[/bold yellow]")
-        console.print(f"  • [cyan]RootFS[/cyan] - Root filesystem (read-only, secure)")
-        console.print(f"  • [cyan]RootFS-RW[/cyan] - Root filesystem (read-write, DANGEROUS!)")
-        console.print(f"  • [cyan]Homes[/cyan] - User home directories")
-        console.print(f"  • [cyan]{SAMBA_SHARE_NAME}[/cyan] - Data volume")
-        console.print("[bold red]WARNING:[/bold red] RootFS-RW share provides full system access - use with extreme caution!")
+        console.print(_SAMBA_SHARES_TEXT)
     else:
-        failed_services = []
-        if not smbd_active: failed_services.append('smbd')
-        if not nmbd_active: failed_services.append('nmbd')
-        console.print(f"[bold red]Error:[/bold red] Enhanced Samba configuration applied, but service(s) [{', '.join(failed_services)}] failed to start or are not active.")
+        failed_services = [unit for unit in samba_units if not unit_active[unit]]
+        console.print(Text.assemble(("Error:", "bold red"), f" Enhanced Samba configuration applied, but service(s) [{', '.join(failed_services)}] failed to start or are not active."))
         logger.error(f"Samba service(s) not active after configuration: {failed_services}")
-        run_command(['systemctl', 'status', 'smbd', 'nmbd', '--no-pager'], description="Samba service status", check=False, show_output=True)
+        run_command(['systemctl', 'status', *failed_services, '--no-pager'], description="Samba service status", check=False, show_output=True)
         return False # Fail the step if services aren't running
 
     logger.info("Enhanced Samba configuration step finished.")
@@ -2897,7 +3879,7 @@ def step_enhanced_ssh_config(progress, task_id, args):
     if sshd_config_file.exists():
         backup_file = sshd_config_file.with_suffix(f".backup-{current_timestamp}")
         try:
-            shutil.copy2(str(sshd_config_file), str(backup_file))
+            backup_file_copy(sshd_config_file, backup_file)
             console.print(f"[green]✓[/green] Backed up SSH config to [cyan]{backup_file}[/cyan]")
             logger.info(f"Backed up {sshd_config_file} to {backup_file}")
         except Exception as e:
@@ -2968,23 +3950,23 @@ Compression yes
     
     # Ensure SSH directory exists with proper permissions
     try:
-        user_info = pwd.getpwnam(DEBIAN_USER)
+        user_info = _pw(DEBIAN_USER)
         ssh_dir = Path(f"/home/{DEBIAN_USER}/.ssh")
         
-        # Create SSH directory as user
-        if not run_command(['mkdir', '-p', str(ssh_dir)], user=DEBIAN_USER, description="Ensuring SSH directory exists"):
-            logger.error(f"Failed to create SSH directory {ssh_dir}")
-            return False
-        
-        # Set proper permissions
-        run_command(['chmod', '700', str(ssh_dir)], user=DEBIAN_USER, description="Setting SSH directory permissions")
+        # SSH directory owned by the user with mode 700 (direct syscalls, no sudo/mkdir/chmod)
+        _ensure_private_dir(ssh_dir, user_info.pw_uid, user_info.pw_gid)
         
-        # Create/ensure authorized_keys file
+        # Create/ensure authorized_keys file (600, the user's); never follow a symlink as root
         auth_keys_file = ssh_dir / "authorized_keys"
-        if not run_command(['touch', str(auth_keys_file)], user=DEBIAN_USER, description="Creating authorized_keys file"):
-            logger.warning("Failed to create authorized_keys file")
-        else:
-            run_command(['chmod', '600', str(auth_keys_file)], user=DEBIAN_USER, description="Setting authorized_keys permissions")
+        try:
+            fd = os.open(auth_keys_file, os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+            try:
+                os.fchown(fd, user_info.pw_uid, user_info.pw_gid)
+                os.fchmod(fd, 0o600)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.warning(f"Failed to create authorized_keys file: {e}")
         
         console.print(f"[green]✓[/green] SSH directory and authorized_keys configured for [yellow]{DEBIAN_USER}[/yellow].")
         
@@ -3011,7 +3993,7 @@ def step_enhanced_vnc_config(progress, task_id, args):
     logger.info(f"Starting enhanced VNC configuration for user {DEBIAN_USER}.")
     
     try:
-        user_info = pwd.getpwnam(DEBIAN_USER)
+        user_info = _pw(DEBIAN_USER)
         user_home = Path(user_info.pw_dir)
         vnc_dir = user_home / ".vnc"
         vnc_xstartup_path = vnc_dir / "xstartup"
@@ -3023,13 +4005,14 @@ def step_enhanced_vnc_config(progress, task_id, args):
     
     console.print(f"[cyan]Configuring enhanced VNC for user [yellow]{DEBIAN_USER}[/yellow]...[/cyan]")
     
-    # Ensure VNC directory exists
-    if not run_command(['mkdir', '-p', str(vnc_dir)], user=DEBIAN_USER, description="Creating VNC directory"):
-        logger.error(f"Failed to create VNC directory {vnc_dir}")
+    # Ensure VNC directory exists, owned by the user with mode 700
+    try:
+        _ensure_private_dir(vnc_dir, user_info.pw_uid, user_info.pw_gid)
+    except OSError as e:
+        console.print(f"[bold red]Error:[/bold red] Failed creating/preparing VNC directory {vnc_dir}: {e}")
+        logger.error(f"Failed to create VNC directory {vnc_dir}: {e}")
         return False
     
-    run_command(['chmod', '700', str(vnc_dir)], user=DEBIAN_USER, description="Setting VNC directory permissions")
-    
     # Enhanced VNC startup script
     enhanced_xstartup = '''#!/bin/bash
 # Enhanced VNC startup script with better desktop integration
@@ -3122,11 +4105,11 @@ dpi=96
     vnc_service_file = Path("/etc/systemd/system/vncserver@.service")
     
     try:
-        vnc_user_info = pwd.getpwnam(DEBIAN_USER)
+        vnc_user_info = _pw(DEBIAN_USER)
         primary_gid = vnc_user_info.pw_gid
         vnc_group_name = DEBIAN_USER
         try:
-            vnc_group_name = grp.getgrgid(primary_gid).gr_name
+            vnc_group_name = _grgid(primary_gid).gr_name
         except KeyError:
             logger.warning(f"Could not find group name for primary GID {primary_gid}")
         
@@ -3141,8 +4124,9 @@ dpi=96
     enhanced_vnc_service = f'''[Unit]
 Description=Enhanced TigerVNC server for user {DEBIAN_USER}
 Documentation=man:vncserver(1) man:Xvnc(1)
-After=syslog.target network-online.target graphical.target
-Wants=network-online.target
+# Same ordering as VNC_UNIT_TMPL: network and the data mount only, not graphical.target
+After=network-online.target lvm-activate-data-vg.service mnt-data.mount
+Wants=network-online.target lvm-activate-data-vg.service mnt-data.mount
 
 [Service]
 Type=forking
@@ -3182,10 +4166,8 @@ WantedBy=multi-user.target
         logger.error("Failed to write enhanced VNC systemd service.")
         return False
     
-    # Reload systemd and enable service
-    if not run_command(['systemctl', 'daemon-reload'], description="Reloading systemd daemon"):
-        console.print("[yellow]Warning:[/yellow] Failed to reload systemd daemon.")
-        logger.warning("Failed to reload systemd daemon.")
+    # Enable the service; the daemon-reload is deferred (enable reads the unit file from disk)
+    request_daemon_reload()
     
     vnc_instance_service = f"vncserver@{VNC_DISPLAY_NUM}.service"
     if not run_command(['systemctl', 'enable', vnc_instance_service], description=f"Enabling {vnc_instance_service}"):
@@ -3215,11 +4197,11 @@ def step_setup_podman(progress, task_id, args): # Added args
 
     # --- Define Home Directory Paths ---
     try:
-        user_info = pwd.getpwnam(DEBIAN_USER)
+        user_info = _pw(DEBIAN_USER)
         user_home = Path(user_info.pw_dir)
         # Need user's primary group for ownership, DEBIAN_GROUP might be secondary
         user_gid = user_info.pw_gid
-        user_group_info = grp.getgrgid(user_gid)
+        user_group_info = _grgid(user_gid)
         user_primary_group = user_group_info.gr_name
     except KeyError:
          console.print(f"[bold red]Error:[/bold red] Cannot find user {DEBIAN_USER} or primary group to determine home directory/ownership.")
@@ -3234,37 +4216,31 @@ def step_setup_podman(progress, task_id, args): # Added args
     rootful_config_dir = user_home / ".config/containers_root" # Separated name
     rootful_storage_conf_file = rootful_config_dir / "storage.conf"
     rootful_storage_path = user_home / ".local/share/containers_root/storage" # Separated name
+    # Separate runroot for this non-standard rootful setup
+    rootful_runroot = user_home / ".local/run/containers_root/storage"
+
+    # Shared with the post-install summary in main()
+    args.podman_paths = SimpleNamespace(
+        rootless_conf=rootless_storage_conf_file,
+        rootful_conf=rootful_storage_conf_file,
+        rootful_runroot=rootful_runroot,
+    )
 
     storage_driver = "overlay" # Or choose another if preferred/needed
 
     # --- 1. Configure Subordinate IDs ---
-    console.print(f"Configuring subordinate UIDs/GIDs for rootless user [yellow]{DEBIAN_USER}[/yellow]...")
+    console.print(Text.assemble("Configuring subordinate UIDs/GIDs for rootless user ", _USER_TAG, "..."))
     logger.info(f"Configuring subuids/subgids for {DEBIAN_USER} in {sub_uid_file}, {sub_gid_file}.")
     sub_id_configured = True
     try:
-        # Check and add subuid entry
-        sub_uid_content = sub_uid_file.read_text() if sub_uid_file.exists() else ""
-        if f"{DEBIAN_USER}:" not in sub_uid_content:
-            sub_uid_entry = f"{DEBIAN_USER}:{sub_uid_start}:{sub_id_count}"
-            logger.info(f"Adding subuid entry: {sub_uid_entry}")
-            with open(sub_uid_file, "a") as f:
-                f.write(f"{sub_uid_entry}\n")
-            console.print(f"  - Added subuid entry to {sub_uid_file}.")
-        else:
-            logger.info(f"Subuid entry for {DEBIAN_USER} already exists in {sub_uid_file}.")
-            console.print(f"  - Subuid entry already exists for {DEBIAN_USER}.")
-
-        # Check and add subgid entry
-        sub_gid_content = sub_gid_file.read_text() if sub_gid_file.exists() else ""
-        if f"{DEBIAN_USER}:" not in sub_gid_content:
-            sub_gid_entry = f"{DEBIAN_USER}:{sub_gid_start}:{sub_id_count}"
-            logger.info(f"Adding subgid entry: {sub_gid_entry}")
-            with open(sub_gid_file, "a") as f:
-                f.write(f"{sub_gid_entry}\n")
-            console.print(f"  - Added subgid entry to {sub_gid_file}.")
-        else:
-            logger.info(f"Subgid entry for {DEBIAN_USER} already exists in {sub_gid_file}.")
-            console.print(f"  - Subgid entry already exists for {DEBIAN_USER}.")
+        # Check and add the subuid and subgid entries (one open/read/append each)
+        for sub_file, sub_start, kind in ((sub_uid_file, sub_uid_start, "subuid"), (sub_gid_file, sub_gid_start, "subgid")):
+            if _ensure_subid_entry(sub_file, DEBIAN_USER, sub_start, sub_id_count):
+                logger.info("Added %s entry %s:%s:%s to %s", kind, DEBIAN_USER, sub_start, sub_id_count, sub_file)
+                console.print(f"  - Added {kind} entry to {sub_file}.")
+            else:
+                logger.info("%s entry for %s already exists in %s.", kind.capitalize(), DEBIAN_USER, sub_file)
+                console.print(f"  - {kind.capitalize()} entry already exists for {DEBIAN_USER}.")
 
     except Exception as e:
         console.print(f"[bold yellow]Warning:[/bold yellow] Could not automatically configure /etc/subuid or /etc/subgid: {e}")
@@ -3277,7 +4253,7 @@ def step_setup_podman(progress, task_id, args): # Added args
         logger.info("Subordinate ID configuration finished.")
 
     # --- 2. Enable Linger ---
-    console.print(f"Enabling session lingering for user [yellow]{DEBIAN_USER}[/yellow]...")
+    console.print(Text.assemble("Enabling session lingering for user ", _USER_TAG, "..."))
     logger.info(f"Enabling linger for user {DEBIAN_USER}.")
     linger_result = run_command(['loginctl', 'enable-linger', DEBIAN_USER], description="Enable linger", check=False)
     if not linger_result or linger_result.returncode != 0:
@@ -3295,30 +4271,19 @@ def step_setup_podman(progress, task_id, args): # Added args
         logger.info(f"Successfully enabled linger for {DEBIAN_USER}.")
 
     # --- 3. Configure Rootless Storage ---
-    console.print(f"Configuring rootless Podman storage for [yellow]{DEBIAN_USER}[/yellow] -> [cyan]{rootless_storage_path}[/cyan]...")
+    console.print(Text.assemble("Configuring rootless Podman storage for ", _USER_TAG, " -> ", (str(rootless_storage_path), "cyan"), "..."))
     logger.info(f"Configuring Podman rootless storage in {rootless_storage_conf_file} pointing to {rootless_storage_path}.")
 
     try:
-        # Need user's UID/GID for write_file later if creating files as root
-        # We already got user_info and user_primary_group above
-
-        # Create config directory AS THE USER
-        if not run_command(['mkdir', '-p', str(rootless_config_dir)], user=DEBIAN_USER, description=f"Ensuring rootless config dir exists"):
-             raise OSError(f"Failed to create rootless config directory {rootless_config_dir} as user {DEBIAN_USER}")
-        logger.info(f"Ensured rootless config directory exists: {rootless_config_dir}")
-
-        # Create storage directory parent AS THE USER
-        if not run_command(['mkdir', '-p', str(rootless_storage_path.parent)], user=DEBIAN_USER, description=f"Ensuring rootless storage parent dir exists"):
-            raise OSError(f"Failed to create rootless storage parent directory {rootless_storage_path.parent} as user {DEBIAN_USER}")
-        logger.info(f"Ensured rootless storage parent directory exists: {rootless_storage_path.parent}")
-        # The storage dir itself is created by podman later or can be created here too
-        if not run_command(['mkdir', '-p', str(rootless_storage_path)], user=DEBIAN_USER, description=f"Ensuring rootless storage dir exists"):
-            raise OSError(f"Failed to create rootless storage directory {rootless_storage_path} as user {DEBIAN_USER}")
-        logger.info(f"Ensured rootless storage directory exists: {rootless_storage_path}")
+        # Create the rootless and rootful config/storage directories (the rootful ones also live
+        # in the user's home), owned by the user
+        podman_dirs = [rootless_storage_path, rootful_config_dir, rootful_storage_path, rootless_config_dir]
+        _make_user_dirs(podman_dirs, user_info.pw_uid, user_gid)
+        logger.info("Ensured Podman directories exist: %s", ', '.join(map(str, podman_dirs)))
 
     except Exception as e:
-        console.print(f"[bold red]Error:[/bold red] Failed setting up directories for rootless Podman: {e}")
-        logger.exception(f"Failed setting up directories for rootless Podman {DEBIAN_USER}")
+        console.print(f"[bold red]Error:[/bold red] Failed setting up Podman directories: {e}")
+        logger.exception(f"Failed setting up Podman directories for {DEBIAN_USER}")
         return False # Fail the step if dirs can't be made
 
     # Create the rootless storage.conf file
@@ -3340,45 +4305,17 @@ graphroot = "{rootless_storage_path}"
 # Options specific to the driver, e.g., overlay options
 
 """
-    # Use write_file to create the config file as root, but chown it to the user/primary_group
-    if not write_file(rootless_storage_conf_file, rootless_storage_conf_content,
-                      owner=DEBIAN_USER, group=user_primary_group, permissions="0644", show_content=False): # Don't show default content
-        console.print(f"[bold red]Error:[/bold red] Failed to write rootless Podman storage configuration file: {rootless_storage_conf_file}")
-        logger.error(f"Failed writing rootless Podman storage configuration {rootless_storage_conf_file}")
-        return False
-
-    console.print(f"[green]✓[/green] Rootless Podman storage directories and config prepared for [yellow]{DEBIAN_USER}[/yellow].")
-    logger.info(f"Rootless Podman storage config prepared at {rootless_storage_conf_file}")
+    # Written together with the rootful storage.conf below
 
     # --- 4. Setup Directories/Config for Rootful Storage (in Home) ---
     # IMPORTANT: This setup does NOT automatically make 'sudo podman' use this.
     # The user MUST explicitly point 'sudo podman' to this config/storage.
-    console.print(f"Preparing directories for rootful Podman storage (non-standard location): [cyan]{rootful_storage_path}[/cyan]...")
+    console.print(f"Preparing rootful Podman storage config (non-standard location): [cyan]{rootful_storage_path}[/cyan]...")
     logger.info(f"Preparing non-standard rootful Podman storage location {rootful_storage_path} and config {rootful_storage_conf_file}")
 
-    try:
-        # Create config directory AS THE USER (root will use it via flags/env vars)
-        if not run_command(['mkdir', '-p', str(rootful_config_dir)], user=DEBIAN_USER, description=f"Ensuring rootful config dir exists"):
-             raise OSError(f"Failed to create rootful config directory {rootful_config_dir} as user {DEBIAN_USER}")
-        logger.info(f"Ensured rootful config directory exists: {rootful_config_dir}")
-
-        # Create storage directory parent AS THE USER
-        if not run_command(['mkdir', '-p', str(rootful_storage_path.parent)], user=DEBIAN_USER, description=f"Ensuring rootful storage parent dir exists"):
-            raise OSError(f"Failed to create rootful storage parent directory {rootful_storage_path.parent} as user {DEBIAN_USER}")
-        logger.info(f"Ensured rootful storage parent directory exists: {rootful_storage_path.parent}")
-        # Create storage directory itself AS THE USER
-        if not run_command(['mkdir', '-p', str(rootful_storage_path)], user=DEBIAN_USER, description=f"Ensuring rootful storage dir exists"):
-            raise OSError(f"Failed to create rootful storage directory {rootful_storage_path} as user {DEBIAN_USER}")
-        logger.info(f"Ensured rootful storage directory exists: {rootful_storage_path}")
-
-    except Exception as e:
-        console.print(f"[bold red]Error:[/bold red] Failed setting up directories for home-based rootful Podman: {e}")
-        logger.exception(f"Failed setting up directories for home-based rootful Podman for {DEBIAN_USER}")
-        return False # Fail the step if dirs can't be made
+    # The rootful config and storage directories were created with the rootless ones above
 
     # Create the rootful storage.conf file (in the user's home)
-    # Define a separate runroot for this non-standard rootful setup
-    rootful_runroot = user_home / ".local/run/containers_root/storage"
     rootful_runroot.parent.mkdir(parents=True, exist_ok=True) # Ensure parent exists (as root)
     # Chown the runroot parent to the user? Or leave as root? Leave as root for now.
     # os.chown(rootful_runroot.parent, user_info.pw_uid, user_gid)
@@ -3403,9 +4340,22 @@ runroot = "{rootful_runroot}" # Use a separate runroot within home too
 # Options specific to the driver
 
 """
-    # Use write_file to create the config file as root, but chown it to the user/primary_group
-    if not write_file(rootful_storage_conf_file, rootful_storage_conf_content,
-                      owner=DEBIAN_USER, group=user_primary_group, permissions="0644", show_content=False): # Don't show default content
+    # Write both storage.conf files in one batch as root, chowned to the user/primary_group
+    conf_results = write_files([
+        {"path": rootless_storage_conf_file, "content": rootless_storage_conf_content,
+         "owner": DEBIAN_USER, "group": user_primary_group, "permissions": "0644", "atomic": True},
+        {"path": rootful_storage_conf_file, "content": rootful_storage_conf_content,
+         "owner": DEBIAN_USER, "group": user_primary_group, "permissions": "0644", "atomic": True},
+    ])
+    if not conf_results[rootless_storage_conf_file]:
+        console.print(f"[bold red]Error:[/bold red] Failed to write rootless Podman storage configuration file: {rootless_storage_conf_file}")
+        logger.error(f"Failed writing rootless Podman storage configuration {rootless_storage_conf_file}")
+        return False
+
+    console.print(Text.assemble(("✓", "green"), " Rootless Podman storage directories and config prepared for ", _USER_TAG, "."))
+    logger.info(f"Rootless Podman storage config prepared at {rootless_storage_conf_file}")
+
+    if not conf_results[rootful_storage_conf_file]:
         console.print(f"[bold red]Error:[/bold red] Failed to write home-based rootful Podman storage configuration file: {rootful_storage_conf_file}")
         logger.error(f"Failed writing home-based rootful Podman storage configuration {rootful_storage_conf_file}")
         return False
@@ -3432,9 +4382,7 @@ def step_cleanup(progress, task_id, args): # Added args
     console.print("[cyan]Performing final cleanup and system optimization...[/cyan]")
     
     # Clean APT cache
-    clean_env = os.environ.copy()
-    clean_env['DEBIAN_FRONTEND'] = 'noninteractive'
-    if run_command(['apt-get', 'clean'], env=clean_env, description="Cleaning APT cache"):
+    if run_command(['apt-get', 'clean'], env=APT_NONINTERACTIVE_ENV, description="Cleaning APT cache"):
         console.print("[green]✓[/green] APT cache cleaned.")
         logger.info("APT cache cleaned successfully.")
     else:
@@ -3442,7 +4390,7 @@ def step_cleanup(progress, task_id, args): # Added args
         logger.warning("'apt-get clean' failed.")
     
     # Remove unnecessary packages
-    if run_command(['apt-get', 'autoremove', '-y'], env=clean_env, description="Removing unnecessary packages"):
+    if run_command(['apt-get', 'autoremove', '-y'], env=APT_NONINTERACTIVE_ENV, description="Removing unnecessary packages"):
         console.print("[green]✓[/green] Unnecessary packages removed.")
         logger.info("Unnecessary packages removed successfully.")
     else:
@@ -3467,27 +4415,16 @@ def step_cleanup(progress, task_id, args): # Added args
         else:
             console.print("[yellow]Warning:[/yellow] Failed to update man database.")
     
-    # Verify key services are running
-    console.print("[cyan]Verifying key services...[/cyan]")
-    key_services = ['ssh', 'smbd', 'docker']
-    service_status = {}
-    
-    for service in key_services:
-        status_result = run_command(['systemctl', 'is-active', '--quiet', service], check=False, description=f"Checking {service} status")
-        service_status[service] = status_result and status_result.returncode == 0
-        
-        if service_status[service]:
-            console.print(f"[green]✓[/green] {service} service is active")
-        else:
-            console.print(f"[yellow]⚠[/yellow] {service} service is not active")
-    
-    # Create system information script
+    # Prepare the system information script and log rotation config
     try:
-        user_info = pwd.getpwnam(DEBIAN_USER)
-        user_home = Path(user_info.pw_dir)
-        sysinfo_script = user_home / "system-info.sh"
-        
-        sysinfo_content = '''#!/bin/bash
+        user_info = _pw(DEBIAN_USER)
+        sysinfo_script = Path(user_info.pw_dir) / "system-info.sh"
+    except KeyError:
+        sysinfo_script = None
+        console.print(f"[yellow]Warning:[/yellow] User '{DEBIAN_USER}' not found, skipping system information script.")
+        logger.warning(f"User '{DEBIAN_USER}' not found, skipping system information script.")
+
+    sysinfo_content = '''#!/bin/bash
 # System Information Script
 # Generated by Ultima-interactive.py installer
 
@@ -3513,17 +4450,15 @@ echo "=== Docker Information ==="
 if command -v docker >/dev/null 2>&1; then
     echo "Docker Version: $(docker --version)"
     echo "Docker Status: $(systemctl is-active docker)"
-    echo "Docker Images: $(docker images --format 'table {{.Repository}}\\t{{.Tag}}\\t{{.Size}}' 2>/dev/null || echo 'None')"
+    echo "Docker Images: $(docker image ls -q 2>/dev/null | wc -l) present (details: docker image ls)"
 else
     echo "Docker: Not installed"
 fi
 echo ""
 
 echo "=== Services Status ==="
-for service in ssh smbd docker vncserver@1; do
-    status=$(systemctl is-active $service 2>/dev/null || echo "inactive")
-    echo "$service: $status"
-done
+# One systemctl call for all units: Id/ActiveState pairs, blank unit separators dropped
+systemctl show -p Id -p ActiveState --value ssh smbd docker vncserver@1 2>/dev/null | sed '/^$/d' | paste - - | awk '{print $1 ": " $2}'
 echo ""
 
 echo "=== Storage Information ==="
@@ -3543,17 +4478,7 @@ else
     echo "Samba client not available"
 fi
 '''
-        
-        if write_file(sysinfo_script, sysinfo_content, owner=DEBIAN_USER, permissions="0755"):
-            console.print(f"[green]✓[/green] System information script created at [cyan]{sysinfo_script}[/cyan]")
-        else:
-            console.print("[yellow]Warning:[/yellow] Failed to create system information script.")
-            
-    except Exception as e:
-        console.print(f"[yellow]Warning:[/yellow] Failed to create system information script: {e}")
-        logger.warning(f"Failed to create system information script: {e}")
-    
-    # Set up log rotation for installer logs
+
     logrotate_config = Path("/etc/logrotate.d/avf-installer")
     logrotate_content = f'''{LOG_FILENAME} {{
     weekly
@@ -3565,12 +4490,38 @@ fi
     create 644 root root
 }}
 '''
-    
-    if write_file(logrotate_config, logrotate_content, permissions="0644"):
+
+    # Service probes and the two file writes are independent, so overlap them
+    key_services = ['ssh', 'smbd', 'docker']
+
+    console.print("[cyan]Verifying key services and writing helper files...[/cyan]")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        states_future = executor.submit(get_unit_properties, key_services)
+        file_specs = [{"path": logrotate_config, "content": logrotate_content, "permissions": "0644"}]
+        if sysinfo_script:
+            file_specs.append({"path": sysinfo_script, "content": sysinfo_content, "owner": DEBIAN_USER, "permissions": "0755"})
+        files_future = executor.submit(write_files, file_specs)
+
+    unit_states = states_future.result()
+    service_status = {service: unit_states.get(service, {}).get('ActiveState') == 'active' for service in key_services}
+    for service, active in service_status.items():
+        if active:
+            console.print(f"[green]✓[/green] {service} service is active")
+        else:
+            console.print(f"[yellow]⚠[/yellow] {service} service is not active")
+
+    file_results = files_future.result()
+    if sysinfo_script:
+        if file_results[sysinfo_script]:
+            console.print(f"[green]✓[/green] System information script created at [cyan]{sysinfo_script}[/cyan]")
+        else:
+            console.print("[yellow]Warning:[/yellow] Failed to create system information script.")
+
+    if file_results[logrotate_config]:
         console.print("[green]✓[/green] Log rotation configured for installer logs.")
     else:
         console.print("[yellow]Warning:[/yellow] Failed to configure log rotation.")
-    
+
     logger.info("Final cleanup and system optimization finished.")
     progress.update(task_id, advance=1)
     return True
@@ -3590,7 +4541,14 @@ def main():
         action='store_true',      # Store True if flag is present
         help='Run in non-interactive mode, assuming yes to confirmations (use with caution!).'
     )
+    parser.add_argument(
+        '--quiet', '-q',
+        action='store_true',
+        help='Only print errors, warnings, prompts and step headers (full detail still goes to the log file).'
+    )
     args = parser.parse_args()
+    global QUIET
+    QUIET = args.quiet
     # --- End Argument Parsing ---
 
     start_time = datetime.datetime.now()
@@ -3628,21 +4586,40 @@ def main():
 
         # Verify step order reflects dependencies (Enable Services should be after LVM/Fstab)
         # This check seems reasonable to keep.
-        step_titles = [s['title'] for s in installer_steps]
-        try:
-            lvm_idx = step_titles.index("Configure LVM (Create if Needed)")
-            fstab_idx = step_titles.index("Configure Mount Point & fstab")
-            enable_svc_idx = step_titles.index("Enable Storage Persistence Services")
-            if not (enable_svc_idx > lvm_idx and enable_svc_idx > fstab_idx):
-                 console.print("[bold red]INTERNAL ERROR: Step order incorrect. Enable Storage Services must come after LVM and Fstab config.[/bold red]")
-                 logger.critical("Installer step order incorrect regarding Enable Storage Services.")
-                 sys.exit(99)
-        except ValueError:
+        title_to_idx = {s['title']: idx for idx, s in enumerate(installer_steps)}
+        lvm_idx = title_to_idx.get("Configure LVM (Create if Needed)")
+        fstab_idx = title_to_idx.get("Configure Mount Point & fstab")
+        enable_svc_idx = title_to_idx.get("Enable Storage Persistence Services")
+        if None in (lvm_idx, fstab_idx, enable_svc_idx):
              console.print("[bold red]INTERNAL ERROR: One of the storage configuration steps is missing.[/bold red]")
              logger.critical("One or more essential storage steps missing from installer_steps list.")
              sys.exit(98)
+        if enable_svc_idx <= max(lvm_idx, fstab_idx):
+             console.print("[bold red]INTERNAL ERROR: Step order incorrect. Enable Storage Services must come after LVM and Fstab config.[/bold red]")
+             logger.critical("Installer step order incorrect regarding Enable Storage Services.")
+             sys.exit(99)
+
+        # Step headers are built once as plain Text (no markup to parse when each one prints)
+        step_rules = [
+            Rule(Text.assemble((f"Starting: {step['title']}", "bold cyan"), f" ({n}/{total_steps})"))
+            for n, step in enumerate(installer_steps, 1)
+        ]
 
-        for i, step_info in enumerate(installer_steps):
+        def run_step(i, step_info, deferred_output=False):
+            """
+            Runs one installer step with its own progress task; returns True on success.
+            With deferred_output (concurrent waves) the step's console output is captured on
+            its thread and printed as one block when it finishes, so parallel steps don't interleave.
+            """
+            if not deferred_output:
+                return _run_step(i, step_info)
+            with console.capture() as captured: # Rich capture buffers are per-thread
+                step_success = _run_step(i, step_info)
+            console.print(Text.from_ansi(captured.get()), end="")
+            return step_success
+
+        def _run_step(i, step_info):
+            """Body of run_step(): starts the step's progress task, runs it and reports the outcome."""
             step_title = step_info['title']
             step_func = step_info['func']
             step_number = i + 1
@@ -3650,7 +4627,7 @@ def main():
             # Add task but don't start it immediately, let the step function advance it
             step_task = progress.add_task(task_description, total=1, start=False, visible=True)
 
-            console.print(Rule(f"[bold cyan]Starting: {step_title}[/bold cyan] ({step_number}/{total_steps})"))
+            console.print(step_rules[i])
             logger.info(f"Starting step ({step_number}/{total_steps}): {step_title}")
             progress.start_task(step_task) # Mark task as started visually
 
@@ -3705,23 +4682,43 @@ def main():
                 )
                 
                 logger.critical(f"Failed step: {step_title}. Aborting installation.")
+            return step_success
+
+        completed_titles = set()
+        i = 0
+        while i < total_steps:
+            # Group consecutive steps whose declared dependencies are already met and run them together.
+            # Interactive runs stay sequential since prompts need the terminal to themselves.
+            wave = [i]
+            if args.non_interactive and step_is_ready(installer_steps[i], completed_titles):
+                while wave[-1] + 1 < total_steps and step_is_ready(installer_steps[wave[-1] + 1], completed_titles):
+                    wave.append(wave[-1] + 1)
+
+            if len(wave) == 1:
+                results = [run_step(i, installer_steps[i])]
+            else:
+                logger.info(f"Running steps concurrently: {[installer_steps[idx]['title'] for idx in wave]}")
+                with ThreadPoolExecutor(max_workers=3) as executor:
+                    results = list(executor.map(lambda idx: run_step(idx, installer_steps[idx], deferred_output=True), wave))
+
+            completed_titles.update(installer_steps[idx]['title'] for idx, ok in zip(wave, results) if ok)
+            if not all(results):
                 all_steps_successful = False
                 progress.update(overall_task, description="[bold red]Overall Progress (Failed)[/bold red]")
                 # Keep progress bar visible on failure
                 # progress.stop()
                 break # Exit the loop
 
+            i = wave[-1] + 1
             time.sleep(0.3) # Small pause between steps for visual effect
 
-        # After the loop finishes
+        # After the loop finishes: one reload covers every unit file written since the last one
+        if not flush_daemon_reload():
+            console.print("[yellow]Warning:[/yellow] Final systemctl daemon-reload failed. Run 'sudo systemctl daemon-reload' manually.")
+            logger.warning("Deferred daemon-reload at the end of the run failed.")
         if not all_steps_successful:
-             # Save console output on failure
-             try:
-                 html_log = f"installer_error_console_{current_timestamp}.html"
-                 console.save_html(html_log)
-                 console.print(f"\n[yellow]Tip:[/yellow] Detailed console output saved to [dim]'{html_log}'[/dim] for review.")
-             except Exception as save_err:
-                 logger.warning(f"Could not save console HTML log on failure: {save_err}")
+             # Save console output on failure (in the background; joined at interpreter exit)
+             save_console_html_async(ERROR_HTML_LOG)
              sys.exit(1) # Exit with error code
 
     # If all steps completed successfully
@@ -3735,21 +4732,23 @@ def main():
 
 
     # Post-Installation Info - Updated with all new features
-    # Get paths again dynamically for the summary message
+    # Podman paths were recorded by step_setup_podman; the rest are derived from the home dir
+    podman_paths = getattr(args, 'podman_paths', None)
+    if podman_paths is None:
+        # Should not happen if install succeeded, but handle gracefully
+        podman_paths = SimpleNamespace(
+            rootless_conf=f"/home/{DEBIAN_USER}/.config/containers/storage.conf (approx)",
+            rootful_conf=f"/home/{DEBIAN_USER}/.config/containers_root/storage.conf (approx)",
+            rootful_runroot=f"/home/{DEBIAN_USER}/.local/run/containers_root/storage (approx)",
+        )
+    rootless_storage_conf_file = podman_paths.rootless_conf
+    rootful_storage_conf_file = podman_paths.rootful_conf
+    rootful_runroot = podman_paths.rootful_runroot
     try:
-        user_info = pwd.getpwnam(DEBIAN_USER)
-        user_home = Path(user_info.pw_dir)
-        rootless_storage_conf_file = user_home / ".config/containers/storage.conf"
-        rootful_config_dir = user_home / ".config/containers_root"
-        rootful_storage_conf_file = rootful_config_dir / "storage.conf"
-        rootful_runroot = user_home / ".local/run/containers_root/storage" # As defined in step
+        user_home = Path(_pw(DEBIAN_USER).pw_dir)
         starship_config = user_home / ".config/starship.toml"
         sysinfo_script = user_home / "system-info.sh"
     except KeyError:
-         # Should not happen if install succeeded, but handle gracefully
-         rootless_storage_conf_file = f"/home/{DEBIAN_USER}/.config/containers/storage.conf (approx)"
-         rootful_storage_conf_file = f"/home/{DEBIAN_USER}/.config/containers_root/storage.conf (approx)"
-         rootful_runroot = f"/home/{DEBIAN_USER}/.local/run/containers_root/storage (approx)"
          starship_config = f"/home/{DEBIAN_USER}/.config/starship.toml (approx)"
          sysinfo_script = f"/home/{DEBIAN_USER}/system-info.sh (approx)"
 
@@ -3823,13 +4822,14 @@ def main():
     console.print(f"- [log] Logs:[/log] Installation logs: [dim]{LOG_FILENAME}[/dim]")
     
     console.print(Rule())
-    console.print("[bold green]🎉 Installation completed successfully! Your Debian ARM64 system is now fully enhanced with:")
-    console.print("   • Docker CE with x86 emulation support")
-    console.print("   • Enhanced Samba sharing (including root filesystem)")
-    console.print("   • Advanced package management tools")
-    console.print("   • Starship cross-shell prompt")
-    console.print("   • Enhanced SSH and VNC configurations")
-    console.print("   • Comprehensive system optimizations[/bold green]")
+    # One markup string (and one write) so the bold green span opens and closes in the same print
+    console.print("[bold green]🎉 Installation completed successfully! Your Debian ARM64 system is now fully enhanced with:\n"
+                  "   • Docker CE with x86 emulation support\n"
+                  "   • Enhanced Samba sharing (including root filesystem)\n"
+                  "   • Advanced package management tools\n"
+                  "   • Starship cross-shell prompt\n"
+                  "   • Enhanced SSH and VNC configurations\n"
+                  "   • Comprehensive system optimizations[/bold green]")
     console.print(Rule())
 
     sys.exit(0)
@@ -3841,17 +4841,16 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         console.print("\n[bold yellow]\nInstallation interrupted by user (Ctrl+C).[/bold yellow]")
         logger.warning("Installation interrupted by user (KeyboardInterrupt).")
+        flush_logs()
         sys.exit(130)
     except Exception as e:
-         console.print(f"\n[bold red]An unexpected critical error occurred outside of step execution:[/bold red]")
-         logger.critical("Unexpected critical error during main execution.", exc_info=True)
-         console.print_exception(show_locals=False, word_wrap=True)
-         console.print(f"\nPlease check the log file for details: [dim]{LOG_FILENAME}[/dim]")
-         # Try to save console output on critical failure
-         try:
-              html_log = f"installer_CRITICAL_error_console_{current_timestamp}.html"
-              console.save_html(html_log)
-              console.print(f"\n[yellow]Tip:[/yellow] Detailed console output saved to [dim]'{html_log}'[/dim] for review.")
-         except Exception as save_err:
-              logger.warning(f"Could not save console HTML log on critical failure: {save_err}")
+         os.write(2, _BANNER_CRIT)
+         # Format the traceback once and feed the same text to the log and the console
+         tb_str = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+         logger.critical("Unexpected critical error during main execution:\n%s", tb_str)
+         console.print(tb_str, style="red", markup=False, highlight=False)
+         os.write(2, _BANNER_LOG_HINT)
+         # Try to save console output on critical failure (background export, bounded wait)
+         save_console_html_async(CRITICAL_HTML_LOG).join(timeout=2.0)
+         flush_logs()
          sys.exit(2)